@@ -0,0 +1,153 @@
+"""Compare the struct based APS decoder with the former binascii based one
+
+Run from the repository root: python benchmarks/bench_decoder.py [inverter qty...]
+"""
+
+import binascii
+import sys
+import timeit
+
+from aps2mqtt.apsystems import frames
+from aps2mqtt.apsystems.APSystemsSocket import APSystemsSocket
+
+_TYPES = ["01", "02", "03", "04", "05"]
+
+
+class LegacyAPSystemsSocket(APSystemsSocket):
+    """Decoder as it was before the struct based implementation"""
+
+    def aps_int(self, codec, start):
+        return int(binascii.b2a_hex(codec[(start) : (start + 2)]), 16)
+
+    def aps_short(self, codec, start):
+        return int(binascii.b2a_hex(codec[(start) : (start + 1)]), 8)
+
+    def aps_uid(self, codec, start):
+        return str(binascii.b2a_hex(codec[(start) : (start + 12)]))[2:14]
+
+    def aps_str(self, codec, start, amount):
+        return str(codec[start : (start + amount)])[2 : (amount + 2)]
+
+    def aps_timestamp(self, codec, start, amount):
+        timestr = str(binascii.b2a_hex(codec[start : (start + amount)]))[2 : (amount + 2)]
+        return (
+            timestr[0:4]
+            + "-"
+            + timestr[4:6]
+            + "-"
+            + timestr[6:8]
+            + " "
+            + timestr[8:10]
+            + ":"
+            + timestr[10:12]
+            + ":"
+            + timestr[12:14]
+        )
+
+    def process_signal_data(self, data=None):
+        signal_data = {}
+        data = self.inverter_raw_signal
+        binascii.b2a_hex(data)  # formerly always computed for the debug log
+        self.check_ecu_checksum(data, "Signal Query")
+        location = 15
+        for _ in range(0, self.qty_of_inverters):
+            uid = self.aps_uid(data, location)
+            location += 6
+            strength = data[location]
+            location += 1
+            signal_data[uid] = int((strength / 255) * 100)
+        return signal_data
+
+    def process_inverter_data(self, data=None):
+        output = {}
+        data = self.inverter_raw_data
+        binascii.b2a_hex(data)  # formerly always computed for the debug log
+        self.check_ecu_checksum(data, "Inverter data")
+        cnt2 = 26
+        timestamp = self.aps_timestamp(data, 19, 14)
+        inverter_qty = self.aps_int(data, 17)
+        output["timestamp"] = timestamp
+        signal = self.process_signal_data()
+        inverters = []
+        for _ in range(inverter_qty):
+            inv = {}
+            if self.aps_str(data, 15, 2) == "01":
+                inverter_uid = self.aps_uid(data, cnt2)
+                inv["uid"] = inverter_uid
+                inv["online"] = bool(self.aps_short(data, cnt2 + 6))
+                istr = self.aps_str(data, cnt2 + 7, 2)
+                inv["signal"] = signal.get(inverter_uid, 0)
+                if istr in ["01", "04", "05"]:
+                    offsets, voltage_offsets, stride, model, channel_qty = (
+                        (13, 17),
+                        (15, 19),
+                        21,
+                        "YC600/DS3D/DS3-H/DS3/DS3-L",
+                        2,
+                    )
+                elif istr == "02":
+                    offsets, voltage_offsets, stride, model, channel_qty = (
+                        (13, 17, 21, 25),
+                        (15, 19, 23),
+                        27,
+                        "YC1000/QT2",
+                        4,
+                    )
+                else:
+                    offsets, voltage_offsets, stride, model, channel_qty = (
+                        (13, 17, 19, 21),
+                        (15,),
+                        23,
+                        "QS1",
+                        4,
+                    )
+                inv["frequency"] = self.aps_int(data, cnt2 + 9) / 10
+                if inv["online"]:
+                    inv["temperature"] = self.aps_int(data, cnt2 + 11) - 100
+                inv["model"] = model
+                inv["channel_qty"] = channel_qty
+                inv["power"] = [self.aps_int(data, cnt2 + offset) for offset in offsets]
+                inv["voltage"] = [self.aps_int(data, cnt2 + offset) for offset in voltage_offsets]
+                cnt2 = cnt2 + stride
+                inverters.append(inv)
+        output["inverters"] = inverters
+        return output
+
+
+def build_socket(socket_class, inverter_qty):
+    """Create a socket holding synthetic frames for the given number of mixed inverters"""
+    uids = [frames.inverter_uid(i) for i in range(inverter_qty)]
+    records = [frames.inverter_record(uid, _TYPES[i % len(_TYPES)]) for i, uid in enumerate(uids)]
+    aps_socket = socket_class("127.0.0.1", raw_inverter=frames.inverter_frame(records))
+    aps_socket.inverter_raw_signal = frames.signal_frame([(uid, 200) for uid in uids])
+    aps_socket.qty_of_inverters = inverter_qty
+    return aps_socket
+
+
+def bench(inverter_qty, repeat=5):
+    """Return the best per frame decoding time, in seconds, for the legacy and current decoders"""
+    results = []
+    for socket_class in (LegacyAPSystemsSocket, APSystemsSocket):
+        aps_socket = build_socket(socket_class, inverter_qty)
+        number = max(1, 2000 // inverter_qty)
+        timer = timeit.Timer(aps_socket.process_inverter_data)
+        results.append(min(timer.repeat(repeat=repeat, number=number)) / number)
+    return results
+
+
+def main(inverter_qties):
+    legacy_output = build_socket(LegacyAPSystemsSocket, 10).process_inverter_data()
+    current_output = build_socket(APSystemsSocket, 10).process_inverter_data()
+    if legacy_output != current_output:
+        raise AssertionError("Decoders output differ")
+
+    print(f"{'inverters':>10} {'legacy (ms)':>12} {'struct (ms)':>12} {'speedup':>8}")
+    for inverter_qty in inverter_qties:
+        legacy, current = bench(inverter_qty)
+        print(
+            f"{inverter_qty:>10} {legacy * 1000:>12.3f} {current * 1000:>12.3f} {legacy / current:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [10, 80, 200, 400])
@@ -0,0 +1,145 @@
+"""Measure a full poll, from the ECU query to the MQTT publication, against the ECU simulator
+
+MQTT messages are handed to an in-process stand-in client, so only aps2mqtt is measured.
+
+Run from the repository root: python benchmarks/bench_pipeline.py [--inverters N] ...
+"""
+
+import argparse
+import asyncio
+import time
+import tracemalloc
+from statistics import mean
+
+from paho.mqtt.client import MQTTMessageInfo
+
+from aps2mqtt.apsystems.ECU import ECU
+from aps2mqtt.apsystems.simulator import ECUSimulator
+from aps2mqtt.config import ECUConfig, MQTTConfig
+from aps2mqtt.mqtthandler import MQTTHandler
+
+# query includes the decoding of the frames, measured again alone by decode
+_STAGES = ("query", "decode", "build", "publish", "poll")
+
+
+class FakeMQTTClient:
+    """Stand-in paho client, acknowledging every message as soon as it is published"""
+
+    def __init__(self):
+        self.on_publish = None
+        self.messages = 0
+        self.payload_bytes = 0
+        self._mid = 0
+
+    def is_connected(self):
+        return True
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        del topic, qos, retain
+        self._mid += 1
+        self.messages += 1
+        self.payload_bytes += len(payload)
+        info = MQTTMessageInfo(self._mid)
+        info._set_as_published()  # pylint: disable=protected-access
+        if self.on_publish is not None:
+            self.on_publish(self, None, self._mid, 0, None)
+        return info
+
+
+async def poll(ecu, mqtt_handler, timings):
+    """Run one poll, adding the duration of each stage to timings"""
+    start = time.perf_counter()
+    data = await ecu.async_update()
+    queried = time.perf_counter()
+    ecu.socket.collect_data()
+    decoded = time.perf_counter()
+    mqtt_handler._build_payloads(data)  # pylint: disable=protected-access
+    built = time.perf_counter()
+    await mqtt_handler.async_publish_values(data)
+    published = time.perf_counter()
+
+    timings["query"].append(queried - start)
+    timings["decode"].append(decoded - queried)
+    timings["build"].append(built - decoded)
+    timings["publish"].append(published - built)
+    timings["poll"].append((queried - start) + (published - built))
+
+
+async def bench(args):
+    simulator = ECUSimulator(
+        args.inverters, latency=args.latency, chunk_size=args.chunk_size, seed=0
+    )
+    async with simulator:
+        ecu = ECU(
+            ECUConfig(
+                {
+                    "APS_ECU_IP": "127.0.0.1",
+                    "APS_ECU_PORT": simulator.port,
+                    "APS_ECU_TIMEZONE": "UTC",
+                    "APS_ECU_WAIT_READY": True,
+                    "APS_ECU_PERSISTENT_CONNECTION": args.persistent,
+                }
+            )
+        )
+        mqtt_handler = MQTTHandler(
+            MQTTConfig(
+                {
+                    "MQTT_DISCOVERY_ENABLED": True,
+                    "MQTT_PAYLOAD_MODE": args.mode,
+                    "MQTT_PAYLOAD_ENCODING": args.encoding,
+                }
+            )
+        )
+        client = FakeMQTTClient()
+        client.on_publish = mqtt_handler.on_publish
+        mqtt_handler.client = client
+
+        # First poll publishes the discovery messages, not measured
+        await poll(ecu, mqtt_handler, {stage: [] for stage in _STAGES})
+        client.messages = client.payload_bytes = 0
+
+        timings = {stage: [] for stage in _STAGES}
+        start = time.perf_counter()
+        for _ in range(args.polls):
+            await poll(ecu, mqtt_handler, timings)
+        elapsed = time.perf_counter() - start
+        messages, payload_bytes = client.messages, client.payload_bytes
+
+        tracemalloc.start()
+        peaks = []
+        for _ in range(min(args.polls, 10)):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            await poll(ecu, mqtt_handler, {stage: [] for stage in _STAGES})
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        tracemalloc.stop()
+        await ecu.socket.async_close()
+
+    print(
+        f"{args.inverters} inverters, mode={args.mode}, encoding={args.encoding}, "
+        f"latency={args.latency}s, persistent={args.persistent}"
+    )
+    print(f"{args.polls / elapsed:.1f} polls/s")
+    print(f"{'stage':>8} {'mean (ms)':>10} {'max (ms)':>10}")
+    for stage in _STAGES:
+        print(
+            f"{stage:>8} {mean(timings[stage]) * 1000:>10.3f} {max(timings[stage]) * 1000:>10.3f}"
+        )
+    print(f"{messages / args.polls:.0f} messages, {payload_bytes / args.polls:.0f} bytes per poll")
+    print(f"peak allocation per poll: {max(peaks) / 1024:.1f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--inverters", type=int, default=100)
+    parser.add_argument("--polls", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0, help="ECU reply delay in seconds")
+    parser.add_argument("--chunk-size", type=int, default=None, help="ECU reply chunk size")
+    parser.add_argument("--persistent", action="store_true", help="keep the ECU connection")
+    parser.add_argument("--mode", default="topics", choices=("topics", "aggregated", "both"))
+    parser.add_argument("--encoding", default="json", choices=("json", "msgpack", "cbor"))
+    asyncio.run(bench(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
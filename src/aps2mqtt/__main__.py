@@ -1,3 +1,11 @@
+import sys
+
 from aps2mqtt.main import main
 
-main()
+if __name__ == "__main__":
+    if getattr(sys, "frozen", False):
+        # The spawned decoding workers of a frozen executable start it again
+        import multiprocessing  # pylint: disable=import-outside-toplevel
+
+        multiprocessing.freeze_support()
+    main()
@@ -1,9 +1,32 @@
 """Open communication socket to APSystems ECU, send requests and parse received data"""
+import asyncio
 import socket
-import binascii
+import selectors
 import datetime
 import logging
+import struct
 import time
+from collections import deque
+
+from aps2mqtt.apsystems.inverters import get_inverter_layout
+from aps2mqtt.apsystems.snapshot import decode_inverter_snapshot
+from aps2mqtt.metrics import METRICS
+
+# APS frames start with "APS" + 2 digit version followed by the 4 digit frame length
+_HEADER_SIZE = 9
+_LENGTH_FIELD = slice(5, 9)
+
+# Big endian fields of the APS protocol, compiled once
+_UINT8 = struct.Struct(">B")
+_UINT16 = struct.Struct(">H")
+_UINT32 = struct.Struct(">I")
+_SIGNAL_RECORD = struct.Struct(">6sB")
+
+# Number of errors kept in APSystemsSocket.errors, the oldest are dropped
+_MAX_ERRORS = 50
+
+# Command code -> name, used as metrics label
+_COMMANDS = {"0001": "ecu", "0002": "inverter", "0030": "signal"}
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -16,8 +39,54 @@ class APSystemsInvalidInverter(Exception):
     pass
 
 
+class HexFrame:
+    """Frame formatted as hex only when converted to str, for lazy logging"""
+
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return self.data.hex()
+
+
+class APSystemsError:
+    """Error recorded while decoding an ECU reply, keeping a reference to the frame"""
+
+    __slots__ = ("timestamp", "message", "data")
+
+    def __init__(self, message, data=None):
+        self.timestamp = datetime.datetime.now()
+        self.message = message
+        self.data = data
+
+    def frame_hex(self):
+        """Frame of the error as hex, None if the error isn't about a frame"""
+        return None if self.data is None else self.data.hex()
+
+    def __str__(self):
+        if self.data is None:
+            return f"[{self.timestamp}] {self.message}"
+        return f"[{self.timestamp}] {self.message} data={self.frame_hex()}"
+
+    def __repr__(self):
+        return f"APSystemsError({self.timestamp!r}, {self.message!r})"
+
+
 class APSystemsSocket:
-    def __init__(self, ipaddr, port=8899, raw_ecu=None, raw_inverter=None):
+    def __init__(
+        self,
+        ipaddr,
+        port=8899,
+        raw_ecu=None,
+        raw_inverter=None,
+        timeout=10,
+        wait_ready=False,
+        command_gap=0,
+        persistent=False,
+        snapshot=False,
+    ):
         self.ipaddr = ipaddr
         self.port = port
 
@@ -25,15 +94,36 @@ class APSystemsSocket:
         self.recv_suffix = b"END\n"
 
         # how long to wait on socket commands until we get our recv_suffix
-        self.timeout = 10
+        self.timeout = timeout
 
         # how big of a buffer to read at a time from the socket
         # https://github.com/ksheumaker/homeassistant-apsystems_ecur/issues/108
         self.recv_size = 1024
 
+        # frames are read in this buffer, grown if the ECU announces a bigger frame
+        self.frame_buffer = bytearray(4 * self.recv_size)
+
         # how long to wait between socket open/closes
         self.socket_sleep_time = 5
 
+        # wait for the ECU reply to be readable instead of sleeping socket_sleep_time
+        self.wait_ready = wait_ready
+
+        # minimum delay between the end of a command and the next one, for slow ECUs
+        self.command_gap = command_gap
+        self.last_command_time = None
+
+        # keep the connection open between commands and polls, if the ECU firmware allows it
+        self.persistent = persistent
+        self.persistent_support = {}
+        self.reconnect_min_delay = 1
+        self.reconnect_max_delay = 60
+        self.reconnect_delay = self.reconnect_min_delay
+        self.next_connect_time = None
+
+        # also decode the inverters as a columnar snapshot, requires numpy
+        self.snapshot = snapshot
+
         self.cmd_suffix = "END\n"
         self.ecu_query = "APS1100160001" + self.cmd_suffix
         self.inverter_query_prefix = "APS1100280002"
@@ -61,24 +151,117 @@ class APSystemsSocket:
         self.writer = None
         self.socket = None
         self.socket_open = False
-        self.errors = []
+        # Last decoding errors, the frame is only formatted when an error is read
+        self.errors = deque(maxlen=_MAX_ERRORS)
+        # CaptureWriter recording every reply, if any
+        self.recorder = None
+        # Coroutine function decoding the inverter replies out of the event loop, if any
+        self.decoder = None
 
     def send_read_from_socket(self, cmd):
         try:
+            self.wait_command_gap()
             self.sock.settimeout(self.timeout)
+            start = time.perf_counter()
             self.sock.sendall(cmd.encode("utf-8"))
-            time.sleep(self.socket_sleep_time)
+            sent = time.perf_counter()
+            if self.wait_ready:
+                deadline = time.monotonic() + self.timeout
+                self.wait_readable(deadline)
+            else:
+                time.sleep(self.socket_sleep_time)
+                deadline = time.monotonic() + self.timeout
             self.read_buffer = b""
-            self.sock.settimeout(self.timeout)
             # An infinite loop was causing the integration to block
             # https://github.com/ksheumaker/homeassistant-apsystems_ecur/issues/115
-            # Solution might cause a new issue when large solar array's applies
-            self.read_buffer = self.sock.recv(self.recv_size)
+            # The frame is read until its announced length is reached, within a global deadline
+            self.read_buffer = self.read_frame(deadline)
+            self.last_command_time = time.monotonic()
+            self.record_command_metrics(cmd, start, sent)
             return self.read_buffer
         except Exception as err:
+            if isinstance(err, socket.timeout):
+                METRICS.inc("aps_timeouts_total", ecu=self.ipaddr)
             self.close_socket()
             raise APSystemsInvalidData(err) from err
 
+    def record_command_metrics(self, cmd, start, sent):
+        """Record the send and receive times of a command sent at start"""
+        if not METRICS.enabled:
+            return
+        command = _COMMANDS.get(cmd[9:13], "unknown")
+        METRICS.observe("aps_command_send_seconds", sent - start, ecu=self.ipaddr, command=command)
+        METRICS.observe(
+            "aps_command_receive_seconds",
+            time.perf_counter() - sent,
+            ecu=self.ipaddr,
+            command=command,
+        )
+
+    def command_gap_delay(self):
+        """Remaining time before the minimum delay since the previous command is elapsed"""
+        if self.command_gap <= 0 or self.last_command_time is None:
+            return 0
+        return max(self.last_command_time + self.command_gap - time.monotonic(), 0)
+
+    def wait_command_gap(self):
+        """Sleep until the minimum delay since the previous command is elapsed"""
+        delay = self.command_gap_delay()
+        if delay > 0:
+            time.sleep(delay)
+
+    def wait_readable(self, deadline):
+        """Block until the ECU reply can be read, raise a timeout at the deadline"""
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.sock, selectors.EVENT_READ)
+            if not selector.select(max(deadline - time.monotonic(), 0)):
+                raise socket.timeout("timed out")
+
+    def read_frame(self, deadline):
+        """Read a full APS frame before the deadline, using the length announced in its header"""
+        received = 0
+        expected = None
+        header_read = False
+        while expected is None or received < expected:
+            if not header_read and received >= _HEADER_SIZE:
+                header_read = True
+                expected = self.frame_length(self.frame_buffer)
+                if expected is not None and expected > len(self.frame_buffer):
+                    self.frame_buffer.extend(bytes(expected - len(self.frame_buffer)))
+                continue
+            suffix_start = received - len(self.recv_suffix)
+            if header_read and self.frame_buffer[suffix_start:received] == self.recv_suffix:
+                # Unreadable length field, rely on the frame suffix instead
+                break
+            if received == len(self.frame_buffer):
+                self.frame_buffer.extend(bytes(len(self.frame_buffer)))
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("timed out")
+            self.sock.settimeout(remaining)
+            # Never read past the frame, the next one may already be on the wire
+            if not header_read:
+                end = _HEADER_SIZE
+            elif expected is not None:
+                end = expected
+            else:
+                end = len(self.frame_buffer)
+            count = self.sock.recv_into(memoryview(self.frame_buffer)[received:end])
+            if count == 0:
+                # Connection closed by the ECU, the checksum will tell if the frame is complete
+                break
+            received += count
+        return bytes(self.frame_buffer[:received])
+
+    def frame_length(self, header):
+        """Return the total frame length announced by the header, None if it can't be read"""
+        length = bytes(header[_LENGTH_FIELD])
+        if not length.isdigit():
+            return None
+        # Announced length doesn't count the trailing newline, see check_ecu_checksum
+        return int(length) + 1
+
     def close_socket(self):
         try:
             if self.socket_open:
@@ -87,51 +270,254 @@ class APSystemsSocket:
                 data = self.sock.recv(
                     self.recv_size
                 )  # flush incoming/outgoing data after shutdown request before actually closing the socket
-                self.sock.close()
-                self.socket_open = False
         except Exception as err:
             raise APSystemsInvalidData(err) from err
+        finally:
+            # Always release the socket, a broken one must not be reused
+            if self.socket_open:
+                self.sock.close()
+                self.socket_open = False
 
     def open_socket(self):
         self.socket_open = False
         try:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.settimeout(self.timeout)
-            self.sock.connect((self.ipaddr, self.port))
+            with METRICS.timer("aps_socket_connect_seconds", ecu=self.ipaddr):
+                self.sock.connect((self.ipaddr, self.port))
             self.socket_open = True
         except Exception as err:
             raise APSystemsInvalidData(err) from err
 
+    def use_persistent_connection(self):
+        """Whether the connection should be kept open, unknown firmwares are optimistically tried"""
+        return self.persistent and self.persistent_support.get(self.firmware, True)
+
+    def reconnect(self):
+        """Open a new persistent connection, respecting the backoff delay after a failure"""
+        delay = self.connection_backoff_delay()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            self.open_socket()
+        except APSystemsInvalidData:
+            self.connection_failed()
+            raise
+        self.connection_succeeded()
+
+    def send_command(self, cmd):
+        """Send a command and return the reply, on a new or on the persistent connection"""
+        if not self.use_persistent_connection():
+            # Some ECUs likes the socket to be closed and re-opened between commands
+            self.open_socket()
+            data = self.send_read_from_socket(cmd)
+            self.close_socket()
+            return data
+
+        reused = self.socket_open
+        if not reused:
+            self.reconnect()
+        try:
+            data = self.send_read_from_socket(cmd)
+        except APSystemsInvalidData:
+            if not reused:
+                raise
+            self.persistent_connection_failed()
+            METRICS.inc("aps_retries_total", ecu=self.ipaddr)
+            self.reconnect()
+            data = self.send_read_from_socket(cmd)
+            if not self.use_persistent_connection():
+                self.close_socket()
+            return data
+
+        self.persistent_connection_succeeded(reused)
+        return data
+
+    def persistent_connection_failed(self):
+        """A reused connection failed, flag the firmware if it never supported it"""
+        if not self.persistent_support.get(self.firmware, False):
+            _LOGGER.info("ECU firmware %s doesn't support persistent connection", self.firmware)
+            self.persistent_support[self.firmware] = False
+
+    def persistent_connection_succeeded(self, reused):
+        """A command was sent successfully, flag the firmware if the connection was reused"""
+        if reused and self.firmware is not None:
+            self.persistent_support[self.firmware] = True
+
+    def connection_backoff_delay(self):
+        """Remaining time before the next connection attempt is allowed"""
+        if self.next_connect_time is None:
+            return 0
+        return max(self.next_connect_time - time.monotonic(), 0)
+
+    def connection_failed(self):
+        """Increase the reconnection delay after a failed connection"""
+        if self.next_connect_time is not None:
+            self.reconnect_delay = min(self.reconnect_delay * 2, self.reconnect_max_delay)
+        self.next_connect_time = time.monotonic() + self.reconnect_delay
+
+    def connection_succeeded(self):
+        """Reset the reconnection delay"""
+        self.reconnect_delay = self.reconnect_min_delay
+        self.next_connect_time = None
+
+    def close(self):
+        """Close the persistent connection, if any"""
+        if self.socket_open:
+            self.close_socket()
+
     def query_ecu(self):
-        self.open_socket()
-        cmd = self.ecu_query
-        self.ecu_raw_data = self.send_read_from_socket(cmd)
-        self.close_socket()
+        self.ecu_raw_data = self.record(self.send_command(self.ecu_query))
+        with METRICS.timer("aps_parse_seconds", ecu=self.ipaddr, command="ecu"):
+            self.check_ecu_data()
+
+        cmd = self.inverter_query_prefix + self.ecu_id + self.inverter_query_suffix
+        self.inverter_raw_data = self.record(self.send_command(cmd))
+
+        cmd = self.inverter_signal_prefix + self.ecu_id + self.inverter_signal_suffix
+        self.inverter_raw_signal = self.record(self.send_command(cmd))
+
+        with METRICS.timer("aps_parse_seconds", ecu=self.ipaddr, command="inverter"):
+            return self.collect_data()
+
+    async def async_open_socket(self):
+        self.socket_open = False
+        try:
+            with METRICS.timer("aps_socket_connect_seconds", ecu=self.ipaddr):
+                self.reader, self.writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.ipaddr, self.port), self.timeout
+                )
+            self.socket_open = True
+        except Exception as err:
+            raise APSystemsInvalidData(err) from err
+
+    async def async_close_socket(self):
+        try:
+            if self.socket_open:
+                self.writer.close()
+                await asyncio.wait_for(self.writer.wait_closed(), self.timeout)
+        except Exception as err:
+            raise APSystemsInvalidData(err) from err
+        finally:
+            self.socket_open = False
+
+    async def async_send_read_from_socket(self, cmd):
+        try:
+            await asyncio.sleep(self.command_gap_delay())
+            start = time.perf_counter()
+            self.writer.write(cmd.encode("utf-8"))
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+            sent = time.perf_counter()
+            if not self.wait_ready:
+                await asyncio.sleep(self.socket_sleep_time)
+            self.read_buffer = b""
+            self.read_buffer = await asyncio.wait_for(self.async_read_frame(), self.timeout)
+            self.last_command_time = time.monotonic()
+            self.record_command_metrics(cmd, start, sent)
+            return self.read_buffer
+        except asyncio.TimeoutError as err:
+            METRICS.inc("aps_timeouts_total", ecu=self.ipaddr)
+            await self.async_close_socket()
+            raise APSystemsInvalidData("timed out") from err
+        except Exception as err:
+            await self.async_close_socket()
+            raise APSystemsInvalidData(err) from err
+
+    async def async_read_frame(self):
+        """Read a full APS frame from the stream, using the length announced in its header"""
+        header = b""
+        try:
+            header = await self.reader.readexactly(_HEADER_SIZE)
+            expected = self.frame_length(header)
+            if expected is None:
+                # Unreadable length field, rely on the frame suffix instead
+                return header + await self.reader.readuntil(self.recv_suffix)
+            return header + await self.reader.readexactly(max(expected - _HEADER_SIZE, 0))
+        except asyncio.IncompleteReadError as err:
+            # Connection closed by the ECU, the checksum will tell if the frame is complete
+            return header + err.partial
+
+    async def async_reconnect(self):
+        """Open a new persistent connection, respecting the backoff delay after a failure"""
+        await asyncio.sleep(self.connection_backoff_delay())
+        try:
+            await self.async_open_socket()
+        except APSystemsInvalidData:
+            self.connection_failed()
+            raise
+        self.connection_succeeded()
+
+    async def async_send_command(self, cmd):
+        """Send a command and return the reply, on a new or on the persistent connection"""
+        if not self.use_persistent_connection():
+            # Some ECUs likes the socket to be closed and re-opened between commands
+            await self.async_open_socket()
+            data = await self.async_send_read_from_socket(cmd)
+            await self.async_close_socket()
+            return data
+
+        reused = self.socket_open
+        if not reused:
+            await self.async_reconnect()
+        try:
+            data = await self.async_send_read_from_socket(cmd)
+        except APSystemsInvalidData:
+            if not reused:
+                raise
+            self.persistent_connection_failed()
+            METRICS.inc("aps_retries_total", ecu=self.ipaddr)
+            await self.async_reconnect()
+            data = await self.async_send_read_from_socket(cmd)
+            if not self.use_persistent_connection():
+                await self.async_close_socket()
+            return data
+
+        self.persistent_connection_succeeded(reused)
+        return data
+
+    async def async_close(self):
+        """Close the persistent connection, if any"""
+        if self.socket_open:
+            await self.async_close_socket()
+
+    async def async_query_ecu(self):
+        self.ecu_raw_data = self.record(await self.async_send_command(self.ecu_query))
+        with METRICS.timer("aps_parse_seconds", ecu=self.ipaddr, command="ecu"):
+            self.check_ecu_data()
+
+        cmd = self.inverter_query_prefix + self.ecu_id + self.inverter_query_suffix
+        self.inverter_raw_data = self.record(await self.async_send_command(cmd))
+
+        cmd = self.inverter_signal_prefix + self.ecu_id + self.inverter_signal_suffix
+        self.inverter_raw_signal = self.record(await self.async_send_command(cmd))
+
+        with METRICS.timer("aps_parse_seconds", ecu=self.ipaddr, command="inverter"):
+            if self.decoder is not None:
+                return await self.decoder(self)
+            return self.collect_data()
+
+    def record(self, frame):
+        """Write the reply to the capture file, if recording"""
+        if self.recorder is not None:
+            self.recorder.write(frame)
+        return frame
+
+    def check_ecu_data(self):
+        """Parse the ECU reply, which is needed to query the inverters"""
         try:
             self.process_ecu_data()
             # conflicting interests of which 113 is just a temorary issue and less common
             # https://github.com/ksheumaker/homeassistant-apsystems_ecur/issues/126
             # https://github.com/ksheumaker/homeassistant-apsystems_ecur/issues/113
             if self.lifetime_energy == 0:
-                error = f"ECU returned 0 for lifetime energy, this is either a glitch from the ECU or a brand new installed ECU. Raw Data={self.ecu_raw_data}"
-                self.add_error(error)
+                error = "ECU returned 0 for lifetime energy, this is either a glitch from the ECU or a brand new installed ECU"
+                self.add_error(error, self.ecu_raw_data)
                 raise APSystemsInvalidData(error)
         except Exception as err:
             raise APSystemsInvalidData(err) from err
 
-        # Some ECUs likes the socket to be closed and re-opened between commands
-        self.open_socket()
-        cmd = self.inverter_query_prefix + self.ecu_id + self.inverter_query_suffix
-        self.inverter_raw_data = self.send_read_from_socket(cmd)
-        self.close_socket()
-
-        # Some ECUs likes the socket to be closed and re-opened between commands
-        self.open_socket()
-        cmd = self.inverter_signal_prefix + self.ecu_id + self.inverter_signal_suffix
-        self.inverter_raw_signal = self.send_read_from_socket(cmd)
-
-        self.close_socket()
-
+    def collect_data(self):
+        """Parse the inverter replies and merge them with the ECU data"""
         data = self.process_inverter_data()
         data["ecu_id"] = self.ecu_id
         data["today_energy"] = self.today_energy
@@ -143,54 +529,43 @@ class APSystemsSocket:
 
     def aps_int(self, codec, start):
         try:
-            return int(binascii.b2a_hex(codec[(start) : (start + 2)]), 16)
-        except ValueError as err:
-            debugdata = binascii.b2a_hex(codec)
-            error = f"Unable to convert binary to int location={start} data={debugdata}"
-            self.add_error(error)
+            return _UINT16.unpack_from(codec, start)[0]
+        except struct.error as err:
+            error = f"Unable to convert binary to int location={start}"
+            self.add_error(error, codec)
             raise APSystemsInvalidData(error) from err
 
     def aps_short(self, codec, start):
         try:
-            return int(binascii.b2a_hex(codec[(start) : (start + 1)]), 8)
-        except ValueError as err:
-            debugdata = binascii.b2a_hex(codec)
-            error = f"Unable to convert binary to short int location={start} data={debugdata}"
-            self.add_error(error)
+            return _UINT8.unpack_from(codec, start)[0]
+        except struct.error as err:
+            error = f"Unable to convert binary to short int location={start}"
+            self.add_error(error, codec)
             raise APSystemsInvalidData(error) from err
 
     def aps_double(self, codec, start):
         try:
-            return int(binascii.b2a_hex(codec[(start) : (start + 4)]), 16)
-        except ValueError as err:
-            debugdata = binascii.b2a_hex(codec)
-            error = f"Unable to convert binary to double location={start} data={debugdata}"
-            self.add_error(error)
+            return _UINT32.unpack_from(codec, start)[0]
+        except struct.error as err:
+            error = f"Unable to convert binary to double location={start}"
+            self.add_error(error, codec)
             raise APSystemsInvalidData(error) from err
 
     def aps_bool(self, codec, start):
-        return bool(binascii.b2a_hex(codec[(start) : (start + 2)]))
+        return len(codec[(start) : (start + 2)]) > 0
 
     def aps_uid(self, codec, start):
-        return str(binascii.b2a_hex(codec[(start) : (start + 12)]))[2:14]
+        return memoryview(codec)[start : (start + 6)].hex()
 
     def aps_str(self, codec, start, amount):
-        return str(codec[start : (start + amount)])[2 : (amount + 2)]
+        return bytes(codec[start : (start + amount)]).decode("ascii", "backslashreplace")
 
     def aps_timestamp(self, codec, start, amount):
-        timestr = str(binascii.b2a_hex(codec[start : (start + amount)]))[2 : (amount + 2)]
+        # BCD encoded, amount is the number of digits
+        timestr = memoryview(codec)[start : (start + amount // 2)].hex()
         return (
-            timestr[0:4]
-            + "-"
-            + timestr[4:6]
-            + "-"
-            + timestr[6:8]
-            + " "
-            + timestr[8:10]
-            + ":"
-            + timestr[10:12]
-            + ":"
-            + timestr[12:14]
+            f"{timestr[0:4]}-{timestr[4:6]}-{timestr[6:8]} "
+            f"{timestr[8:10]}:{timestr[10:12]}:{timestr[12:14]}"
         )
 
     def check_ecu_checksum(self, data, cmd):
@@ -198,34 +573,27 @@ class APSystemsSocket:
         try:
             checksum = int(data[5:9])
         except ValueError as err:
-            debugdata = binascii.b2a_hex(data)
-            error = f"could not extract checksum int from '{cmd}' data={debugdata}"
-            self.add_error(error)
+            error = f"could not extract checksum int from '{cmd}'"
+            self.add_error(error, data)
             raise APSystemsInvalidData(error) from err
 
         if datalen != checksum:
-            debugdata = binascii.b2a_hex(data)
-            error = (
-                f"Checksum on '{cmd}' failed checksum={checksum} datalen={datalen} data={debugdata}"
-            )
-            self.add_error(error)
+            METRICS.inc("aps_checksum_failures_total", ecu=self.ipaddr)
+            error = f"Checksum on '{cmd}' failed checksum={checksum} datalen={datalen}"
+            self.add_error(error, data)
             raise APSystemsInvalidData(error)
 
         start_str = self.aps_str(data, 0, 3)
         end_str = self.aps_str(data, len(data) - 4, 3)
 
         if start_str != "APS":
-            debugdata = binascii.b2a_hex(data)
-            error = (
-                f"Result on '{cmd}' incorrect start signature '{start_str}' != APS data={debugdata}"
-            )
-            self.add_error(error)
+            error = f"Result on '{cmd}' incorrect start signature '{start_str}' != APS"
+            self.add_error(error, data)
             raise APSystemsInvalidData(error)
 
         if end_str != "END":
-            debugdata = binascii.b2a_hex(data)
-            error = f"Result on '{cmd}' incorrect end signature '{end_str}' != END data={debugdata}"
-            self.add_error(error)
+            error = f"Result on '{cmd}' incorrect end signature '{end_str}' != END"
+            self.add_error(error, data)
             raise APSystemsInvalidData(error)
 
         return True
@@ -233,7 +601,7 @@ class APSystemsSocket:
     def process_ecu_data(self, data=None):
         if self.ecu_raw_data != "" and (self.aps_str(self.ecu_raw_data, 9, 4)) == "0001":
             data = self.ecu_raw_data
-            _LOGGER.debug(binascii.b2a_hex(data))
+            _LOGGER.debug("ECU data: %s", HexFrame(data))
             self.check_ecu_checksum(data, "ECU Query")
             self.ecu_id = self.aps_str(data, 13, 12)
             self.lifetime_energy = self.aps_double(data, 27) / 10
@@ -259,29 +627,25 @@ class APSystemsSocket:
             and (self.aps_str(self.inverter_raw_signal, 9, 4)) == "0030"
         ):
             data = self.inverter_raw_signal
-            _LOGGER.debug(binascii.b2a_hex(data))
+            _LOGGER.debug("Signal data: %s", HexFrame(data))
             self.check_ecu_checksum(data, "Signal Query")
             if not self.qty_of_inverters:
                 return signal_data
             location = 15
             for i in range(0, self.qty_of_inverters):
-                uid = self.aps_uid(data, location)
-                location += 6
-                strength = data[location]
-                location += 1
-                strength = int((strength / 255) * 100)
-                signal_data[uid] = strength
+                uid, strength = _SIGNAL_RECORD.unpack_from(data, location)
+                location += _SIGNAL_RECORD.size
+                signal_data[uid.hex()] = int((strength / 255) * 100)
             return signal_data
 
     def process_inverter_data(self, data=None):
         output = {}
         if self.inverter_raw_data != "" and (self.aps_str(self.inverter_raw_data, 9, 4)) == "0002":
             data = self.inverter_raw_data
-            _LOGGER.debug(binascii.b2a_hex(data))
+            _LOGGER.debug("Inverter data: %s", HexFrame(data))
             self.check_ecu_checksum(data, "Inverter data")
-            istr = ""
             cnt1 = 0
-            cnt2 = 26
+            cnt2 = self.inverter_byte_start
             if self.aps_str(data, 14, 2) == "00":
                 timestamp = self.aps_timestamp(data, 19, 14)
                 inverter_qty = self.aps_int(data, 17)
@@ -290,81 +654,39 @@ class APSystemsSocket:
                 output["inverters"] = []
                 signal = self.process_signal_data()
                 inverters = []
+                has_records = self.aps_str(data, 15, 2) == "01"
 
                 while cnt1 < inverter_qty:
-                    inv = {}
-                    if self.aps_str(data, 15, 2) == "01":
-                        inverter_uid = self.aps_uid(data, cnt2)
-                        inv["uid"] = inverter_uid
-                        inv["online"] = bool(self.aps_short(data, cnt2 + 6))
+                    if has_records:
                         istr = self.aps_str(data, cnt2 + 7, 2)
-                        inv["signal"] = signal.get(inverter_uid, 0)
-                        if istr in ["01", "04", "05"]:
-                            power = []
-                            voltages = []
-                            inv["frequency"] = self.aps_int(data, cnt2 + 9) / 10
-                            if inv["online"]:
-                                inv["temperature"] = self.aps_int(data, cnt2 + 11) - 100
-                            power.append(self.aps_int(data, cnt2 + 13))
-                            voltages.append(self.aps_int(data, cnt2 + 15))
-                            power.append(self.aps_int(data, cnt2 + 17))
-                            voltages.append(self.aps_int(data, cnt2 + 19))
-                            inv_desc = {
-                                "model": "YC600/DS3D/DS3-H/DS3/DS3-L",
-                                "channel_qty": 2,
-                                "power": power,
-                                "voltage": voltages,
-                            }
-                            inv.update(inv_desc)
-                            cnt2 = cnt2 + 21
-                        elif istr == "02":
-                            power = []
-                            voltages = []
-                            inv["frequency"] = self.aps_int(data, cnt2 + 9) / 10
-                            if inv["online"]:
-                                inv["temperature"] = self.aps_int(data, cnt2 + 11) - 100
-                            power.append(self.aps_int(data, cnt2 + 13))
-                            voltages.append(self.aps_int(data, cnt2 + 15))
-                            power.append(self.aps_int(data, cnt2 + 17))
-                            voltages.append(self.aps_int(data, cnt2 + 19))
-                            power.append(self.aps_int(data, cnt2 + 21))
-                            voltages.append(self.aps_int(data, cnt2 + 23))
-                            power.append(self.aps_int(data, cnt2 + 25))
-                            inv_desc = {
-                                "model": "YC1000/QT2",
-                                "channel_qty": 4,
-                                "power": power,
-                                "voltage": voltages,
-                            }
-                            inv.update(inv_desc)
-                            cnt2 = cnt2 + 27
-                        elif istr == "03":
-                            power = []
-                            voltages = []
-                            inv["frequency"] = self.aps_int(data, cnt2 + 9) / 10
-                            if inv["online"]:
-                                inv["temperature"] = self.aps_int(data, cnt2 + 11) - 100
-                            power.append(self.aps_int(data, cnt2 + 13))
-                            voltages.append(self.aps_int(data, cnt2 + 15))
-                            power.append(self.aps_int(data, cnt2 + 17))
-                            power.append(self.aps_int(data, cnt2 + 19))
-                            power.append(self.aps_int(data, cnt2 + 21))
-                            inv_desc = {
-                                "model": "QS1",
-                                "channel_qty": 4,
-                                "power": power,
-                                "voltage": voltages,
-                            }
-                            inv.update(inv_desc)
-                            cnt2 = cnt2 + 23
-                        else:
-                            cnt2 = cnt2 + 9
-                        inverters.append(inv)
+                        layout = get_inverter_layout(istr)
+                        if layout is None:
+                            # Record size is unknown, the following records can't be located,
+                            # the ECU data and the inverters decoded so far are still valid
+                            error = f"Unsupported inverter type '{istr}' uid={self.aps_uid(data, cnt2)} location={cnt2}"
+                            self.add_error(error, data)
+                            _LOGGER.warning("%s, the following inverters are ignored", error)
+                            break
+                        try:
+                            inverters.append(layout.unpack(data, cnt2, signal))
+                        except struct.error as err:
+                            error = f"Inverter data truncated at location={cnt2}"
+                            self.add_error(error, data)
+                            raise APSystemsInvalidData(error) from err
+                        cnt2 = cnt2 + layout.stride
                     cnt1 = cnt1 + 1
                 self.inverters = inverters
                 output["inverters"] = inverters
+                if self.snapshot and has_records:
+                    output["snapshot"] = decode_inverter_snapshot(
+                        data, self.inverter_byte_start, len(inverters), signal
+                    )
                 return output
 
-    def add_error(self, error):
-        timestamp = datetime.datetime.now()
-        self.errors.append(f"[{timestamp}] {error}")
+    def add_error(self, error, data=None):
+        """Record an error, with the frame it was found in"""
+        record = APSystemsError(error, data)
+        self.errors.append(record)
+        _LOGGER.debug("ECU error: %s", record)
+        METRICS.inc("aps_errors_total", ecu=self.ipaddr)
+        return record
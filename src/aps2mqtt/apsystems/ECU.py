@@ -1,140 +1,305 @@
 """Handle ECU requests"""
 
+import asyncio
+import http.client
 import logging
+import time
 from datetime import datetime, timedelta, timezone
-import requests
-from suntime import Sun
+from urllib.parse import urlencode
 from aps2mqtt.apsystems.APSystemsSocket import APSystemsSocket, APSystemsInvalidData
+from aps2mqtt.apsystems.snapshot import numpy_available
+from aps2mqtt.energy import EnergyIntegrator
+from aps2mqtt.health import ECUHealth
+from aps2mqtt.metrics import METRICS
 
 _LOGGER = logging.getLogger(__name__)
 
+# The ECU keeps accepting connections for a while after the restart request
+_RESTART_GRACE = 30
+# Delay between two checks of the port of a restarting ECU
+_RESTART_CHECK_INTERVAL = 10
+_PORT_CHECK_TIMEOUT = 5
+
 
 class ECU:
     def __init__(self, ecu_config):
-        self.socket = APSystemsSocket(ecu_config.ipaddr)
+        self.socket = APSystemsSocket(
+            ecu_config.ipaddr,
+            ecu_config.port,
+            timeout=ecu_config.command_timeout,
+            wait_ready=ecu_config.wait_ready,
+            command_gap=ecu_config.command_gap,
+            persistent=ecu_config.persistent_connection,
+            snapshot=ecu_config.columnar_snapshot,
+        )
+        if ecu_config.columnar_snapshot and not numpy_available():
+            raise ValueError("numpy is required by APS_ECU_COLUMNAR_SNAPSHOT")
         self.cached_data = {}
         self.ipaddr = ecu_config.ipaddr
         self.port = ecu_config.port
-        self.retry = 5
-        self.retry_count = 0
-        self.querying = True
-        self.ecu_restarting = False
-        if ecu_config.auto_restart:
+        # Id of the last valid data, kept while the ECU fails
+        self.ecu_id = None
+        self.health = ECUHealth(
+            ecu_config.failure_threshold, max_delay=ecu_config.max_retry_delay * 60
+        )
+        self.auto_restart = ecu_config.auto_restart
+        if self.auto_restart:
             self.wifi_config = ecu_config.wifi_config
+            self.health.restart_timeout = ecu_config.restart_timeout
+        # Background restart, referenced until it is over
+        self.restart_task = None
         self.stop_at_night = ecu_config.stop_at_night
         if self.stop_at_night:
+            # Only needed at night, not imported by every start
+            from suntime import Sun  # pylint: disable=import-outside-toplevel
+
             self.ecu_location = Sun(
                 ecu_config.ecu_position_latitude, ecu_config.ecu_position_longitude
             )
+            # day -> (sunrise, sunset)
+            self._sun_times = {}
         self.timezone = ecu_config.timezone
-
-    def should_sleep(self):
-        return (
-            self.stop_at_night
-            and (
-                len(self.cached_data) > 0
-                and self.cached_data.get("qty_of_online_inverters", 0) == 0
-            )
-            and (
-                datetime.now(timezone.utc) < self.ecu_location.get_sunrise_time()
-                or datetime.now(timezone.utc) > self.ecu_location.get_sunset_time()
+        self.energy = (
+            EnergyIntegrator(
+                self.timezone, ecu_config.energy_state_file, ecu_config.power_window * 60
             )
+            if ecu_config.energy_integration
+            else None
         )
 
+    def should_sleep(self):
+        if not self.stop_at_night or len(self.cached_data) == 0:
+            return False
+        if self.cached_data.get("qty_of_online_inverters", 0) != 0:
+            return False
+        now = datetime.now(timezone.utc)
+        sunrise, sunset = self.sun_times(now.date())
+        return now < sunrise or now > sunset
+
     def wake_up_time(self):
-        if self.ecu_location.get_sunrise_time() < datetime.now(timezone.utc):
-            return self.ecu_location.get_sunrise_time(datetime.today() + timedelta(days=1))
-        return self.ecu_location.get_sunrise_time()
+        now = datetime.now(timezone.utc)
+        sunrise, _ = self.sun_times(now.date())
+        if sunrise < now:
+            sunrise, _ = self.sun_times(now.date() + timedelta(days=1))
+        return sunrise
 
-    def invalid_data(self):
-        # we got invalid data, increment retry counter
-        self.retry_count += 1
+    def sun_times(self, day):
+        """Sunrise and sunset (UTC) of the given day, computed once per day"""
+        if day not in self._sun_times:
+            # Only today and tomorrow are needed
+            self._sun_times = {
+                cached_day: times
+                for cached_day, times in self._sun_times.items()
+                if cached_day >= day - timedelta(days=1)
+            }
+            self._sun_times[day] = (
+                self.ecu_location.get_sunrise_time(day),
+                self.ecu_location.get_sunset_time(day),
+            )
+        return self._sun_times[day]
 
-        if self.retry_count == self.retry:
+    def invalid_data(self):
+        now = datetime.now(timezone.utc)
+        if self.health.failure(now):
             _LOGGER.warning(
-                "Communication with the ECU failed after %s repeated attempts.", self.retry
+                "Communication with the ECU %s failed after %s repeated attempts.",
+                self.ipaddr,
+                self.health.failures,
             )
-            # Determine ECU type to decide ECU restart (for ECU-C and ECU-R with sunspec only)
-            if (self.cached_data["ecu_id"][0:3] == "215") or (
-                self.cached_data["ecu_id"][0:4] == "2162"
-            ):
-                data = {
-                    "SSID": self.wifi_config.ssid,
-                    "channel": 0,
-                    "method": 2,
-                    "psk_wep": "",
-                    "psk_wpa": self.wifi_config.passwd,
-                }
-                _LOGGER.debug("Data sent with URL: %s", data["SSID"])
-                url = "http://" + str(self.ipaddr) + "/index.php/management/set_wlan_ap"
-                headers = {"X-Requested-With": "XMLHttpRequest"}
-                try:
-                    get_url = requests.post(url, headers=headers, data=data, timeout=30)
-                    _LOGGER.debug(
-                        "Attempt to restart ECU gave as response: %s.", str(get_url.status_code)
-                    )
-                    self.ecu_restarting = True
-                except IOError as err:
-                    _LOGGER.warning(
-                        "Attempt to restart ECU failed with error: %s. Querying is stopped automatically.",
-                        err,
-                    )
-                    self.querying = False
+            if self.can_restart():
+                self.restart(now)
             else:
-                # Older ECU-R models starting with 2160
                 _LOGGER.warning(
-                    "Try manually power cycling the ECU. Querying is stopped automatically, turn switch back on after restart of ECU."
+                    "Try manually power cycling the ECU %s, next attempt at %s.",
+                    self.ipaddr,
+                    self.health.next_attempt.astimezone().strftime("%Y-%m-%d %H:%M:%S %Z"),
                 )
-                self.querying = False
+        elif self.health.is_open():
+            _LOGGER.info(
+                "ECU %s still unreachable, next attempt at %s.",
+                self.ipaddr,
+                self.health.next_attempt.astimezone().strftime("%Y-%m-%d %H:%M:%S %Z"),
+            )
 
         if self.cached_data.get("ecu_id", None) is None:
             raise ValueError(
                 "Unable to get correct data from ECU. See log for details, and try power cycling the ECU."
             )
 
+    def can_restart(self):
+        """Whether the ECU can be restarted, only ECU-C and ECU-R with sunspec can"""
+        return (
+            self.auto_restart
+            and self.ecu_id is not None
+            and (self.ecu_id[0:3] == "215" or self.ecu_id[0:4] == "2162")
+        )
+
+    def restart(self, now):
+        """Restart the ECU in the background, it isn't queried until it is back
+
+        Without event loop, for the synchronous updates, wait for the end of the restart.
+        """
+        self.health.restarting(now)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            asyncio.run(self.async_restart())
+            return
+        self.restart_task = loop.create_task(self.async_restart())
+
+    async def async_restart(self):
+        """Restart the ECU by setting its Wifi access point, wait until it accepts connections
+
+        Return whether the ECU came back within the restart timeout of its health.
+        """
+        start = time.monotonic()
+        data = {
+            "SSID": self.wifi_config.ssid,
+            "channel": 0,
+            "method": 2,
+            "psk_wep": "",
+            "psk_wpa": self.wifi_config.passwd,
+        }
+        _LOGGER.debug("Data sent with URL: %s", data["SSID"])
+        loop = asyncio.get_running_loop()
+        try:
+            status = await loop.run_in_executor(
+                None, post_form, self.ipaddr, "/index.php/management/set_wlan_ap", data
+            )
+            _LOGGER.debug("Attempt to restart ECU gave as response: %s.", status)
+        except (OSError, http.client.HTTPException) as err:
+            _LOGGER.warning("Attempt to restart ECU failed with error: %s.", err)
+            METRICS.inc("aps_ecu_restarts_total", ecu=self.ipaddr, result="failed")
+            self.health.restart_failed(datetime.now(timezone.utc))
+            return False
+
+        # The connection kept open doesn't survive the restart
+        try:
+            await self.socket.async_close()
+        except APSystemsInvalidData:
+            pass
+        await asyncio.sleep(_RESTART_GRACE)
+        deadline = start + self.health.restart_timeout
+        while True:
+            if await self.port_open():
+                elapsed = time.monotonic() - start
+                _LOGGER.info("ECU %s restarted in %ss.", self.ipaddr, round(elapsed))
+                METRICS.inc("aps_ecu_restarts_total", ecu=self.ipaddr, result="recovered")
+                METRICS.set("aps_ecu_restart_recovery_seconds", elapsed, ecu=self.ipaddr)
+                self.health.restarted(datetime.now(timezone.utc))
+                return True
+            if time.monotonic() + _RESTART_CHECK_INTERVAL > deadline:
+                break
+            await asyncio.sleep(_RESTART_CHECK_INTERVAL)
+
+        _LOGGER.warning(
+            "ECU %s still unreachable %ss after its restart.",
+            self.ipaddr,
+            round(self.health.restart_timeout),
+        )
+        METRICS.inc("aps_ecu_restarts_total", ecu=self.ipaddr, result="timeout")
+        self.health.restart_failed(datetime.now(timezone.utc))
+        return False
+
+    async def port_open(self):
+        """Whether the ECU accepts connections on its port"""
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.ipaddr, self.port), _PORT_CHECK_TIMEOUT
+            )
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return True
+
     def update(self):
         _LOGGER.debug("Start ECU update")
-        data = {}
-
-        # if we aren't actively quering data.
-        # this is so we can stop querying after sunset
-        if not self.querying:
-            _LOGGER.debug("Not querying ECU due to query=False")
-            return data
 
         _LOGGER.debug("Querying ECU...")
+        start = time.perf_counter()
         try:
             data = self.socket.query_ecu()
+        except Exception as err:
+            data = self.query_failed(err)
+
+        return self.record_update(self.handle_data(data), start)
+
+    async def async_update(self):
+        _LOGGER.debug("Start ECU update")
+
+        _LOGGER.debug("Querying ECU...")
+        start = time.perf_counter()
+        try:
+            data = await self.socket.async_query_ecu()
+        except Exception as err:
+            data = self.query_failed(err)
+
+        return self.record_update(self.handle_data(data), start)
+
+    def record_update(self, data, start):
+        """Record the duration of an update started at start and its data in the metrics"""
+        if METRICS.enabled:
+            METRICS.observe("aps_update_seconds", time.perf_counter() - start, ecu=self.ipaddr)
+            METRICS.record_ecu_data(data)
+        return data
+
+    def query_failed(self, err):
+        METRICS.inc("aps_update_failures_total", ecu=self.ipaddr)
+        if isinstance(err, APSystemsInvalidData):
+            msg = f"Invalid data error: {err}"
+            if str(err) != "timed out":
+                _LOGGER.warning(msg)
+        else:
+            msg = f"Exception error: {err}"
+            _LOGGER.warning(msg)
+        return {}
+
+    def handle_data(self, data):
+        if data:
             _LOGGER.debug("Got data from ECU")
 
             # we got good results, so we store it and set flags about our
             # cache state
-            if data["ecu_id"] is not None:
+            if data.get("ecu_id", None) is not None:
                 self.cached_data = data
-                self.ecu_restarting = False
+                self.ecu_id = data["ecu_id"]
+                self.health.success()
+                if self.energy is not None and "inverters" in data:
+                    self.energy.update(data)
             else:
                 msg = "Error: no ecu_id returned"
                 _LOGGER.warning(msg)
                 data = {}
 
-        except APSystemsInvalidData as err:
-            msg = f"Invalid data error: {err}"
-            if str(err) != "timed out":
-                _LOGGER.warning(msg)
-            data = {}
-
-        except Exception as err:
-            msg = f"Exception error: {err}"
-            _LOGGER.warning(msg)
-            data = {}
-
         if data.get("ecu_id", None) is None:
             self.cached_data = {}
             self.invalid_data()
             raise ValueError("Somehow data doesn't contain a valid ecu_id")
 
-        data["querying"] = self.querying
-        data["restart_ecu"] = self.ecu_restarting
         _LOGGER.debug("Returning %s", data)
 
         return data
+
+
+def post_form(host, path, fields, timeout=30):
+    """POST form fields to the ECU web interface, return the HTTP status"""
+    connection = http.client.HTTPConnection(host, timeout=timeout)
+    try:
+        connection.request(
+            "POST",
+            path,
+            body=urlencode(fields),
+            headers={
+                "Content-Type": "application/x-www-form-urlencoded",
+                "X-Requested-With": "XMLHttpRequest",
+            },
+        )
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
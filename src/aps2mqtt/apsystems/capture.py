@@ -0,0 +1,114 @@
+"""Record the raw ECU replies to a capture file, and replay them instead of querying the ECU
+
+A capture file starts with a magic line followed by one record per reply: the reception
+time (float seconds since the epoch) and the frame length, big endian, then the frame.
+"""
+
+import logging
+import os
+import struct
+import time
+
+from aps2mqtt.apsystems.APSystemsSocket import APSystemsSocket, APSystemsInvalidData
+
+_LOGGER = logging.getLogger(__name__)
+
+_MAGIC = b"APSCAP1\n"
+_RECORD_HEADER = struct.Struct(">dI")
+# Command code of a command or of its reply
+_COMMAND_CODE = slice(9, 13)
+
+
+class CaptureEnd(Exception):
+    """All the frames of the capture have been replayed"""
+
+
+def capture_path(directory, ipaddr, port):
+    """Capture file of an ECU in the directory"""
+    return os.path.join(directory, f"{ipaddr}_{port}.apscap")
+
+
+class CaptureWriter:
+    """Append the frames to a capture file, created if needed"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "ab")  # pylint: disable=consider-using-with
+        if self.file.tell() == 0:
+            self.file.write(_MAGIC)
+
+    def write(self, frame, timestamp=None):
+        """Append a frame, received at timestamp (now by default)"""
+        if timestamp is None:
+            timestamp = time.time()
+        self.file.write(_RECORD_HEADER.pack(timestamp, len(frame)))
+        self.file.write(frame)
+        # A crash must not lose the frames of the previous updates
+        self.file.flush()
+
+    def close(self):
+        """Close the capture file"""
+        self.file.close()
+
+
+def read_capture(path):
+    """Yield the (timestamp, frame) records of a capture file, stop at a truncated record"""
+    with open(path, "rb") as capture:
+        if capture.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError(f"{path} is not an APS capture file")
+        while True:
+            header = capture.read(_RECORD_HEADER.size)
+            if len(header) < _RECORD_HEADER.size:
+                break
+            timestamp, length = _RECORD_HEADER.unpack(header)
+            frame = capture.read(length)
+            if len(frame) < length:
+                _LOGGER.warning("Truncated record at the end of %s", path)
+                break
+            yield timestamp, frame
+
+
+class ReplaySocket(APSystemsSocket):
+    """ECU socket replying to each command with the next frame of a capture file
+
+    Frames are replayed in the recorded order, without any delay, so an update whose ECU
+    reply was invalid is replayed without its inverter replies, as it happened. Only the
+    replies of the commands which succeeded are recorded: a command whose reply is missing
+    fails again, and the next update resumes from its ECU reply.
+    """
+
+    def __init__(self, path, ipaddr="replay", **kwargs):
+        super().__init__(ipaddr, **kwargs)
+        self.path = path
+        self._records = read_capture(path)
+        self._next = next(self._records, None)
+        self.replayed = 0
+
+    def exhausted(self):
+        """Whether all the frames have been replayed"""
+        return self._next is None
+
+    def send_command(self, cmd):
+        code = cmd[_COMMAND_CODE].encode()
+        ecu_code = self.ecu_query[_COMMAND_CODE].encode()
+        while self._next is not None:
+            _, frame = self._next
+            frame_code = frame[_COMMAND_CODE]
+            if frame_code == ecu_code and code != ecu_code:
+                # Kept for the next update
+                raise APSystemsInvalidData(f"No reply recorded for command {cmd[:13]}")
+            self._next = next(self._records, None)
+            if frame_code == code:
+                self.replayed += 1
+                return frame
+            _LOGGER.debug("Reply %s skipped, %s expected", frame_code, code)
+        raise CaptureEnd(self.path)
+
+    async def async_send_command(self, cmd):
+        return self.send_command(cmd)
+
+    def close(self):
+        self._records.close()
+
+    async def async_close(self):
+        self.close()
@@ -0,0 +1,96 @@
+"""Build APS protocol frames, as sent by the ECU, used by tests and benchmarks"""
+
+import struct
+
+_UINT16 = struct.Struct(">H")
+_UINT32 = struct.Struct(">I")
+_INVERTER_HEADER = struct.Struct(">6sB2sHH")
+_SIGNAL_RECORD = struct.Struct(">6sB")
+
+# Number of (power, voltage) values per inverter type, in frame order
+INVERTER_CHANNELS = {
+    "01": (2, 2),
+    "02": (4, 3),
+    "03": (4, 1),
+    "04": (2, 2),
+    "05": (2, 2),
+}
+
+
+def frame(command, body):
+    """Wrap the body in an APS frame with a valid length field"""
+    length = 9 + 4 + len(body) + 4
+    if length > 10000:
+        raise ValueError(f"Frame too long for the 4 digits length field: {length}")
+    return b"APS11" + b"%04d" % (length - 1) + command.encode() + body + b"END\n"
+
+
+def ecu_frame(
+    ecu_id="216000000001",
+    lifetime_energy=1234.5,
+    current_power=420,
+    today_energy=3.21,
+    qty_of_inverters=1,
+    qty_of_online_inverters=1,
+    firmware="ECU_R_1.2.22",
+    timezone="Europe/Paris",
+):
+    """Build the reply to the ECU info query"""
+    body = (
+        ecu_id.encode()
+        + b"01"
+        + _UINT32.pack(round(lifetime_energy * 10))
+        + _UINT32.pack(current_power)
+        + _UINT32.pack(round(today_energy * 100))
+        + bytes(7)
+        + _UINT16.pack(qty_of_inverters)
+        + _UINT16.pack(qty_of_online_inverters)
+        + b"10"
+        + b"%03d" % len(firmware)
+        + firmware.encode()
+        + b"%03d" % len(timezone)
+        + timezone.encode()
+    )
+    return frame("0001", body)
+
+
+def inverter_record(
+    uid, inverter_type="01", online=True, frequency=50.0, temperature=30, power=None, voltage=None
+):
+    """Build the record of an inverter, power and voltage default to a plausible value per channel"""
+    power_qty, voltage_qty = INVERTER_CHANNELS[inverter_type]
+    power = power if power is not None else [100 + i for i in range(power_qty)]
+    voltage = voltage if voltage is not None else [230 + i for i in range(voltage_qty)]
+    # Values are interleaved: power 1, voltage 1, power 2, voltage 2...
+    values = []
+    for i in range(power_qty):
+        values.append(power[i])
+        if i < voltage_qty:
+            values.append(voltage[i])
+    return _INVERTER_HEADER.pack(
+        bytes.fromhex(uid),
+        1 if online else 0,
+        inverter_type.encode(),
+        round(frequency * 10),
+        temperature + 100,
+    ) + b"".join(_UINT16.pack(value) for value in values)
+
+
+def inverter_frame(records, timestamp="2025-07-20 12:00:00"):
+    """Build the reply to the inverter data query from inverter records"""
+    bcd_timestamp = bytes.fromhex(timestamp.replace("-", "").replace(" ", "").replace(":", ""))
+    body = b"0001" + _UINT16.pack(len(records)) + bcd_timestamp + b"".join(records)
+    return frame("0002", body)
+
+
+def signal_frame(signals):
+    """Build the reply to the signal query from (uid, strength) pairs, strength from 0 to 255"""
+    body = b"00" + b"".join(
+        _SIGNAL_RECORD.pack(bytes.fromhex(uid), strength) for uid, strength in signals
+    )
+    return frame("0030", body)
+
+
+def inverter_uid(index):
+    """Build a valid inverter uid from an index"""
+    return f"8060{index:08d}"
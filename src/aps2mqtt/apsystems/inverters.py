@@ -0,0 +1,117 @@
+"""Layouts of the inverter records found in the inverter data frame"""
+
+import struct
+
+# Every record starts with the inverter uid, its online flag and its type code
+_HEADER_FIELDS = (("uid", 0, "6s"), ("online", 6, "B"), ("type", 7, "2s"))
+_FREQUENCY_OFFSET = 9
+_TEMPERATURE_OFFSET = 11
+
+
+class InverterLayout:
+    """Layout of an inverter record, compiled once into a struct covering the whole record
+
+    Offsets are in bytes from the start of the record, every value is a big endian uint16.
+    """
+
+    def __init__(self, type_codes, model, channel_qty, power_offsets, voltage_offsets, stride):
+        self.type_codes = tuple(type_codes)
+        self.model = model
+        self.channel_qty = channel_qty
+        self.stride = stride
+        self.frequency_offset = _FREQUENCY_OFFSET
+        self.temperature_offset = _TEMPERATURE_OFFSET
+        self.power_offsets = tuple(power_offsets)
+        self.voltage_offsets = tuple(voltage_offsets)
+
+        fields = list(_HEADER_FIELDS)
+        fields.append(("frequency", _FREQUENCY_OFFSET, "H"))
+        fields.append(("temperature", _TEMPERATURE_OFFSET, "H"))
+        fields.extend((f"power_{i}", offset, "H") for i, offset in enumerate(power_offsets))
+        fields.extend((f"voltage_{i}", offset, "H") for i, offset in enumerate(voltage_offsets))
+        fields.sort(key=lambda field: field[1])
+
+        fmt = ">"
+        position = 0
+        for name, offset, code in fields:
+            if offset < position:
+                raise ValueError(f"Field {name} of {model} overlaps the previous one")
+            fmt += "x" * (offset - position) + code
+            position = offset + struct.calcsize(">" + code)
+        if position > stride:
+            raise ValueError(f"Fields of {model} exceed the record stride {stride}")
+        fmt += "x" * (stride - position)
+        self.struct = struct.Struct(fmt)
+
+        names = [field[0] for field in fields]
+        self.frequency_index = names.index("frequency")
+        self.temperature_index = names.index("temperature")
+        self.online_index = names.index("online")
+        self.power_indexes = tuple(names.index(f"power_{i}") for i in range(len(power_offsets)))
+        self.voltage_indexes = tuple(
+            names.index(f"voltage_{i}") for i in range(len(voltage_offsets))
+        )
+
+    def unpack(self, data, start, signal):
+        """Decode the record starting at the given position, signal is the uid -> strength dict"""
+        values = self.struct.unpack_from(data, start)
+        uid = values[0].hex()
+        inv = {
+            "uid": uid,
+            "online": bool(values[self.online_index]),
+            "signal": signal.get(uid, 0),
+            "frequency": values[self.frequency_index] / 10,
+        }
+        if inv["online"]:
+            inv["temperature"] = values[self.temperature_index] - 100
+        inv["model"] = self.model
+        inv["channel_qty"] = self.channel_qty
+        inv["power"] = [values[i] for i in self.power_indexes]
+        inv["voltage"] = [values[i] for i in self.voltage_indexes]
+        return inv
+
+
+_LAYOUTS = {}
+
+
+def register_inverter_layout(layout):
+    """Register a layout for all its type codes, replacing any previous one"""
+    for type_code in layout.type_codes:
+        _LAYOUTS[type_code] = layout
+
+
+def get_inverter_layout(type_code):
+    """Return the layout of the given type code, None if unknown"""
+    return _LAYOUTS.get(type_code)
+
+
+register_inverter_layout(
+    InverterLayout(
+        ("01", "04", "05"),
+        "YC600/DS3D/DS3-H/DS3/DS3-L",
+        channel_qty=2,
+        power_offsets=(13, 17),
+        voltage_offsets=(15, 19),
+        stride=21,
+    )
+)
+register_inverter_layout(
+    InverterLayout(
+        ("02",),
+        "YC1000/QT2",
+        channel_qty=4,
+        power_offsets=(13, 17, 21, 25),
+        voltage_offsets=(15, 19, 23),
+        stride=27,
+    )
+)
+register_inverter_layout(
+    InverterLayout(
+        ("03",),
+        "QS1",
+        channel_qty=4,
+        power_offsets=(13, 17, 19, 21),
+        voltage_offsets=(15,),
+        stride=23,
+    )
+)
@@ -0,0 +1,240 @@
+"""Stand-in ECU speaking the APS protocol over TCP, used by tests and benchmarks
+
+The simulator replies to the ECU, inverter data and signal queries with valid frames for
+a configurable set of inverters, with optional latency, fragmented replies and faults.
+
+Run from the repository root: python -m aps2mqtt.apsystems.simulator [--inverters N] ...
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import threading
+from datetime import datetime
+
+from aps2mqtt.apsystems import frames
+
+_LOGGER = logging.getLogger(__name__)
+
+INVERTER_TYPES = ("01", "02", "03", "04", "05")
+
+# Faults injected instead of a valid reply
+FAULTS = (
+    "close",  # close the connection without replying
+    "hang",  # never reply, the client times out
+    "truncate",  # send the first half of the frame and close the connection
+    "checksum",  # send a frame whose length field doesn't match its length
+    "garbage",  # send random bytes
+)
+
+
+class ECUSimulator:
+    """ECU replying with generated frames, inverter types are assigned in turn"""
+
+    def __init__(
+        self,
+        inverter_qty=10,
+        inverter_types=INVERTER_TYPES,
+        ecu_id="216000000001",
+        latency=0,
+        chunk_size=None,
+        chunk_delay=0,
+        fault_rate=0,
+        faults=FAULTS,
+        seed=None,
+    ):
+        unknown = set(faults) - set(FAULTS)
+        if unknown:
+            raise ValueError(f"Unknown faults {sorted(unknown)}, must be in {FAULTS}")
+        self.ecu_id = ecu_id
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.fault_rate = fault_rate
+        self.faults = tuple(faults)
+        self.random = random.Random(seed)
+        self.inverters = [
+            (frames.inverter_uid(index + 1), inverter_types[index % len(inverter_types)])
+            for index in range(inverter_qty)
+        ]
+        self.lifetime_energy = 1000.0
+        self.commands = 0
+        self.injected_faults = 0
+        self.server = None
+        self.port = None
+        # writer -> task of the connected clients
+        self._clients = {}
+        self._loop = None
+        self._thread = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Start listening, return the listening port"""
+        self.server = await asyncio.start_server(self._handle_client, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        _LOGGER.info("ECU simulator listening on %s:%s", host, self.port)
+        return self.port
+
+    async def stop(self):
+        """Stop listening"""
+        self.server.close()
+        for writer in self._clients:
+            writer.close()
+        await asyncio.gather(*self._clients.values(), return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    def start_thread(self, host="127.0.0.1", port=0):
+        """Run the simulator in its own event loop thread, for blocking clients"""
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self.start(host, port))
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="ecu-simulator", daemon=True)
+        self._thread.start()
+        started.wait()
+        return self.port
+
+    def stop_thread(self):
+        """Stop the simulator started with start_thread"""
+        asyncio.run_coroutine_threadsafe(self.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _handle_client(self, reader, writer):
+        self._clients[writer] = asyncio.current_task()
+        try:
+            while True:
+                try:
+                    command = await reader.readuntil(b"END\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                self.commands += 1
+                reply = self.reply(command)
+                if reply is None:
+                    break
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                if not await self._send(reader, writer, reply):
+                    break
+        finally:
+            self._clients.pop(writer, None)
+            writer.close()
+
+    def reply(self, command):
+        """Build the reply to a command, None for unknown commands"""
+        code = command[9:13]
+        if code == b"0001":
+            return self.ecu_frame()
+        if code == b"0002":
+            return self.inverter_frame()
+        if code == b"0030":
+            return self.signal_frame()
+        _LOGGER.warning("Unknown command %s", command)
+        return None
+
+    async def _send(self, reader, writer, reply):
+        """Send the reply or a fault, return False if the connection must be closed"""
+        if self.fault_rate and self.random.random() < self.fault_rate:
+            self.injected_faults += 1
+            fault = self.random.choice(self.faults)
+            if fault == "close":
+                return False
+            if fault == "hang":
+                # Wait for the client to give up
+                await reader.read()
+                return False
+            if fault == "truncate":
+                writer.write(reply[: len(reply) // 2])
+                await writer.drain()
+                return False
+            if fault == "checksum":
+                reply = reply[:5] + b"%04d" % (len(reply) + 10) + reply[9:]
+            elif fault == "garbage":
+                reply = self.random.randbytes(len(reply))
+
+        if self.chunk_size is None:
+            writer.write(reply)
+            await writer.drain()
+        else:
+            for position in range(0, len(reply), self.chunk_size):
+                writer.write(reply[position : position + self.chunk_size])
+                await writer.drain()
+                if self.chunk_delay:
+                    await asyncio.sleep(self.chunk_delay)
+        return True
+
+    def ecu_frame(self):
+        """ECU info frame, the lifetime energy increases at each query"""
+        self.lifetime_energy += 0.1
+        return frames.ecu_frame(
+            ecu_id=self.ecu_id,
+            lifetime_energy=self.lifetime_energy,
+            current_power=self.random.randint(0, 300) * len(self.inverters),
+            qty_of_inverters=len(self.inverters),
+            qty_of_online_inverters=len(self.inverters),
+        )
+
+    def inverter_frame(self):
+        """Inverter data frame, with random power and voltage values"""
+        records = []
+        for uid, inverter_type in self.inverters:
+            power_qty, voltage_qty = frames.INVERTER_CHANNELS[inverter_type]
+            records.append(
+                frames.inverter_record(
+                    uid,
+                    inverter_type,
+                    frequency=self.random.choice((49.9, 50.0, 50.1)),
+                    temperature=self.random.randint(20, 60),
+                    power=[self.random.randint(0, 300) for _ in range(power_qty)],
+                    voltage=[self.random.randint(225, 245) for _ in range(voltage_qty)],
+                )
+            )
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return frames.inverter_frame(records, timestamp)
+
+    def signal_frame(self):
+        """Signal frame, with random signal strengths"""
+        return frames.signal_frame(
+            [(uid, self.random.randint(0, 255)) for uid, _ in self.inverters]
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in APS ECU")
+    parser.add_argument("--port", type=int, default=8899)
+    parser.add_argument("--inverters", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0, help="reply delay in seconds")
+    parser.add_argument("--chunk-size", type=int, default=None, help="send replies in chunks")
+    parser.add_argument("--fault-rate", type=float, default=0, help="ratio of faulty replies")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    async def serve():
+        simulator = ECUSimulator(
+            args.inverters,
+            latency=args.latency,
+            chunk_size=args.chunk_size,
+            fault_rate=args.fault_rate,
+        )
+        await simulator.start("0.0.0.0", args.port)
+        async with simulator.server:
+            await simulator.server.serve_forever()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
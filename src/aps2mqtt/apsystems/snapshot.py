@@ -0,0 +1,139 @@
+"""Columnar snapshot of the inverters of an ECU poll, decoded in bulk with numpy"""
+
+import importlib.util
+from aps2mqtt.apsystems.inverters import get_inverter_layout
+
+_UID_SIZE = 6
+_TYPE_OFFSET = 7
+_ONLINE_OFFSET = 6
+
+
+def numpy_available():
+    """Whether the columnar snapshot can be used
+
+    numpy is optional, and only imported by the first snapshot as it slows the startup down.
+    """
+    return importlib.util.find_spec("numpy") is not None
+
+
+class InverterSnapshot:
+    """Inverter readings of a poll as columns, one row per inverter in the frame order
+
+    Missing values (temperature of an offline inverter, unused channels) are NaN.
+    """
+
+    def __init__(self, uid, model, online, signal, frequency, temperature, power, voltage):
+        self.uid = uid
+        self.model = model
+        self.online = online
+        self.signal = signal
+        self.frequency = frequency
+        self.temperature = temperature
+        self.power = power
+        self.voltage = voltage
+
+    def __len__(self):
+        return len(self.uid)
+
+    def __repr__(self):
+        return f"InverterSnapshot({len(self)} inverters)"
+
+    def inverter_power(self):
+        """Total power of each inverter, sum of its channels"""
+        import numpy as np  # pylint: disable=import-outside-toplevel
+
+        return np.nansum(self.power, axis=1)
+
+    def inverter_voltage(self):
+        """Mean voltage of each inverter"""
+        import numpy as np  # pylint: disable=import-outside-toplevel
+
+        voltage = np.where(np.isnan(self.voltage), 0, self.voltage)
+        count = np.count_nonzero(~np.isnan(self.voltage), axis=1)
+        return np.divide(
+            voltage.sum(axis=1), count, out=np.full(len(self), np.nan), where=count > 0
+        )
+
+    def aggregate(self):
+        """Fleet-wide totals and per model power, computed from the columns in one pass"""
+        import numpy as np  # pylint: disable=import-outside-toplevel
+
+        inverter_power = self.inverter_power()
+        models, model_index = np.unique(self.model, return_inverse=True)
+        model_power = np.bincount(model_index, weights=inverter_power, minlength=len(models))
+        model_count = np.bincount(model_index, minlength=len(models))
+        return {
+            "power": float(inverter_power.sum()),
+            "online": int(np.count_nonzero(self.online)),
+            "max_temperature": (
+                float(np.nanmax(self.temperature)) if np.any(self.online) else None
+            ),
+            "models": {
+                str(model): {"count": int(count), "power": float(power)}
+                for model, count, power in zip(models, model_count, model_power)
+            },
+        }
+
+
+def decode_inverter_snapshot(data, start, inverter_qty, signal):
+    """Decode the inverter records of an inverter data frame into a snapshot
+
+    Only the record types are read one by one, to locate the records. Values are then
+    gathered for all the records of a layout at once.
+    """
+    import numpy as np  # pylint: disable=import-outside-toplevel
+
+    offsets = []
+    layout_index = []
+    layouts = []
+    position = start
+    for _ in range(inverter_qty):
+        type_code = bytes(data[position + _TYPE_OFFSET : position + _TYPE_OFFSET + 2]).decode(
+            "ascii", "backslashreplace"
+        )
+        layout = get_inverter_layout(type_code)
+        if layout is None:
+            raise ValueError(f"Unsupported inverter type '{type_code}' location={position}")
+        if layout not in layouts:
+            layouts.append(layout)
+        offsets.append(position)
+        layout_index.append(layouts.index(layout))
+        position += layout.stride
+    if position > len(data):
+        raise ValueError(f"Inverter data truncated, {position} bytes expected")
+
+    frame = np.frombuffer(data, dtype=np.uint8)
+    # Big endian uint16 starting at every byte of the frame
+    words = (frame[:-1].astype(np.uint16) << 8) | frame[1:]
+    starts = np.asarray(offsets, dtype=np.intp)
+
+    qty = len(offsets)
+    power_qty = max((len(layout.power_offsets) for layout in layouts), default=0)
+    voltage_qty = max((len(layout.voltage_offsets) for layout in layouts), default=0)
+    power = np.full((qty, power_qty), np.nan)
+    voltage = np.full((qty, voltage_qty), np.nan)
+    frequency = np.empty(qty)
+    temperature = np.empty(qty)
+    model = np.empty(qty, dtype=object)
+
+    layout_index = np.asarray(layout_index, dtype=np.intp)
+    for index, layout in enumerate(layouts):
+        rows = layout_index == index
+        records = starts[rows]
+        frequency[rows] = words[records + layout.frequency_offset] / 10
+        temperature[rows] = words[records + layout.temperature_offset].astype(np.float64) - 100
+        for channel, offset in enumerate(layout.power_offsets):
+            power[rows, channel] = words[records + offset]
+        for channel, offset in enumerate(layout.voltage_offsets):
+            voltage[rows, channel] = words[records + offset]
+        model[rows] = layout.model
+
+    online = frame[starts + _ONLINE_OFFSET] != 0
+    temperature[~online] = np.nan
+    uid_bytes = frame[starts[:, None] + np.arange(_UID_SIZE)]
+    uid = np.array([row.tobytes().hex() for row in uid_bytes], dtype=f"U{2 * _UID_SIZE}")
+    signal_column = np.array([signal.get(inverter_uid, 0) for inverter_uid in uid], dtype=np.int16)
+
+    return InverterSnapshot(
+        uid, model.astype(str), online, signal_column, frequency, temperature, power, voltage
+    )
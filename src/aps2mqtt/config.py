@@ -2,9 +2,23 @@
 
 import os
 from zoneinfo import ZoneInfo
-from dateutil import tz
-import yaml
 from str2bool import str2bool_exc
+from aps2mqtt.serializer import PAYLOAD_ENCODINGS
+
+# Inverter payloads published on their own topics, in the ECU document, or both
+_PAYLOAD_MODES = ("topics", "aggregated", "both")
+
+
+def parse_deadbands(deadbands):
+    """Parse deadbands given as a dict or as a 'field:value,field:value' string"""
+    if isinstance(deadbands, dict):
+        return {str(field): float(value) for field, value in deadbands.items()}
+    parsed = {}
+    for item in str(deadbands).split(","):
+        if item.strip():
+            field, value = item.split(":")
+            parsed[field.strip()] = float(value)
+    return parsed
 
 
 class MQTTDiscoveryConfig:
@@ -12,6 +26,7 @@ class MQTTDiscoveryConfig:
 
     def __init__(self, cfg):
         self.prefix = cfg.get("MQTT_DISCOVERY_PREFIX", "homeassistant")
+        self.state_file = cfg.get("MQTT_DISCOVERY_STATE_FILE", None)
 
 
 class MQTTConfig:
@@ -25,9 +40,34 @@ class MQTTConfig:
         self.client_id = cfg.get("MQTT_CLIENT_ID", "APS2MQTT")
         self.topic_prefix = cfg.get("MQTT_TOPIC_PREFIX", "")
         self.retain = str2bool_exc(str(cfg.get("MQTT_RETAIN", False)))
+        self.qos = int(cfg.get("MQTT_QOS", 0))
+        if self.qos not in (0, 1, 2):
+            raise ValueError(f"Invalid MQTT QoS {self.qos}, must be 0, 1 or 2")
+        self.max_inflight = int(cfg.get("MQTT_MAX_INFLIGHT", 20))
+        self.max_queued = int(cfg.get("MQTT_MAX_QUEUED", 0))
+        self.publish_timeout = float(cfg.get("MQTT_PUBLISH_TIMEOUT", 10))
+        self.payload_encoding = str(cfg.get("MQTT_PAYLOAD_ENCODING", "json")).lower()
+        if self.payload_encoding not in PAYLOAD_ENCODINGS:
+            raise ValueError(
+                f"Invalid MQTT payload encoding {self.payload_encoding}, "
+                f"must be one of {PAYLOAD_ENCODINGS}"
+            )
+        self.payload_mode = str(cfg.get("MQTT_PAYLOAD_MODE", "topics")).lower()
+        if self.payload_mode not in _PAYLOAD_MODES:
+            raise ValueError(
+                f"Invalid MQTT payload mode {self.payload_mode}, must be one of {_PAYLOAD_MODES}"
+            )
         self.discovery_enabled = str2bool_exc(str(cfg.get("MQTT_DISCOVERY_ENABLED", False)))
         if self.discovery_enabled:
             self.discovery = MQTTDiscoveryConfig(cfg)
+        self.publish_on_change = str2bool_exc(str(cfg.get("MQTT_PUBLISH_ON_CHANGE", False)))
+        if self.publish_on_change:
+            self.deadbands = parse_deadbands(cfg.get("MQTT_DEADBANDS", {}))
+            self.full_refresh_interval = float(cfg.get("MQTT_FULL_REFRESH_INTERVAL", 60))
+        self.spool_file = cfg.get("MQTT_SPOOL_FILE", None)
+        if self.spool_file is not None:
+            self.spool_max_messages = int(cfg.get("MQTT_SPOOL_MAX_MESSAGES", 100000))
+            self.spool_drain_rate = float(cfg.get("MQTT_SPOOL_DRAIN_RATE", 0))
         self.secured_connection = str2bool_exc(
             str(cfg.get("MQTT_BROKER_SECURED_CONNECTION", False))
         )
@@ -35,6 +75,24 @@ class MQTTConfig:
             self.cacerts_path = cfg.get("MQTT_BROKER_CACERTS_PATH", None)
 
 
+class MetricsConfig:
+    """Prometheus metrics config"""
+
+    def __init__(self, cfg):
+        self.enabled = str2bool_exc(str(cfg.get("METRICS_ENABLED", False)))
+        self.host = cfg.get("METRICS_HOST", "0.0.0.0")
+        self.port = int(cfg.get("METRICS_PORT", 9880))
+
+
+class DecodeConfig:
+    """ECU replies decoding config"""
+
+    def __init__(self, cfg):
+        self.workers = int(cfg.get("DECODE_WORKERS", 0))
+        if self.workers < 0:
+            raise ValueError(f"Invalid decode workers {self.workers}, must be positive or 0")
+
+
 class ECUConfig:
     """ECU config"""
 
@@ -42,12 +100,35 @@ class ECUConfig:
         self.ipaddr = cfg["APS_ECU_IP"]
         self.port = int(cfg.get("APS_ECU_PORT", 8899))
         ecu_timezone = cfg.get("APS_ECU_TIMEZONE", os.getenv("TZ", None))
-        self.timezone = ZoneInfo(str(ecu_timezone)) if ecu_timezone is not None else tz.tzlocal()
+        if ecu_timezone is not None:
+            self.timezone = ZoneInfo(str(ecu_timezone))
+        else:
+            from dateutil import tz  # pylint: disable=import-outside-toplevel
+
+            self.timezone = tz.tzlocal()
+        self.command_timeout = float(cfg.get("APS_ECU_COMMAND_TIMEOUT", 10))
+        self.wait_ready = str2bool_exc(str(cfg.get("APS_ECU_WAIT_READY", False)))
+        self.command_gap = float(cfg.get("APS_ECU_COMMAND_GAP", 0))
+        self.persistent_connection = str2bool_exc(
+            str(cfg.get("APS_ECU_PERSISTENT_CONNECTION", False))
+        )
+        self.columnar_snapshot = str2bool_exc(str(cfg.get("APS_ECU_COLUMNAR_SNAPSHOT", False)))
+        self.energy_integration = str2bool_exc(str(cfg.get("APS_ECU_ENERGY_INTEGRATION", False)))
+        if self.energy_integration:
+            self.energy_state_file = cfg.get("APS_ECU_ENERGY_STATE_FILE", None)
+            self.power_window = float(cfg.get("APS_ECU_POWER_WINDOW", 15))
+        self.failure_threshold = int(cfg.get("APS_ECU_FAILURE_THRESHOLD", 5))
+        if self.failure_threshold < 1:
+            raise ValueError(
+                f"Invalid ECU failure threshold {self.failure_threshold}, must be at least 1"
+            )
+        self.max_retry_delay = float(cfg.get("APS_ECU_MAX_RETRY_DELAY", 60))
         self.auto_restart = str2bool_exc(str(cfg.get("APS_ECU_AUTO_RESTART", False)))
         if self.auto_restart:
             self.wifi_config = WifiConfig(
                 cfg.get("APS_ECU_WIFI_SSID", ""), cfg.get("APS_ECU_WIFI_PASSWD", "")
             )
+            self.restart_timeout = float(cfg.get("APS_ECU_RESTART_TIMEOUT", 300))
         self.stop_at_night = str2bool_exc(str(cfg.get("APS_ECU_STOP_AT_NIGHT", False)))
         if self.stop_at_night:
             self.ecu_position_latitude = float(cfg.get("APS_ECU_POSITION_LAT", 48.864716))
@@ -73,10 +154,25 @@ class Config:
         else:
             cfg = os.environ
             self.mqtt_config = MQTTConfig(cfg)
-            self.ecu_config = ECUConfig(cfg)
+            self.ecu_configs = [ECUConfig(cfg)]
+            self.metrics_config = MetricsConfig(cfg)
+            self.decode_config = DecodeConfig(cfg)
+        # First ECU, kept for single ECU setups
+        self.ecu_config = self.ecu_configs[0]
 
     def __load_yaml_config_file(self, config_path):
+        # Not imported by the containers configured by env variables
+        import yaml  # pylint: disable=import-outside-toplevel
+
         with open(config_path, "r", encoding="UTF-8") as yml_cfg:
             cfg = yaml.safe_load(yml_cfg)
             self.mqtt_config = MQTTConfig(cfg["mqtt"])
-            self.ecu_config = ECUConfig(cfg["ecu"])
+            # ecu section can be a single ECU or a list of ECUs
+            ecu_cfgs = cfg["ecu"] if isinstance(cfg["ecu"], list) else [cfg["ecu"]]
+            if len(ecu_cfgs) == 0:
+                raise ValueError("At least one ECU must be configured")
+            self.ecu_configs = [ECUConfig(ecu_cfg) for ecu_cfg in ecu_cfgs]
+            # Optional section, metrics are disabled without it
+            self.metrics_config = MetricsConfig(cfg.get("metrics") or {})
+            # Optional section, replies are decoded by the main process without it
+            self.decode_config = DecodeConfig(cfg.get("decoding") or {})
@@ -0,0 +1,117 @@
+"""Decode the inverter replies of the ECUs and build their MQTT payloads in worker processes
+
+Only the raw frames and the few ECU values needed to decode them are sent to a worker, the
+decoded data come back with their serialized payloads. Decoding many ECUs then uses several
+cores instead of sharing the GIL with the event loop and the MQTT network thread.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from aps2mqtt.apsystems.APSystemsSocket import APSystemsSocket
+from aps2mqtt.metrics import METRICS
+from aps2mqtt.mqtthandler import build_payloads
+from aps2mqtt.serializer import get_serializer
+
+_LOGGER = logging.getLogger(__name__)
+
+# Values of the ECU reply, decoded by the main process, merged with the inverter data
+_ECU_FIELDS = (
+    "ecu_id",
+    "today_energy",
+    "lifetime_energy",
+    "current_power",
+    "qty_of_inverters",
+    "qty_of_online_inverters",
+)
+
+
+def _init_worker(log_level):
+    logging.basicConfig(level=log_level)
+    # Recorded by the main process, the worker ones couldn't be served
+    METRICS.enabled = False
+
+
+@lru_cache(maxsize=None)
+def _serializer(encoding):
+    return get_serializer(encoding)
+
+
+def decode_inverters(
+    ipaddr, ecu_values, inverter_frame, signal_frame, snapshot=False, payload_options=None
+):
+    """Decode the inverter and signal replies of an ECU update, run by a worker
+
+    payload_options is the (topic prefix, payload mode, payload encoding) of the serialized
+    payloads added to the data, None to only decode. Return (data, errors, exception): the
+    decoding errors are returned with the exception, which can't carry them.
+    """
+    aps_socket = APSystemsSocket(ipaddr, snapshot=snapshot)
+    for name, value in ecu_values.items():
+        setattr(aps_socket, name, value)
+    aps_socket.inverter_raw_data = inverter_frame
+    aps_socket.inverter_raw_signal = signal_frame
+    try:
+        data = aps_socket.collect_data()
+        if payload_options is not None:
+            topic_prefix, payload_mode, payload_encoding = payload_options
+            serializer = _serializer(payload_encoding)
+            data["payloads"] = {
+                topic: serializer.dumps(payload)
+                for topic, payload in build_payloads(data, topic_prefix, payload_mode).items()
+            }
+    except Exception as err:  # pylint: disable=broad-except
+        return None, list(aps_socket.errors), err
+    return data, list(aps_socket.errors), None
+
+
+class DecoderPool:
+    """Pool of worker processes decoding the inverter replies of all the ECUs
+
+    payload_options are the options of the payloads built by the workers, None if they must
+    be built by the main process.
+    """
+
+    def __init__(self, workers, payload_options=None):
+        self.workers = workers
+        self.payload_options = payload_options
+        # Forking would copy the event loop and the MQTT network thread
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(logging.getLogger().getEffectiveLevel(),),
+        )
+        _LOGGER.info("Decoding the ECU replies in %s worker processes", workers)
+
+    async def decode(self, aps_socket, payloads=True):
+        """Decode the inverter replies read by the socket in a worker, return the ECU data
+
+        Serialized payloads are added to the data as payloads, unless disabled.
+        """
+        loop = asyncio.get_running_loop()
+        data, errors, err = await loop.run_in_executor(
+            self.executor,
+            decode_inverters,
+            aps_socket.ipaddr,
+            {name: getattr(aps_socket, name) for name in _ECU_FIELDS},
+            aps_socket.inverter_raw_data,
+            aps_socket.inverter_raw_signal,
+            aps_socket.snapshot,
+            self.payload_options if payloads else None,
+        )
+        for error in errors:
+            aps_socket.errors.append(error)
+            METRICS.inc("aps_errors_total", ecu=aps_socket.ipaddr)
+        if err is not None:
+            raise err
+        if "timestamp" in data:
+            aps_socket.last_update = data["timestamp"]
+            aps_socket.inverters = data["inverters"]
+        return data
+
+    def shutdown(self):
+        """Stop the workers, without waiting for the pending updates"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
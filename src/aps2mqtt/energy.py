@@ -0,0 +1,175 @@
+"""Per inverter and per panel energy, integrated from the power of successive ECU updates"""
+
+import json
+import logging
+import os
+from collections import deque
+from datetime import datetime
+
+_LOGGER = logging.getLogger(__name__)
+
+_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class RollingPower:
+    """Average and peak of the power samples of the last window seconds
+
+    Each sample is added and removed once, the peak is the head of a queue of decreasing
+    powers, so no sample is scanned again.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.samples = deque()
+        self.total = 0.0
+        # (time, power) of the samples which can still become the peak
+        self.peaks = deque()
+
+    def add(self, time, power):
+        """Add the power sampled at time, in seconds, and forget the samples out of the window"""
+        self.samples.append((time, power))
+        self.total += power
+        while self.peaks and self.peaks[-1][1] <= power:
+            self.peaks.pop()
+        self.peaks.append((time, power))
+
+        start = time - self.window
+        while self.samples[0][0] <= start:
+            self.total -= self.samples.popleft()[1]
+        while self.peaks[0][0] <= start:
+            self.peaks.popleft()
+
+    def average(self):
+        """Average power of the window, None without sample"""
+        return self.total / len(self.samples) if self.samples else None
+
+    def peak(self):
+        """Peak power of the window, None without sample"""
+        return self.peaks[0][1] if self.peaks else None
+
+
+class InverterEnergy:
+    """Energy produced today by each panel of an inverter, in Wh"""
+
+    def __init__(self, window, today=None, last_time=None, last_power=None):
+        self.today = today or []
+        self.last_time = last_time
+        self.last_power = last_power
+        self.rolling = RollingPower(window)
+
+    def add(self, time, power, max_gap):
+        """Integrate the panel powers sampled at time, with the trapezoidal rule"""
+        if self.last_time is not None and time == self.last_time:
+            # Same ECU data polled again, only sampled if the window was lost by a restart
+            if not self.rolling.samples:
+                self.rolling.add(time, sum(power))
+            return
+        if len(self.today) != len(power):
+            self.today = [0.0] * len(power)
+        elif (
+            self.last_time is not None
+            and 0 < time - self.last_time <= max_gap
+            and len(self.last_power) == len(power)
+        ):
+            hours = (time - self.last_time) / 3600
+            for panel, (previous, current) in enumerate(zip(self.last_power, power)):
+                self.today[panel] += (previous + current) / 2 * hours
+        self.last_time = time
+        self.last_power = list(power)
+        self.rolling.add(time, sum(power))
+
+    def offline(self):
+        """The inverter power is unknown until it is back online"""
+        self.last_time = None
+        self.last_power = None
+
+
+class EnergyIntegrator:
+    """Today energy of the inverters and panels of an ECU, with rolling power aggregates
+
+    Energy is reset at midnight in the ECU timezone. Samples more than max_gap seconds
+    apart are not integrated, the power in between is unknown.
+    """
+
+    def __init__(self, timezone, state_file=None, window=900, max_gap=900):
+        self.timezone = timezone
+        self.state_file = state_file
+        self.window = window
+        self.max_gap = max_gap
+        self.day = None
+        # Inverter uid -> InverterEnergy
+        self.inverters = {}
+        self._load_state()
+
+    def update(self, data):
+        """Integrate the inverter powers of an ECU update, adding their energy to the data
+
+        Inverters get a today_energy in kWh and panel_today_energy list, online ones also get
+        avg_power and peak_power over the window.
+        """
+        timestamp = datetime.strptime(data["timestamp"], _TIMESTAMP_FORMAT).replace(
+            tzinfo=self.timezone
+        )
+        if timestamp.date() != self.day:
+            # Midnight passed, or first update
+            self.day = timestamp.date()
+            for energy in self.inverters.values():
+                energy.today = [0.0] * len(energy.today)
+        time = timestamp.timestamp()
+
+        for inverter in data["inverters"]:
+            uid = str(inverter["uid"])
+            energy = self.inverters.get(uid)
+            if energy is None:
+                energy = self.inverters[uid] = InverterEnergy(self.window)
+            if inverter["online"]:
+                energy.add(time, inverter["power"], self.max_gap)
+                inverter["avg_power"] = round(energy.rolling.average(), 1)
+                inverter["peak_power"] = energy.rolling.peak()
+            else:
+                energy.offline()
+            inverter["panel_today_energy"] = [round(wh / 1000, 3) for wh in energy.today]
+            inverter["today_energy"] = round(sum(energy.today) / 1000, 3)
+
+        self._save_state()
+        return data
+
+    def _load_state(self):
+        if self.state_file is None:
+            return
+        try:
+            with open(self.state_file, "r", encoding="UTF-8") as state_file:
+                state = json.load(state_file)
+            self.day = datetime.strptime(state["day"], "%Y-%m-%d").date()
+            self.inverters = {
+                uid: InverterEnergy(
+                    self.window, inverter["today"], inverter["last_time"], inverter["last_power"]
+                )
+                for uid, inverter in state["inverters"].items()
+            }
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            _LOGGER.warning("Invalid energy state file, energy starts from zero: %s", err)
+
+    def _save_state(self):
+        if self.state_file is None:
+            return
+        state = {
+            "day": self.day.isoformat(),
+            "inverters": {
+                uid: {
+                    "today": energy.today,
+                    "last_time": energy.last_time,
+                    "last_power": energy.last_power,
+                }
+                for uid, energy in self.inverters.items()
+            },
+        }
+        tmp_path = self.state_file + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="UTF-8") as state_file:
+                json.dump(state, state_file)
+            os.replace(tmp_path, self.state_file)
+        except OSError as err:
+            _LOGGER.warning("Failed to save energy state: %s", err)
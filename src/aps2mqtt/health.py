@@ -0,0 +1,87 @@
+"""Health of the connection to an ECU, with a circuit breaker to stop polling a dead ECU"""
+
+from datetime import timedelta
+
+HEALTHY = "healthy"
+DEGRADED = "degraded"
+OPEN = "open"
+RESTARTING = "restarting"
+
+
+class ECUHealth:
+    """Health state machine of an ECU, driven by the results of its updates
+
+    * healthy: the last update succeeded
+    * degraded: the last updates failed, the ECU is still polled as usual
+    * open: failure_threshold updates failed in a row. The ECU is only probed once a delay
+      has passed, doubled after each failed probe, from min_delay up to max_delay seconds
+    * restarting: the ECU is restarting, it is not queried until it accepts connections
+      again, for up to restart_timeout seconds
+
+    A successful update closes the circuit from any state.
+    """
+
+    def __init__(self, failure_threshold=5, min_delay=60, max_delay=3600, restart_timeout=300):
+        self.failure_threshold = failure_threshold
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.restart_timeout = restart_timeout
+        self.state = HEALTHY
+        self.failures = 0
+        # Failed probes since the circuit opened
+        self.failed_probes = 0
+        self.next_attempt = None
+
+    def is_open(self):
+        """Whether the ECU must not be polled before next_attempt"""
+        return self.state in (OPEN, RESTARTING)
+
+    def success(self):
+        """Record a successful update"""
+        self.state = HEALTHY
+        self.failures = 0
+        self.failed_probes = 0
+        self.next_attempt = None
+
+    def failure(self, now):
+        """Record a failed update at now, return True if the circuit has just opened"""
+        self.failures += 1
+        if self.is_open():
+            # Half-open probe failed, or the restart didn't help
+            self.failed_probes += 1
+            self._open(now)
+            return False
+        if self.failures >= self.failure_threshold:
+            self._open(now)
+            return True
+        self.state = DEGRADED
+        return False
+
+    def restarting(self, now):
+        """Record the restart request of the ECU at now"""
+        self.state = RESTARTING
+        self.next_attempt = now + timedelta(seconds=self.restart_timeout)
+
+    def restarted(self, now):
+        """The restarted ECU accepts connections again at now, probe it right away"""
+        self.next_attempt = now
+
+    def restart_failed(self, now):
+        """The ECU couldn't be restarted, or didn't come back in time"""
+        self.failed_probes += 1
+        self._open(now)
+
+    def status(self):
+        """Payload of the ECU status topic"""
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "next_attempt": (
+                self.next_attempt.isoformat(timespec="seconds") if self.is_open() else None
+            ),
+        }
+
+    def _open(self, now):
+        self.state = OPEN
+        delay = min(self.min_delay * 2**self.failed_probes, self.max_delay)
+        self.next_attempt = now + timedelta(seconds=delay)
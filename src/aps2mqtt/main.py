@@ -1,18 +1,31 @@
 """Query APS ECU data periodically and send them to the MQTT broker"""
 
+import asyncio
 import logging
 import os
 import time
 
 from argparse import ArgumentParser
 from datetime import datetime, timedelta, timezone
+from functools import partial
 from str2bool import str2bool_exc
 from aps2mqtt.mqtthandler import MQTTHandler
 from aps2mqtt.config import Config
+from aps2mqtt.health import RESTARTING
 from aps2mqtt.apsystems.ECU import ECU
+from aps2mqtt.apsystems.capture import CaptureWriter, ReplaySocket, capture_path
+from aps2mqtt.metrics import METRICS, MetricsServer
+from aps2mqtt.refresh import RefreshPredictor
+from aps2mqtt.scheduler import Scheduler
 
 _LOGGER = logging.getLogger(__name__)
 
+_MIN_UPDATE_DELAY = 5
+# Spread the ECU polls scheduled at the same time
+_UPDATE_JITTER = 2
+# Delay between two checks of a restarting ECU, polled as soon as it is back
+_RESTART_CHECK_DELAY = 10
+
 
 def cli_args():
     """Create CLI arguments and parse them"""
@@ -23,6 +36,18 @@ def cli_args():
     parser.add_argument(
         "-D", "--debug", dest="debug_level", help="enable debug logs", action="store_true"
     )
+    parser.add_argument(
+        "--record",
+        dest="record_dir",
+        help="record the ECU replies to capture files in DIR",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--replay",
+        dest="replay_dir",
+        help="publish the ECU replies recorded in DIR instead of querying the ECUs",
+        metavar="DIR",
+    )
 
     return parser.parse_args()
 
@@ -37,39 +62,169 @@ def main():
     else:
         logging.basicConfig(level=logging.INFO)
 
-    update_time = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    if args.replay_dir is not None:
+        asyncio.run(replay(conf, args.replay_dir))
+    else:
+        asyncio.run(run(conf, args.record_dir))
+
+
+async def run(conf, record_dir=None):
+    """Connect to the broker and poll every ECU concurrently until the application is stopped"""
+    if conf.metrics_config.enabled:
+        METRICS.enable()
+        MetricsServer(METRICS, conf.metrics_config.host, conf.metrics_config.port).start()
 
-    ecu = ECU(conf.ecu_config)
+    ecus = [ECU(ecu_config) for ecu_config in conf.ecu_configs]
+    if record_dir is not None:
+        for ecu in ecus:
+            ecu.socket.recorder = CaptureWriter(capture_path(record_dir, ecu.ipaddr, ecu.port))
+            _LOGGER.info("ECU %s: recording replies to %s", ecu.ipaddr, ecu.socket.recorder.path)
     mqtt_handler = MQTTHandler(conf.mqtt_config)
+    decoder_pool = None
+    if conf.decode_config.workers > 0:
+        # multiprocessing is only imported when needed, it slows the startup down
+        from aps2mqtt.decoder import DecoderPool  # pylint: disable=import-outside-toplevel
+
+        decoder_pool = DecoderPool(
+            conf.decode_config.workers, mqtt_handler.worker_payload_options()
+        )
+        for ecu, ecu_config in zip(ecus, conf.ecu_configs):
+            # Energy is added to the data by this process, the payloads are built afterwards
+            ecu.socket.decoder = partial(
+                decoder_pool.decode, payloads=not ecu_config.energy_integration
+            )
     mqtt_handler.connect_mqtt()
 
-    while 1:
-        if datetime.now(timezone.utc) > update_time:
-            if ecu.should_sleep():
-                update_time = ecu.wake_up_time()
-                _LOGGER.info(
-                    "Time to sleep, next update at: %s",
-                    update_time.astimezone().strftime("%Y-%m-%d %H:%M:%S %Z"),
-                )
-            else:
-                try:
-                    data = ecu.update()
-                    if data is None or len(data) == 0:
-                        raise ValueError("Retrieved data are empty")
-                    update_time = datetime.strptime(data["timestamp"], "%Y-%m-%d %H:%M:%S").replace(
-                        tzinfo=conf.ecu_config.timezone
-                    ) + timedelta(seconds=360)
-                    mqtt_handler.publish_values(data)
-                except Exception as e:
-                    update_time = datetime.now(timezone.utc) + timedelta(seconds=60)
-                    _LOGGER.error("An exception occured: %s -> %s", e.__class__.__name__, str(e))
-                    _LOGGER.debug("Exception trace:", exc_info=True)
-                _LOGGER.info(
-                    "Update finished, next update at: %s",
-                    update_time.astimezone().strftime("%Y-%m-%d %H:%M:%S %Z"),
-                )
-
-        time.sleep(5)
+    scheduler = Scheduler(jitter=_UPDATE_JITTER)
+    for ecu, ecu_config in zip(ecus, conf.ecu_configs):
+        schedule_poll(scheduler, ecu, mqtt_handler, ecu_config)
+    try:
+        await scheduler.run()
+    finally:
+        if decoder_pool is not None:
+            decoder_pool.shutdown()
+
+
+def schedule_poll(scheduler, ecu, mqtt_handler, ecu_config):
+    """Poll the ECU now, then just after each predicted ECU refresh"""
+    predictor = RefreshPredictor()
+
+    async def poll():
+        update_time = await poll_ecu(ecu, mqtt_handler, ecu_config, predictor)
+        # An ECU clock behind ours would give an update time already passed
+        delay = (update_time - datetime.now(timezone.utc)).total_seconds()
+        scheduler.schedule_in(max(delay, _MIN_UPDATE_DELAY), poll)
+
+    scheduler.schedule_in(0, poll)
+
+
+async def poll_ecu(ecu, mqtt_handler, ecu_config, predictor):
+    """Query the ECU and publish its new data, return the time of the next poll"""
+    if ecu.should_sleep():
+        update_time = ecu.wake_up_time()
+        _LOGGER.info(
+            "ECU %s: time to sleep, next update at: %s",
+            ecu.ipaddr,
+            update_time.astimezone().strftime("%Y-%m-%d %H:%M:%S %Z"),
+        )
+        return update_time
+
+    now = datetime.now(timezone.utc)
+    if ecu.health.state == RESTARTING and now < ecu.health.next_attempt:
+        _LOGGER.debug("ECU %s: restarting, not queried", ecu.ipaddr)
+        mqtt_handler.publish_ecu_status(ecu.ipaddr, ecu.health.status())
+        return restart_check_time(ecu, now)
+
+    try:
+        data = await ecu.async_update()
+        if data is None or len(data) == 0:
+            raise ValueError("Retrieved data are empty")
+        timestamp = datetime.strptime(data["timestamp"], "%Y-%m-%d %H:%M:%S").replace(
+            tzinfo=ecu_config.timezone
+        )
+        if predictor.is_stale(timestamp):
+            predictor.stale()
+            _LOGGER.info("ECU %s: no new data since %s, nothing published", ecu.ipaddr, timestamp)
+        else:
+            await mqtt_handler.async_publish_values(data)
+            predictor.data_received(timestamp)
+    except Exception as e:
+        predictor.error()
+        _LOGGER.error(
+            "ECU %s: an exception occured: %s -> %s",
+            ecu.ipaddr,
+            e.__class__.__name__,
+            str(e),
+        )
+        _LOGGER.debug("Exception trace:", exc_info=True)
+    now = datetime.now(timezone.utc)
+    update_time = predictor.next_update(now)
+    if ecu.health.state == RESTARTING:
+        update_time = restart_check_time(ecu, now)
+    elif ecu.health.is_open():
+        # Circuit open, the ECU is only probed once the retry delay has passed
+        update_time = max(update_time, ecu.health.next_attempt)
+    mqtt_handler.publish_ecu_status(ecu.ipaddr, ecu.health.status())
+    _LOGGER.info(
+        "ECU %s: update finished, refresh period %ss, next update at: %s",
+        ecu.ipaddr,
+        round(predictor.period()),
+        update_time.astimezone().strftime("%Y-%m-%d %H:%M:%S %Z"),
+    )
+    return update_time
+
+
+def restart_check_time(ecu, now):
+    """Time of the next check of a restarting ECU, at the latest at the end of its restart"""
+    return min(now + timedelta(seconds=_RESTART_CHECK_DELAY), ecu.health.next_attempt)
+
+
+async def replay(conf, capture_dir):
+    """Publish the ECU replies recorded in capture_dir, as fast as possible
+
+    The live ECUs and the state files of the live application are left untouched.
+    """
+    if conf.mqtt_config.discovery_enabled:
+        conf.mqtt_config.discovery.state_file = None
+    conf.mqtt_config.spool_file = None
+    for ecu_config in conf.ecu_configs:
+        ecu_config.auto_restart = False
+        ecu_config.energy_state_file = None
+    mqtt_handler = MQTTHandler(conf.mqtt_config)
+    mqtt_handler.connect_mqtt()
+
+    for ecu_config in conf.ecu_configs:
+        path = capture_path(capture_dir, ecu_config.ipaddr, ecu_config.port)
+        if not os.path.exists(path):
+            _LOGGER.warning("ECU %s: no capture file %s", ecu_config.ipaddr, path)
+            continue
+        ecu = ECU(ecu_config)
+        ecu.socket = ReplaySocket(path, ecu_config.ipaddr, snapshot=ecu_config.columnar_snapshot)
+        await replay_ecu(ecu, mqtt_handler)
+
+
+async def replay_ecu(ecu, mqtt_handler):
+    """Update the ECU from its replay socket and publish its data until the capture ends"""
+    updates = failures = 0
+    start = time.perf_counter()
+    while not ecu.socket.exhausted():
+        try:
+            data = await ecu.async_update()
+        except Exception as err:
+            failures += 1
+            _LOGGER.debug("ECU %s: replayed update failed: %s", ecu.ipaddr, err)
+            continue
+        await mqtt_handler.async_publish_values(data)
+        updates += 1
+    _LOGGER.info(
+        "ECU %s: %s updates and %s failed updates replayed from %s frames in %.3fs",
+        ecu.ipaddr,
+        updates,
+        failures,
+        ecu.socket.replayed,
+        time.perf_counter() - start,
+    )
+    return updates
 
 
 if __name__ == "__main__":
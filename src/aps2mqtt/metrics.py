@@ -0,0 +1,284 @@
+"""Prometheus metrics of the ECU queries and MQTT publications, served over HTTP
+
+Instrumented code records its metrics in the module level METRICS, whose methods return
+right away until metrics are enabled.
+"""
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+_LOGGER = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds in seconds, from a command on a reused connection to a slow ECU reply
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# name -> (type, help)
+_DEFINITIONS = {
+    "aps_socket_connect_seconds": ("histogram", "Time to open a connection to the ECU"),
+    "aps_command_send_seconds": ("histogram", "Time to send a command to the ECU"),
+    "aps_command_receive_seconds": ("histogram", "Time waiting for and reading an ECU reply"),
+    "aps_parse_seconds": ("histogram", "Time to decode the ECU replies"),
+    "aps_update_seconds": ("histogram", "Time of a successful ECU update"),
+    "aps_update_failures_total": ("counter", "ECU updates without valid data"),
+    "aps_checksum_failures_total": ("counter", "ECU replies whose length doesn't match"),
+    "aps_timeouts_total": ("counter", "ECU commands without reply before the timeout"),
+    "aps_retries_total": ("counter", "ECU commands sent again on a new connection"),
+    "aps_errors_total": ("counter", "Errors recorded while decoding the ECU replies"),
+    "aps_mqtt_publish_seconds": ("histogram", "Time to publish an ECU update to the broker"),
+    "aps_mqtt_messages_sent_total": ("counter", "MQTT messages handed to the client"),
+    "aps_mqtt_messages_acknowledged_total": ("counter", "MQTT messages acknowledged"),
+    "aps_mqtt_messages_dropped_total": ("counter", "MQTT messages lost or refused"),
+    "aps_mqtt_messages_unacknowledged_total": ("counter", "MQTT messages not acknowledged in time"),
+    "aps_mqtt_ack_latency_seconds": ("gauge", "Acknowledgement latency of the last MQTT message"),
+    "aps_ecu_restarts_total": ("counter", "ECU restarts, by result"),
+    "aps_ecu_restart_recovery_seconds": (
+        "gauge",
+        "Time for the last restarted ECU to accept connections again",
+    ),
+    "aps_ecu_current_power_watts": ("gauge", "ECU current power"),
+    "aps_ecu_today_energy_kwh": ("gauge", "ECU energy produced today"),
+    "aps_ecu_lifetime_energy_kwh": ("gauge", "ECU lifetime energy"),
+    "aps_ecu_inverters": ("gauge", "Inverters registered on the ECU"),
+    "aps_ecu_online_inverters": ("gauge", "Inverters online"),
+    "aps_ecu_max_temperature_celsius": ("gauge", "Highest temperature of the online inverters"),
+    "aps_model_inverters": ("gauge", "Inverters of each model"),
+    "aps_model_power_watts": ("gauge", "Power of the inverters of each model"),
+    "aps_inverter_online": ("gauge", "Whether the inverter is online"),
+    "aps_inverter_signal": ("gauge", "Inverter signal strength"),
+    "aps_inverter_temperature_celsius": ("gauge", "Inverter temperature"),
+    "aps_inverter_frequency_hertz": ("gauge", "Inverter grid frequency"),
+    "aps_panel_power_watts": ("gauge", "Panel power"),
+    "aps_panel_voltage_volts": ("gauge", "Panel voltage"),
+}
+
+
+class Histogram:
+    """Count of the observed values in each bucket, with their sum"""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        # The last count is for the values above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Record a value"""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        """(upper bound, count of the values lower or equal) of each bucket, +Inf last"""
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics:
+    """Registry of the counters, gauges and histograms, rendered in the Prometheus format"""
+
+    def __init__(self):
+        self.enabled = False
+        # name -> {sorted (label, value) tuples: value or Histogram}
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        """Start recording metrics"""
+        self.enabled = True
+
+    def clear(self):
+        """Forget the recorded metrics"""
+        with self._lock:
+            self._series = {}
+
+    def inc(self, name, amount=1, **labels):
+        """Increase a counter"""
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        """Set a gauge, or a counter maintained elsewhere"""
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series.setdefault(name, {})[key] = value
+
+    def observe(self, name, value, **labels):
+        """Record a value in a histogram"""
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Record the duration of the block in a histogram, unless it raises"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        yield
+        self.observe(name, time.perf_counter() - start, **labels)
+
+    def record_ecu_data(self, data):
+        """Set the ECU and inverter gauges from the data of an ECU update"""
+        if not self.enabled:
+            return
+        ecu_id = str(data["ecu_id"])
+        self.set("aps_ecu_current_power_watts", data["current_power"], ecu=ecu_id)
+        self.set("aps_ecu_today_energy_kwh", data["today_energy"], ecu=ecu_id)
+        self.set("aps_ecu_lifetime_energy_kwh", data["lifetime_energy"], ecu=ecu_id)
+        self.set("aps_ecu_inverters", data["qty_of_inverters"], ecu=ecu_id)
+        self.set("aps_ecu_online_inverters", data["qty_of_online_inverters"], ecu=ecu_id)
+        snapshot = data.get("snapshot")
+        if snapshot is not None:
+            # Only computed from the columnar snapshot
+            aggregates = snapshot.aggregate()
+            if aggregates["max_temperature"] is not None:
+                self.set(
+                    "aps_ecu_max_temperature_celsius", aggregates["max_temperature"], ecu=ecu_id
+                )
+            for model, model_aggregates in aggregates["models"].items():
+                self.set("aps_model_inverters", model_aggregates["count"], ecu=ecu_id, model=model)
+                self.set(
+                    "aps_model_power_watts", model_aggregates["power"], ecu=ecu_id, model=model
+                )
+        for inverter in data.get("inverters", ()):
+            uid = str(inverter["uid"])
+            self.set("aps_inverter_online", int(inverter["online"]), ecu=ecu_id, inverter=uid)
+            if not inverter["online"]:
+                continue
+            self.set("aps_inverter_signal", inverter["signal"], ecu=ecu_id, inverter=uid)
+            self.set(
+                "aps_inverter_temperature_celsius",
+                inverter["temperature"],
+                ecu=ecu_id,
+                inverter=uid,
+            )
+            self.set(
+                "aps_inverter_frequency_hertz", inverter["frequency"], ecu=ecu_id, inverter=uid
+            )
+            for panel, power in enumerate(inverter["power"], start=1):
+                self.set("aps_panel_power_watts", power, ecu=ecu_id, inverter=uid, panel=panel)
+            for panel, voltage in enumerate(inverter["voltage"], start=1):
+                self.set("aps_panel_voltage_volts", voltage, ecu=ecu_id, inverter=uid, panel=panel)
+
+    def render(self):
+        """Metrics in the Prometheus text format"""
+        with self._lock:
+            series = {name: dict(values) for name, values in self._series.items()}
+            histograms = {
+                name: {
+                    key: (list(value.cumulative_counts()), value.sum, value.count)
+                    for key, value in values.items()
+                }
+                for name, values in series.items()
+                if _DEFINITIONS.get(name, ("untyped",))[0] == "histogram"
+            }
+
+        lines = []
+        for name in sorted(series):
+            kind, help_text = _DEFINITIONS.get(name, ("untyped", ""))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                for key, (buckets, total, count) in histograms[name].items():
+                    for bound, bucket_count in buckets:
+                        labels = _format_labels(key + (("le", _format_value(bound)),))
+                        lines.append(f"{name}_bucket{labels} {bucket_count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {_format_value(total)}")
+                    lines.append(f"{name}_count{_format_labels(key)} {count}")
+            else:
+                for key, value in series[name].items():
+                    lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """HTTP server exposing the metrics on /metrics, in a background thread"""
+
+    def __init__(self, metrics, host="0.0.0.0", port=9880):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.server = None
+        self._thread = None
+
+    def start(self):
+        """Start serving, return the listening port"""
+        # Not imported when metrics are disabled
+        # pylint: disable-next=import-outside-toplevel
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):  # pylint: disable=invalid-name
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                _LOGGER.debug(format, *args)
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name="metrics-server", daemon=True
+        )
+        self._thread.start()
+        _LOGGER.info("Metrics served on http://%s:%s/metrics", self.host, self.port)
+        return self.port
+
+    def stop(self):
+        """Stop serving"""
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    labels = ",".join(f'{label}="{_escape(value)}"' for label, value in key)
+    return "{" + labels + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+
+METRICS = Metrics()
@@ -1,17 +1,53 @@
 """Handle MQTT connection and data publishing"""
 
+import asyncio
+import hashlib
 import logging
+import os
+import threading
 import time
 import atexit
 import json
 from statistics import mean
-import certifi
 from paho.mqtt import client as mqtt_client
+from aps2mqtt.metrics import METRICS
+from aps2mqtt.payloadcache import PayloadCache
+from aps2mqtt.serializer import JSONSerializer, get_serializer
 
 _LOGGER = logging.getLogger(__name__)
 
 _MAX_RETRY = 10
 
+# Spooled messages published between two acknowledgement waits
+_SPOOL_BATCH = 100
+
+
+class PublishStats:
+    """Counters of the published messages and latency of their acknowledgement
+
+    With QoS 0 a message is acknowledged once written to the broker connection.
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.acknowledged = 0
+        self.dropped = 0
+        self.unacknowledged = 0
+        self.last_latency = None
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def add_latency(self, latency):
+        """Record the acknowledgement of a message sent latency seconds ago"""
+        self.acknowledged += 1
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
+
+    def mean_latency(self):
+        """Mean acknowledgement latency in seconds, None if no message acknowledged"""
+        return self.total_latency / self.acknowledged if self.acknowledged else None
+
 
 class MQTTHandler:
     """Handle MQTT connection to broker and publish message"""
@@ -24,14 +60,52 @@ class MQTTHandler:
         if self.mqtt_config.discovery_enabled:
             self.discovery_topic = self.mqtt_config.discovery.prefix + "/"
         self.client = None
+        self.serializer = get_serializer(mqtt_config.payload_encoding)
+        # Home Assistant only reads JSON discovery messages
+        self.discovery_serializer = JSONSerializer()
+        if mqtt_config.discovery_enabled and self.serializer.name != "json":
+            _LOGGER.warning(
+                "Discovery sensors can't read %s payloads", mqtt_config.payload_encoding
+            )
+        self.publish_stats = PublishStats()
+        # mid -> send time of the messages waiting for their acknowledgement
+        self._pending = {}
+        # mids acknowledged before their publish call returned
+        self._early_acks = set()
+        self._pending_lock = threading.Lock()
+        # Held by the update draining the spool, the others spool their values meanwhile
+        self._drain_lock = threading.Lock()
         self.status_topic = self.topic_prefix + "aps/status"
-        self.discovery_messages_sent = False
+        # ECU address -> last published health status
+        self.ecu_statuses = {}
+        # Device id -> discovery key of the devices whose discovery is up to date
+        self.discovered_devices = {}
+        # Device id -> {discovery topic: payload hash} of the published discovery payloads
+        self.discovery_state_file = (
+            self.mqtt_config.discovery.state_file if self.mqtt_config.discovery_enabled else None
+        )
+        self.discovery_state = self._load_discovery_state()
+        self.discovery_state_changed = False
+        self.payload_cache = (
+            PayloadCache(mqtt_config.deadbands, mqtt_config.full_refresh_interval * 60)
+            if mqtt_config.publish_on_change
+            else None
+        )
+        self.spool = None
+        if mqtt_config.spool_file is not None:
+            # sqlite3 is only imported when the spool is enabled
+            from aps2mqtt.spool import Spool  # pylint: disable=import-outside-toplevel
+
+            self.spool = Spool(mqtt_config.spool_file, mqtt_config.spool_max_messages)
 
     def on_connect(self, client, userdata, flags, reason_code, properties):
         """Callback function on broker connection"""
         del userdata, flags, properties
         if reason_code == 0:
             _LOGGER.info("Connected to MQTT Broker!")
+            if self.payload_cache is not None:
+                # Broker may have lost the previous values, publish everything again
+                self.payload_cache.clear()
             self._publish(client, self.status_topic, "online", retain=True)
         else:
             _LOGGER.error("Failed to connect: %s", reason_code)
@@ -40,16 +114,68 @@ class MQTTHandler:
         """Callback function on broker disconnection"""
         del client, userdata, flags, properties
         _LOGGER.info("Disconnected from MQTT Broker: %s", reason_code)
+        if self.mqtt_config.qos == 0:
+            # QoS 0 messages are not sent again after a reconnection
+            with self._pending_lock:
+                self.publish_stats.dropped += len(self._pending)
+                self._pending.clear()
+
+    def on_publish(self, client, userdata, mid, reason_code, properties):
+        """Callback function on message acknowledgement"""
+        del client, userdata, reason_code, properties
+        now = time.monotonic()
+        with self._pending_lock:
+            send_time = self._pending.pop(mid, None)
+            if send_time is None:
+                self._early_acks.add(mid)
+            else:
+                self.publish_stats.add_latency(now - send_time)
 
     def _publish(self, client, topic, msg, retain=False):
+        """Publish a message, return its MQTTMessageInfo or None if it couldn't be sent"""
         # If mqtt_retain is True in config, all messages are retained.
         # Otherwise, only LWT uses retain.
         actual_retain = retain or self.mqtt_config.retain
-        result = client.publish(topic, msg, retain=actual_retain)
+        send_time = time.monotonic()
+        result = client.publish(topic, msg, qos=self.mqtt_config.qos, retain=actual_retain)
+        with self._pending_lock:
+            if result.rc == 0:
+                self.publish_stats.sent += 1
+                if result.mid in self._early_acks:
+                    self._early_acks.discard(result.mid)
+                    self.publish_stats.add_latency(time.monotonic() - send_time)
+                else:
+                    self._pending[result.mid] = send_time
+            else:
+                self.publish_stats.dropped += 1
         if result.rc == 0:
             _LOGGER.debug("Send `%s` to topic `%s` (retain=%s)", msg, topic, actual_retain)
-        else:
-            _LOGGER.error("Failed to send message to topic %s: %s", topic, result.rc)
+            return result
+        _LOGGER.error("Failed to send message to topic %s: %s", topic, result.rc)
+        return None
+
+    def wait_for_delivery(self, infos):
+        """Wait for the acknowledgement of the given messages, up to the publish timeout
+
+        Return True if all the messages have been acknowledged.
+        """
+        deadline = time.monotonic() + self.mqtt_config.publish_timeout
+        for info in infos:
+            try:
+                info.wait_for_publish(max(deadline - time.monotonic(), 0))
+            except (ValueError, RuntimeError):
+                pass
+        unacknowledged = sum(1 for info in infos if not _is_published(info))
+        if unacknowledged:
+            with self._pending_lock:
+                self.publish_stats.unacknowledged += unacknowledged
+            _LOGGER.warning(
+                "%s of %s MQTT messages not acknowledged after %ss",
+                unacknowledged,
+                len(infos),
+                self.mqtt_config.publish_timeout,
+            )
+        return unacknowledged == 0
 
     def connect_mqtt(self):
         """Create connection to MQTT broker"""
@@ -68,16 +194,15 @@ class MQTTHandler:
 
         if self.mqtt_config.secured_connection:
             _LOGGER.debug("Use secured connection")
-            if self.mqtt_config.cacerts_path is None:
+            ca_certs = self.mqtt_config.cacerts_path
+            if ca_certs is None:
                 _LOGGER.warning("No ca_certs defined, using default one")
+                # Only needed by secured connections, not imported by every start
+                import certifi  # pylint: disable=import-outside-toplevel
 
-            self.client.tls_set(
-                ca_certs=(
-                    self.mqtt_config.cacerts_path
-                    if self.mqtt_config.cacerts_path is not None
-                    else certifi.where()
-                )
-            )
+                ca_certs = certifi.where()
+
+            self.client.tls_set(ca_certs=ca_certs)
         else:
             _LOGGER.debug("Use unsecured connection")
 
@@ -86,6 +211,10 @@ class MQTTHandler:
 
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
+        self.client.on_publish = self.on_publish
+        # Messages above the in-flight window are queued by the client until acknowledgements
+        self.client.max_inflight_messages_set(self.mqtt_config.max_inflight)
+        self.client.max_queued_messages_set(self.mqtt_config.max_queued)
 
         _LOGGER.info(
             "Connect to broker '%s' on port %s",
@@ -101,165 +230,337 @@ class MQTTHandler:
             _LOGGER.info("Publishing 'offline' status on graceful exit.")
             self._publish(self.client, self.status_topic, "offline", retain=True)
         self.client.loop_stop()
+        if self.spool is not None:
+            self.spool.close()
 
-    def publish_discovery_messages(self, data):
-        """Publish discovery messages for all sensors"""
-        if not self.mqtt_config.discovery_enabled or self.discovery_messages_sent:
+    def publish_ecu_status(self, ipaddr, status):
+        """Publish the health status of an ECU on its retained status topic, if it changed"""
+        if self.ecu_statuses.get(ipaddr) == status or not self._is_connected():
             return
+        topic = self.status_topic + "/" + ipaddr
+        info = self._publish(
+            self.client, topic, self.discovery_serializer.dumps(status), retain=True
+        )
+        if info is not None:
+            self.ecu_statuses[ipaddr] = status
 
-        ecu_id = data["ecu_id"]
-        topic_base = self.topic_prefix + "aps/" + str(ecu_id)
-        ecu_device = self._get_device_payload(ecu_id, "ECU")
+    def publish_discovery_messages(self, data):
+        """Publish discovery messages of the new or changed devices"""
+        if not self.mqtt_config.discovery_enabled:
+            return
 
-        # ECU sensors
-        self._publish_discovery_payload(
-            "sensor",
-            ecu_id,
-            "power",
-            ecu_device,
-            topic_base,
-            "current_power",
-            "ECU Power",
-            "power",
-            "W",
-            "mdi:solar-power",
-        )
-        self._publish_discovery_payload(
-            "sensor",
-            ecu_id,
-            "today_energy",
-            ecu_device,
-            topic_base,
-            "today_energy",
-            "ECU Today Energy",
-            "energy",
-            "kWh",
-            "mdi:solar-power",
-        )
-        self._publish_discovery_payload(
-            "sensor",
-            ecu_id,
-            "lifetime_energy",
-            ecu_device,
-            topic_base,
-            "lifetime_energy",
-            "ECU Lifetime Energy",
-            "energy",
-            "kWh",
-            "mdi:solar-power",
-        )
+        ecu_id = str(data["ecu_id"])
+        if self.discovered_devices.get(ecu_id) != ("ECU",):
+            self._publish_device_discovery(ecu_id, ("ECU",), self._ecu_discovery_payloads(ecu_id))
 
-        # Inverter sensors
         for inverter in data["inverters"]:
-            inv_uid = inverter["uid"]
-            inv_topic_base = topic_base + "/" + str(inv_uid)
-            inv_device = self._get_device_payload(inv_uid, "Inverter", via_device=ecu_id)
+            inv_uid = str(inverter["uid"])
+            # Discovery payloads of an inverter only depend on its ECU and its panel count
+            key = (
+                ecu_id,
+                len(inverter.get("power", [])),
+                len(inverter.get("voltage", [])),
+                len(inverter.get("panel_today_energy", [])) if "today_energy" in inverter else None,
+            )
+            if self.discovered_devices.get(inv_uid) != key:
+                self._publish_device_discovery(
+                    inv_uid, key, self._inverter_discovery_payloads(ecu_id, inverter)
+                )
+
+        if self.discovery_state_changed:
+            self._save_discovery_state()
+
+    def _publish_device_discovery(self, device_id, key, payloads):
+        """Publish the discovery payloads of a device which differ from the published ones"""
+        published = self.discovery_state.get(device_id, {})
+        hashes = {}
+        for topic, payload in payloads:
+            msg = self.discovery_serializer.dumps(payload)
+            digest = hashlib.sha256(msg).hexdigest()
+            if published.get(topic) == digest or self._publish(
+                self.client, topic, msg, retain=True
+            ):
+                hashes[topic] = digest
+
+        # Remove the entities the device doesn't have anymore
+        for topic in sorted(published.keys() - {topic for topic, _ in payloads}):
+            if not self._publish(self.client, topic, "", retain=True):
+                hashes[topic] = published[topic]
+
+        if hashes != published:
+            self.discovery_state[device_id] = hashes
+            self.discovery_state_changed = True
+        if len(hashes) == len(payloads):
+            self.discovered_devices[device_id] = key
+        else:
+            _LOGGER.debug("Discovery of device %s incomplete, retry on next update", device_id)
+
+    def _load_discovery_state(self):
+        if self.discovery_state_file is None:
+            return {}
+        try:
+            with open(self.discovery_state_file, "r", encoding="UTF-8") as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as err:
+            _LOGGER.warning("Invalid discovery state file, discovery will be published: %s", err)
+            return {}
+        return state if isinstance(state, dict) else {}
+
+    def _save_discovery_state(self):
+        self.discovery_state_changed = False
+        if self.discovery_state_file is None:
+            return
+        tmp_path = self.discovery_state_file + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="UTF-8") as state_file:
+                json.dump(self.discovery_state, state_file)
+            os.replace(tmp_path, self.discovery_state_file)
+        except OSError as err:
+            _LOGGER.warning("Failed to save discovery state: %s", err)
+
+    def _ecu_discovery_payloads(self, ecu_id):
+        topic_base = self.topic_prefix + "aps/" + ecu_id
+        ecu_device = self._get_device_payload(ecu_id, "ECU")
+
+        return [
+            self._discovery_payload(
+                "sensor",
+                ecu_id,
+                "power",
+                ecu_device,
+                topic_base,
+                "current_power",
+                "ECU Power",
+                "power",
+                "W",
+                "mdi:solar-power",
+            ),
+            self._discovery_payload(
+                "sensor",
+                ecu_id,
+                "today_energy",
+                ecu_device,
+                topic_base,
+                "today_energy",
+                "ECU Today Energy",
+                "energy",
+                "kWh",
+                "mdi:solar-power",
+            ),
+            self._discovery_payload(
+                "sensor",
+                ecu_id,
+                "lifetime_energy",
+                ecu_device,
+                topic_base,
+                "lifetime_energy",
+                "ECU Lifetime Energy",
+                "energy",
+                "kWh",
+                "mdi:solar-power",
+            ),
+        ]
+
+    def _inverter_discovery_payloads(self, ecu_id, inverter):
+        inv_uid = str(inverter["uid"])
+        inv_topic_base = self.topic_prefix + "aps/" + ecu_id + "/" + inv_uid
+        if self.mqtt_config.payload_mode == "aggregated":
+            # Inverter values are only published in the ECU document
+            state_topic = self.topic_prefix + "aps/" + ecu_id
+            value_prefix = f"inverters['{inv_uid}']."
+        else:
+            state_topic = inv_topic_base
+            value_prefix = ""
+        inv_device = self._get_device_payload(inv_uid, "Inverter", via_device=ecu_id)
 
-            self._publish_discovery_payload(
+        payloads = [
+            self._discovery_payload(
                 "binary_sensor",
                 inv_uid,
                 "online",
                 inv_device,
-                inv_topic_base,
-                "online",
+                state_topic,
+                value_prefix + "online",
                 "Inverter Online",
                 None,
                 None,
                 "mdi:power-plug",
-            )
-            self._publish_discovery_payload(
+            ),
+            self._discovery_payload(
                 "sensor",
                 inv_uid,
                 "signal",
                 inv_device,
-                inv_topic_base,
-                "signal",
+                state_topic,
+                value_prefix + "signal",
                 "Inverter Signal",
                 "signal_strength",
                 "dBm",
                 "mdi:wifi",
-            )
-            self._publish_discovery_payload(
+            ),
+            self._discovery_payload(
                 "sensor",
                 inv_uid,
                 "temperature",
                 inv_device,
-                inv_topic_base,
-                "temperature",
+                state_topic,
+                value_prefix + "temperature",
                 "Inverter Temperature",
                 "temperature",
                 "°C",
                 "mdi:thermometer",
-            )
-            self._publish_discovery_payload(
+            ),
+            self._discovery_payload(
                 "sensor",
                 inv_uid,
                 "frequency",
                 inv_device,
-                inv_topic_base,
-                "frequency",
+                state_topic,
+                value_prefix + "frequency",
                 "Inverter Frequency",
                 "frequency",
                 "Hz",
                 "mdi:sine-wave",
-            )
-            self._publish_discovery_payload(
+            ),
+            self._discovery_payload(
                 "sensor",
                 inv_uid,
                 "power",
                 inv_device,
-                inv_topic_base,
-                "power",
+                state_topic,
+                value_prefix + "power",
                 "Inverter Power",
                 "power",
                 "W",
                 "mdi:solar-power",
-            )
-            self._publish_discovery_payload(
+            ),
+            self._discovery_payload(
                 "sensor",
                 inv_uid,
                 "voltage",
                 inv_device,
-                inv_topic_base,
-                "voltage",
+                state_topic,
+                value_prefix + "voltage",
                 "Inverter Voltage",
                 "voltage",
                 "V",
                 "mdi:lightning-bolt",
+            ),
+        ]
+
+        if "today_energy" in inverter:
+            payloads.extend(
+                self._inverter_energy_discovery_payloads(
+                    inverter, inv_uid, inv_device, state_topic, value_prefix
+                )
             )
 
-            # Panel sensors
-            for i, panel_power in enumerate(inverter.get("power", [])):
-                panel_num = i + 1
-                self._publish_discovery_payload(
+        # Panel sensors
+        for panel_num in range(1, len(inverter.get("power", [])) + 1):
+            panel_topic, panel_value = self._panel_state(
+                state_topic, value_prefix, panel_num, "power"
+            )
+            payloads.append(
+                self._discovery_payload(
                     "sensor",
                     inv_uid,
                     f"panel_{panel_num}_power",
                     inv_device,
-                    inv_topic_base + f"/{panel_num}",
-                    "power",
+                    panel_topic,
+                    panel_value,
                     f"Panel {panel_num} Power",
                     "power",
                     "W",
                     "mdi:solar-panel",
                 )
+            )
 
-            for i, panel_voltage in enumerate(inverter.get("voltage", [])):
-                panel_num = i + 1
-                self._publish_discovery_payload(
+        for panel_num in range(1, len(inverter.get("voltage", [])) + 1):
+            panel_topic, panel_value = self._panel_state(
+                state_topic, value_prefix, panel_num, "voltage"
+            )
+            payloads.append(
+                self._discovery_payload(
                     "sensor",
                     inv_uid,
                     f"panel_{panel_num}_voltage",
                     inv_device,
-                    inv_topic_base + f"/{panel_num}",
-                    "voltage",
+                    panel_topic,
+                    panel_value,
                     f"Panel {panel_num} Voltage",
                     "voltage",
                     "V",
                     "mdi:lightning-bolt",
                 )
+            )
+
+        return payloads
+
+    def _inverter_energy_discovery_payloads(
+        self, inverter, inv_uid, inv_device, state_topic, value_prefix
+    ):
+        payloads = [
+            self._discovery_payload(
+                "sensor",
+                inv_uid,
+                "today_energy",
+                inv_device,
+                state_topic,
+                value_prefix + "today_energy",
+                "Inverter Today Energy",
+                "energy",
+                "kWh",
+                "mdi:solar-power",
+            ),
+            self._discovery_payload(
+                "sensor",
+                inv_uid,
+                "avg_power",
+                inv_device,
+                state_topic,
+                value_prefix + "avg_power",
+                "Inverter Average Power",
+                "power",
+                "W",
+                "mdi:solar-power",
+            ),
+            self._discovery_payload(
+                "sensor",
+                inv_uid,
+                "peak_power",
+                inv_device,
+                state_topic,
+                value_prefix + "peak_power",
+                "Inverter Peak Power",
+                "power",
+                "W",
+                "mdi:solar-power",
+            ),
+        ]
+        for panel_num in range(1, len(inverter["panel_today_energy"]) + 1):
+            payloads.append(
+                self._discovery_payload(
+                    "sensor",
+                    inv_uid,
+                    f"panel_{panel_num}_today_energy",
+                    inv_device,
+                    state_topic,
+                    f"{value_prefix}panel_{panel_num}_today_energy",
+                    f"Panel {panel_num} Today Energy",
+                    "energy",
+                    "kWh",
+                    "mdi:solar-panel",
+                )
+            )
+        return payloads
 
-        self.discovery_messages_sent = True
+    def _panel_state(self, state_topic, value_prefix, panel_num, value):
+        """State topic and value key of a panel sensor"""
+        if self.mqtt_config.payload_mode == "aggregated":
+            return state_topic, f"{value_prefix}panel_{panel_num}_{value}"
+        return state_topic + f"/{panel_num}", value
 
     def _get_device_payload(self, device_id, device_name, via_device=None):
         payload = {
@@ -271,7 +572,7 @@ class MQTTHandler:
             payload["via_device"] = str(via_device)
         return payload
 
-    def _publish_discovery_payload(
+    def _discovery_payload(
         self,
         component,
         device_id,
@@ -305,58 +606,263 @@ class MQTTHandler:
         if icon:
             payload["icon"] = icon
 
-        self._publish(self.client, discovery_topic, json.dumps(payload), retain=True)
+        return discovery_topic, payload
 
     def publish_values(self, data):
         """Publish ECU data to MQTT"""
         _LOGGER.debug("Start MQTT publish")
+        if self.spool is not None and not self._is_connected():
+            self.spool_values(data)
+            return False
 
         retry_count = 0
-        while (self.client is None or not self.client.is_connected()) and retry_count < _MAX_RETRY:
+        while not self._is_connected() and retry_count < _MAX_RETRY:
             _LOGGER.info("MQTT client not connected...")
             retry_count += 1
             time.sleep(5)
 
+        start = time.perf_counter()
+        if self.spool is not None and not self.drain_spool():
+            # Spooled messages must be published first
+            self.spool_values(data)
+            return False
+        infos, cached = self._publish_data(data, retry_count)
+        delivered = self.wait_for_delivery(infos)
+        self._cache_delivered(cached)
+        self._record_publish_metrics(start)
+        return delivered
+
+    async def async_publish_values(self, data):
+        """Publish ECU data to MQTT, without blocking the event loop while waiting for the broker"""
+        _LOGGER.debug("Start MQTT publish")
+        if self.spool is not None and not self._is_connected():
+            self.spool_values(data)
+            return False
+
+        retry_count = 0
+        while not self._is_connected() and retry_count < _MAX_RETRY:
+            _LOGGER.info("MQTT client not connected...")
+            retry_count += 1
+            await asyncio.sleep(5)
+
+        start = time.perf_counter()
+        # Acknowledgements are received by the network thread, wait for them out of the loop
+        loop = asyncio.get_running_loop()
+        if self.spool is not None and not await loop.run_in_executor(None, self.drain_spool):
+            # Spooled messages must be published first
+            self.spool_values(data)
+            return False
+        infos, cached = self._publish_data(data, retry_count)
+        delivered = await loop.run_in_executor(None, self.wait_for_delivery, infos)
+        self._cache_delivered(cached)
+        self._record_publish_metrics(start)
+        return delivered
+
+    def spool_values(self, data):
+        """Keep the ECU data in the spool, with their timestamp, until the broker is back"""
+        timestamp = data.get("timestamp")
+        messages = []
+        for topic, payload in self._build_payloads(data).items():
+            if timestamp is not None:
+                # Published later, tell when the values were read
+                payload = {**payload, "timestamp": timestamp}
+            messages.append((topic, self.serializer.dumps(payload)))
+        dropped = self.spool.append(messages)
+        _LOGGER.warning(
+            "MQTT broker not available, %s messages spooled (%s in the spool)",
+            len(messages),
+            len(self.spool),
+        )
+        if dropped:
+            _LOGGER.warning("MQTT spool full, %s oldest messages dropped", dropped)
+
+    def drain_spool(self):
+        """Publish the spooled messages in order, return False if some couldn't be delivered
+
+        Messages are removed from the spool once acknowledged, at most spool_drain_rate
+        messages are published per second (no limit if 0). Only one update drains the spool,
+        False is returned to the others while it is drained.
+        """
+        if not self._drain_lock.acquire(blocking=False):
+            return False
+        try:
+            return self._drain_spool()
+        finally:
+            self._drain_lock.release()
+
+    def _drain_spool(self):
+        rate = self.mqtt_config.spool_drain_rate
+        start = time.monotonic()
+        published = 0
+        while len(self.spool) > 0:
+            if not self._is_connected():
+                return False
+            batch = self.spool.peek(_SPOOL_BATCH)
+            infos = []
+            for _, topic, payload in batch:
+                if rate > 0:
+                    delay = start + published / rate - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                info = self._publish(self.client, topic, payload)
+                if info is None:
+                    return False
+                infos.append(info)
+                published += 1
+            if not self.wait_for_delivery(infos):
+                return False
+            self.spool.remove(batch[-1][0])
+        if published:
+            _LOGGER.info("%s spooled MQTT messages published", published)
+        return True
+
+    def _record_publish_metrics(self, start):
+        """Record the duration of a publication started at start and the publish stats"""
+        if not METRICS.enabled:
+            return
+        METRICS.observe("aps_mqtt_publish_seconds", time.perf_counter() - start)
+        stats = self.publish_stats
+        METRICS.set("aps_mqtt_messages_sent_total", stats.sent)
+        METRICS.set("aps_mqtt_messages_acknowledged_total", stats.acknowledged)
+        METRICS.set("aps_mqtt_messages_dropped_total", stats.dropped)
+        METRICS.set("aps_mqtt_messages_unacknowledged_total", stats.unacknowledged)
+        if stats.last_latency is not None:
+            METRICS.set("aps_mqtt_ack_latency_seconds", stats.last_latency)
+
+    def _is_connected(self):
+        return self.client is not None and self.client.is_connected()
+
+    def _publish_data(self, data, retry_count):
+        """Publish the ECU data, return (infos of the sent messages, cached)
+
+        cached are the (topic, payload, info) to record in the payload cache once delivered.
+        """
         if retry_count == _MAX_RETRY:
             _LOGGER.warning("MQTT values not published")
             raise ConnectionError("Can't connect to broker")
 
         self.publish_discovery_messages(data)
 
-        for topic, value in self._parse_data(data).items():
-            self._publish(self.client, topic, value)
-        _LOGGER.debug("MQTT values published")
+        infos = []
+        payloads = data.get("payloads")
+        if payloads is not None and self.payload_cache is None:
+            # Serialized by a decoding worker
+            for topic, payload in payloads.items():
+                info = self._publish(self.client, topic, payload)
+                if info is not None:
+                    infos.append(info)
+            _LOGGER.debug("MQTT values published")
+            return infos, []
+
+        cached = []
+        skipped = 0
+        for topic, payload in self._build_payloads(data).items():
+            if self.payload_cache is not None and not self.payload_cache.should_publish(
+                topic, payload
+            ):
+                skipped += 1
+                continue
+            info = self._publish(self.client, topic, self.serializer.dumps(payload))
+            if info is not None:
+                infos.append(info)
+                if self.payload_cache is not None:
+                    cached.append((topic, payload, info))
+        _LOGGER.debug("MQTT values published, %s unchanged skipped", skipped)
+        return infos, cached
+
+    def _cache_delivered(self, cached):
+        """Record the delivered payloads in the payload cache, the others are published again"""
+        for topic, payload, info in cached:
+            if _is_published(info):
+                self.payload_cache.published(topic, payload)
 
     def _parse_data(self, data):
-        output = {}
-        ecu_id = data["ecu_id"]
-        ecu_topic_base = self.topic_prefix + "aps/" + str(ecu_id)
-        ecu_payload = {
-            "current_power": data["current_power"],
-            "today_energy": data["today_energy"],
-            "lifetime_energy": data["lifetime_energy"],
+        return {
+            topic: self.serializer.dumps(payload)
+            for topic, payload in self._build_payloads(data).items()
         }
-        output[ecu_topic_base] = json.dumps(ecu_payload)
 
-        for inverter in data["inverters"]:
-            inverter_uid = str(inverter["uid"])
-            inverter_topic_base = ecu_topic_base + "/" + inverter_uid
-            inverter_payload = {
-                "online": inverter["online"],
-            }
-            if inverter["online"]:
-                inverter_payload["signal"] = inverter["signal"]
-                inverter_payload["temperature"] = inverter["temperature"]
-                inverter_payload["frequency"] = inverter["frequency"]
+    def _build_payloads(self, data):
+        return build_payloads(data, self.topic_prefix, self.mqtt_config.payload_mode)
+
+    def worker_payload_options(self):
+        """Options to build the serialized payloads in a decoding worker, None if they can't be
+
+        Payloads compared to the published ones must be built here.
+        """
+        if self.payload_cache is not None:
+            return None
+        return (self.topic_prefix, self.mqtt_config.payload_mode, self.mqtt_config.payload_encoding)
+
+
+def _is_published(info):
+    try:
+        return info.is_published()
+    except (ValueError, RuntimeError):
+        return False
+
+
+def build_payloads(data, topic_prefix, payload_mode):
+    """Payload of each topic of an ECU update, in the given payload mode"""
+    output = {}
+    ecu_id = data["ecu_id"]
+    ecu_topic_base = topic_prefix + "aps/" + str(ecu_id)
+    ecu_payload = {
+        "current_power": data["current_power"],
+        "today_energy": data["today_energy"],
+        "lifetime_energy": data["lifetime_energy"],
+    }
+    output[ecu_topic_base] = ecu_payload
+    if payload_mode != "topics":
+        # Whole ECU update in a single document
+        inverters_payload = {}
+        ecu_payload["inverters"] = inverters_payload
+
+    snapshot = data.get("snapshot")
+    if snapshot is not None:
+        # Inverter totals computed for all the inverters at once, with the types of sum and mean
+        inverters_power = [int(power) for power in snapshot.inverter_power().tolist()]
+        inverters_voltage = [
+            int(voltage) if voltage.is_integer() else voltage
+            for voltage in snapshot.inverter_voltage().tolist()
+        ]
+
+    for index, inverter in enumerate(data["inverters"]):
+        inverter_uid = str(inverter["uid"])
+        inverter_topic_base = ecu_topic_base + "/" + inverter_uid
+        inverter_payload = {
+            "online": inverter["online"],
+        }
+        if inverter["online"]:
+            inverter_payload["signal"] = inverter["signal"]
+            inverter_payload["temperature"] = inverter["temperature"]
+            inverter_payload["frequency"] = inverter["frequency"]
+            if snapshot is not None:
+                inverter_payload["power"] = inverters_power[index]
+                inverter_payload["voltage"] = inverters_voltage[index]
+            else:
                 inverter_payload["power"] = sum(inverter["power"])
                 inverter_payload["voltage"] = mean(inverter["voltage"])
 
-                for panel_index, panel_power in enumerate(inverter["power"], start=1):
-                    inverter_payload[f"panel_{panel_index}_power"] = panel_power
+            for panel_index, panel_power in enumerate(inverter["power"], start=1):
+                inverter_payload[f"panel_{panel_index}_power"] = panel_power
+
+            for panel_index, panel_voltage in enumerate(inverter["voltage"], start=1):
+                inverter_payload[f"panel_{panel_index}_voltage"] = panel_voltage
+
+            if "avg_power" in inverter:
+                inverter_payload["avg_power"] = inverter["avg_power"]
+                inverter_payload["peak_power"] = inverter["peak_power"]
 
-                for panel_index, panel_voltage in enumerate(inverter["voltage"], start=1):
-                    inverter_payload[f"panel_{panel_index}_voltage"] = panel_voltage
+        if "today_energy" in inverter:
+            # Integrated energy, also known while the inverter is offline
+            inverter_payload["today_energy"] = inverter["today_energy"]
+            for panel_index, panel_energy in enumerate(inverter["panel_today_energy"], start=1):
+                inverter_payload[f"panel_{panel_index}_today_energy"] = panel_energy
 
-            output[inverter_topic_base] = json.dumps(inverter_payload)
+        if payload_mode != "aggregated":
+            output[inverter_topic_base] = inverter_payload
+        if payload_mode != "topics":
+            inverters_payload[inverter_uid] = inverter_payload
 
-        return output
+    return output
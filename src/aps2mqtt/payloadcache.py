@@ -0,0 +1,58 @@
+"""Cache of the last published payloads, to only publish the ones that changed"""
+
+import time
+from numbers import Number
+
+
+class PayloadCache:
+    """Last published payload per topic
+
+    A payload is published again if one of its fields changed by more than its deadband, or
+    if the topic wasn't published for refresh_interval seconds.
+    Deadbands are looked up by field name, then by the last part of the field name, so a
+    "voltage" deadband also applies to "panel_1_voltage".
+    """
+
+    def __init__(self, deadbands=None, refresh_interval=3600):
+        self.deadbands = deadbands or {}
+        self.refresh_interval = refresh_interval
+        self.cache = {}
+
+    def clear(self):
+        """Forget every published payload, the next ones will all be published"""
+        self.cache.clear()
+
+    def should_publish(self, topic, payload, now=None):
+        """Whether the payload differs enough from the last one published on the topic"""
+        entry = self.cache.get(topic)
+        if entry is None:
+            return True
+        published_payload, published_time = entry
+        now = time.monotonic() if now is None else now
+        if now - published_time >= self.refresh_interval:
+            return True
+        return self._changed(published_payload, payload)
+
+    def published(self, topic, payload, now=None):
+        """Record the payload published on the topic"""
+        self.cache[topic] = (payload, time.monotonic() if now is None else now)
+
+    def _changed(self, old, new, key=None):
+        if isinstance(old, dict) and isinstance(new, dict):
+            if old.keys() != new.keys():
+                return True
+            return any(self._changed(old[field], new[field], field) for field in new)
+        if _is_number(old) and _is_number(new):
+            return abs(new - old) > self._deadband(key)
+        return old != new
+
+    def _deadband(self, key):
+        if key is None:
+            return 0
+        if key in self.deadbands:
+            return self.deadbands[key]
+        return self.deadbands.get(str(key).rsplit("_", 1)[-1], 0)
+
+
+def _is_number(value):
+    return isinstance(value, Number) and not isinstance(value, bool)
@@ -0,0 +1,73 @@
+"""Predict when the ECU refreshes its data, from the timestamps of the previous data"""
+
+from collections import deque
+from datetime import timedelta
+from statistics import median
+
+
+class RefreshPredictor:
+    """Learn the ECU refresh period to poll it just after its next refresh
+
+    The period is the median of the last intervals between two data timestamps, intervals
+    longer than max_period (missed refreshes, night) are ignored. Polls returning the data
+    already received and failed polls are retried with an exponential backoff.
+    """
+
+    def __init__(
+        self,
+        default_period=300,
+        margin=30,
+        max_period=900,
+        history=8,
+        stale_delay=30,
+        error_delay=60,
+        max_error_delay=600,
+    ):
+        self.default_period = default_period
+        self.margin = margin
+        self.max_period = max_period
+        self.stale_delay = stale_delay
+        self.error_delay = error_delay
+        self.max_error_delay = max_error_delay
+        self.intervals = deque(maxlen=history)
+        self.last_timestamp = None
+        self.stale_count = 0
+        self.error_count = 0
+
+    def period(self):
+        """Learned refresh period in seconds, the default one until an interval is known"""
+        return median(self.intervals) if self.intervals else self.default_period
+
+    def is_stale(self, timestamp):
+        """Whether data with this timestamp have already been received"""
+        # Earlier timestamps are new data, the ECU clock may have been set back
+        return timestamp == self.last_timestamp
+
+    def stale(self):
+        """Record a poll returning data already received"""
+        self.error_count = 0
+        self.stale_count += 1
+
+    def data_received(self, timestamp):
+        """Record the timestamp of new data"""
+        if self.last_timestamp is not None:
+            interval = (timestamp - self.last_timestamp).total_seconds()
+            if 0 < interval <= self.max_period:
+                self.intervals.append(interval)
+        self.last_timestamp = timestamp
+        self.error_count = 0
+        self.stale_count = 0
+
+    def error(self):
+        """Record a failed poll"""
+        self.error_count += 1
+
+    def next_update(self, now):
+        """Time of the next poll"""
+        if self.error_count:
+            delay = self.error_delay * 2 ** (self.error_count - 1)
+            return now + timedelta(seconds=min(delay, self.max_error_delay))
+        if self.stale_count or self.last_timestamp is None:
+            delay = self.stale_delay * 2 ** max(self.stale_count - 1, 0)
+            return now + timedelta(seconds=min(delay, self.period()))
+        return self.last_timestamp + timedelta(seconds=self.period() + self.margin)
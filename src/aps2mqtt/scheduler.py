@@ -0,0 +1,77 @@
+"""Run jobs at deadlines, sleeping until the earliest one"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """Priority queue of deadlines on the monotonic clock
+
+    Jobs are coroutine functions, run as tasks when their deadline is reached. A job keeps
+    running by scheduling itself again. A random jitter of up to jitter seconds is added to
+    every deadline, so jobs scheduled at the same time don't all run at once.
+    """
+
+    def __init__(self, jitter=0, clock=time.monotonic):
+        self.jitter = jitter
+        self.clock = clock
+        self._queue = []
+        # Keep the insertion order of jobs with the same deadline
+        self._counter = itertools.count()
+        self._tasks = set()
+        self._wakeup = None
+
+    def __len__(self):
+        return len(self._queue)
+
+    def schedule_at(self, deadline, job):
+        """Run the job at the given monotonic clock time"""
+        if self.jitter:
+            deadline += random.uniform(0, self.jitter)
+        heapq.heappush(self._queue, (deadline, next(self._counter), job))
+        if self._wakeup is not None:
+            # The new deadline may be earlier than the awaited one
+            self._wakeup.set()
+        return deadline
+
+    def schedule_in(self, delay, job):
+        """Run the job in delay seconds"""
+        return self.schedule_at(self.clock() + delay, job)
+
+    def next_deadline(self):
+        """Earliest deadline, None if no job is scheduled"""
+        return self._queue[0][0] if self._queue else None
+
+    async def run(self):
+        """Run the jobs until none is scheduled or running"""
+        self._wakeup = asyncio.Event()
+        try:
+            while self._queue or self._tasks:
+                self._wakeup.clear()
+                delay = self._queue[0][0] - self.clock() if self._queue else None
+                if delay is None or delay > 0:
+                    # Sleep until the deadline, a new job or the end of a running one
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                _, _, job = heapq.heappop(self._queue)
+                task = asyncio.create_task(job())
+                self._tasks.add(task)
+                task.add_done_callback(self._job_done)
+        finally:
+            self._wakeup = None
+
+    def _job_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            _LOGGER.error("Scheduled job failed", exc_info=task.exception())
+        if self._wakeup is not None:
+            self._wakeup.set()
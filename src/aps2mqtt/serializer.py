@@ -0,0 +1,84 @@
+"""Encode MQTT payloads, as JSON or as a compact binary encoding
+
+The optional encoding packages are only imported by the serializer using them.
+"""
+
+import io
+import json
+
+
+class JSONSerializer:
+    """Encode payloads as JSON, with orjson when installed"""
+
+    name = "json"
+
+    def __init__(self):
+        try:
+            import orjson  # pylint: disable=import-outside-toplevel
+
+            self._orjson = orjson
+        except ImportError:  # orjson is optional, JSON is encoded with the json module without it
+            self._orjson = None
+        # Encoder built once instead of on every json.dumps call with options
+        self._encoder = json.JSONEncoder(separators=(",", ":"))
+
+    def dumps(self, payload):
+        """Encode the payload to bytes"""
+        if self._orjson is not None:
+            return self._orjson.dumps(payload)
+        return self._encoder.encode(payload).encode()
+
+
+class MsgPackSerializer:
+    """Encode payloads with MessagePack"""
+
+    name = "msgpack"
+
+    def __init__(self):
+        try:
+            import msgpack  # pylint: disable=import-outside-toplevel
+        except ImportError as err:
+            raise ValueError("msgpack payload encoding requires the msgpack package") from err
+        # The packer keeps its internal buffer between payloads
+        self._packer = msgpack.Packer(autoreset=True)
+
+    def dumps(self, payload):
+        """Encode the payload to bytes"""
+        return self._packer.pack(payload)
+
+
+class CBORSerializer:
+    """Encode payloads with CBOR"""
+
+    name = "cbor"
+
+    def __init__(self):
+        try:
+            import cbor2  # pylint: disable=import-outside-toplevel
+        except ImportError as err:
+            raise ValueError("cbor payload encoding requires the cbor2 package") from err
+        self._buffer = io.BytesIO()
+        self._encoder = cbor2.CBOREncoder(self._buffer)
+
+    def dumps(self, payload):
+        """Encode the payload to bytes"""
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._encoder.encode(payload)
+        return self._buffer.getvalue()
+
+
+_SERIALIZERS = {
+    JSONSerializer.name: JSONSerializer,
+    MsgPackSerializer.name: MsgPackSerializer,
+    CBORSerializer.name: CBORSerializer,
+}
+
+PAYLOAD_ENCODINGS = tuple(_SERIALIZERS)
+
+
+def get_serializer(encoding="json"):
+    """Return a serializer for the given encoding, raise ValueError if it can't be used"""
+    if encoding not in _SERIALIZERS:
+        raise ValueError(f"Unknown payload encoding {encoding}, must be one of {PAYLOAD_ENCODINGS}")
+    return _SERIALIZERS[encoding]()
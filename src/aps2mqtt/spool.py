@@ -0,0 +1,67 @@
+"""Keep the messages on disk while the broker can't be reached"""
+
+import logging
+import sqlite3
+import threading
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Spool:
+    """SQLite queue of serialized messages, read back in the order they were added
+
+    At most max_messages are kept, the oldest ones are dropped first.
+    """
+
+    def __init__(self, path, max_messages=100000):
+        self.path = path
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        # Drained from an executor thread, the lock serializes the accesses
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS messages "
+                "(id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT NOT NULL, payload BLOB)"
+            )
+        self._count = self._db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        if self._count:
+            _LOGGER.info("%s messages in the spool %s", self._count, path)
+
+    def __len__(self):
+        return self._count
+
+    def append(self, messages):
+        """Add (topic, payload) messages, return the number of old messages dropped"""
+        messages = list(messages)
+        with self._lock, self._db:
+            self._db.executemany("INSERT INTO messages (topic, payload) VALUES (?, ?)", messages)
+            self._count += len(messages)
+            dropped = max(self._count - self.max_messages, 0)
+            if dropped:
+                self._db.execute(
+                    "DELETE FROM messages WHERE id IN "
+                    "(SELECT id FROM messages ORDER BY id LIMIT ?)",
+                    (dropped,),
+                )
+                self._count -= dropped
+        return dropped
+
+    def peek(self, limit):
+        """Oldest (id, topic, payload) messages, left in the spool"""
+        with self._lock:
+            return self._db.execute(
+                "SELECT id, topic, payload FROM messages ORDER BY id LIMIT ?", (limit,)
+            ).fetchall()
+
+    def remove(self, last_id):
+        """Remove the messages up to last_id, once they have been published"""
+        with self._lock, self._db:
+            removed = self._db.execute("DELETE FROM messages WHERE id <= ?", (last_id,)).rowcount
+            self._count -= removed
+
+    def close(self):
+        """Close the database"""
+        with self._lock:
+            self._db.close()
@@ -1,6 +1,38 @@
+import asyncio
+import socket
+import time
 import unittest
 from unittest.mock import patch, MagicMock, call
-from aps2mqtt.apsystems.APSystemsSocket import APSystemsSocket, APSystemsInvalidData
+from aps2mqtt.apsystems import frames
+from aps2mqtt.apsystems.APSystemsSocket import APSystemsSocket, APSystemsInvalidData, HexFrame
+from aps2mqtt.metrics import Metrics
+
+
+class ChunkedSocket:
+    """Fake socket returning the given chunks, one per recv_into call"""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.timeouts = []
+
+    def settimeout(self, timeout):
+        self.timeouts.append(timeout)
+
+    def recv_into(self, buffer):
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        if len(chunk) > len(buffer):
+            self.chunks.insert(0, chunk[len(buffer):])
+            chunk = chunk[: len(buffer)]
+        buffer[: len(chunk)] = chunk
+        return len(chunk)
+
+
+def make_frame(body):
+    """Build a frame with a valid length field around the given body"""
+    length = 9 + len(body) + 4
+    return b"APS11" + f"{length - 1:04d}".encode() + body + b"END\n"
 
 class TestAPSystemsSocket(unittest.TestCase):
 
@@ -30,29 +62,21 @@ class TestAPSystemsSocket(unittest.TestCase):
         self.assertEqual(self.socket.qty_of_online_inverters, 3)
         mock_check_checksum.assert_called_once_with(b'dummy_data', "ECU Query")
 
-    @patch.object(APSystemsSocket, 'aps_str')
-    @patch.object(APSystemsSocket, 'aps_int')
-    @patch.object(APSystemsSocket, 'aps_double')
-    @patch.object(APSystemsSocket, 'aps_uid')
-    @patch.object(APSystemsSocket, 'aps_short')
-    @patch.object(APSystemsSocket, 'aps_timestamp')
-    @patch.object(APSystemsSocket, 'check_ecu_checksum')
     @patch.object(APSystemsSocket, 'process_signal_data')
-    def test_process_inverter_data(self, mock_process_signal_data, mock_check_checksum, mock_aps_timestamp, mock_aps_short, mock_aps_uid, mock_aps_double, mock_aps_int, mock_aps_str):
+    def test_process_inverter_data(self, mock_process_signal_data):
         # Arrange
-        self.socket.inverter_raw_data = b'dummy_data'
+        self.socket.inverter_raw_data = frames.inverter_frame(
+            [frames.inverter_record("123456789012", "01", frequency=60, temperature=100, power=[200, 150], voltage=[240, 240])],
+            timestamp="2025-07-20 12:00:00",
+        )
         self.socket.qty_of_inverters = 1
-        mock_aps_str.side_effect = ["0002", "00", "01", "01"]
-        mock_aps_int.side_effect = [1, 600, 200, 150, 240, 150, 240]
-        mock_aps_uid.return_value = "123456789012"
-        mock_aps_short.return_value = 1
-        mock_aps_timestamp.return_value = "2025-07-20 12:00:00"
         mock_process_signal_data.return_value = {"123456789012": 80}
 
         # Act
         data = self.socket.process_inverter_data()
 
         # Assert
+        self.assertEqual(data["timestamp"], "2025-07-20 12:00:00")
         self.assertIn("inverters", data)
         self.assertEqual(len(data["inverters"]), 1)
         inverter = data["inverters"][0]
@@ -61,12 +85,137 @@ class TestAPSystemsSocket(unittest.TestCase):
         self.assertEqual(inverter["signal"], 80)
         self.assertEqual(inverter["frequency"], 60.0)
         self.assertEqual(inverter["temperature"], 100)
-        mock_check_checksum.assert_called_once_with(b'dummy_data', "Inverter data")
+        self.assertEqual(inverter["power"], [200, 150])
+        self.assertEqual(inverter["voltage"], [240, 240])
+
+    def test_process_inverter_data_all_types(self):
+        uids = [frames.inverter_uid(i) for i in range(5)]
+        self.socket.inverter_raw_data = frames.inverter_frame(
+            [
+                frames.inverter_record(uids[0], "01"),
+                frames.inverter_record(uids[1], "02", online=False),
+                frames.inverter_record(uids[2], "03", power=[1, 2, 3, 4], voltage=[235]),
+                frames.inverter_record(uids[3], "04"),
+                frames.inverter_record(uids[4], "05"),
+            ]
+        )
+        self.socket.inverter_raw_signal = frames.signal_frame([(uid, 255) for uid in uids])
+        self.socket.qty_of_inverters = 5
+
+        inverters = self.socket.process_inverter_data()["inverters"]
+
+        self.assertEqual([inv["model"] for inv in inverters], [
+            "YC600/DS3D/DS3-H/DS3/DS3-L", "YC1000/QT2", "QS1",
+            "YC600/DS3D/DS3-H/DS3/DS3-L", "YC600/DS3D/DS3-H/DS3/DS3-L",
+        ])
+        self.assertEqual(inverters[1]["power"], [100, 101, 102, 103])
+        self.assertEqual(inverters[1]["voltage"], [230, 231, 232])
+        self.assertNotIn("temperature", inverters[1])
+        self.assertEqual(inverters[2]["power"], [1, 2, 3, 4])
+        self.assertEqual(inverters[2]["voltage"], [235])
+        self.assertEqual([inv["signal"] for inv in inverters], [100] * 5)
+
+    def test_process_inverter_data_unknown_type(self):
+        unknown = bytearray(frames.inverter_record(frames.inverter_uid(1), "01"))
+        unknown[7:9] = b"42"
+        self.socket.inverter_raw_data = frames.inverter_frame(
+            [frames.inverter_record(frames.inverter_uid(0), "01"), bytes(unknown)]
+        )
+        self.socket.inverter_raw_signal = frames.signal_frame([])
+
+        self.socket.ecu_id = "216200001234"
+        self.socket.current_power = 450
+        with self.assertLogs("aps2mqtt.apsystems.APSystemsSocket", level="WARNING"):
+            data = self.socket.collect_data()
+
+        # The ECU data are kept, the update doesn't fail
+        self.assertEqual(data["ecu_id"], "216200001234")
+        self.assertEqual(data["current_power"], 450)
+
+        # Decoded up to the unknown record
+        self.assertEqual([inverter["uid"] for inverter in data["inverters"]], [frames.inverter_uid(0)])
+        error = self.socket.errors[-1]
+        self.assertIn("Unsupported inverter type '42'", error.message)
+        self.assertIs(error.data, self.socket.inverter_raw_data)
+
+    def test_errors_bounded(self):
+        for index in range(100):
+            self.socket.add_error(f"error {index}")
+
+        self.assertEqual(len(self.socket.errors), 50)
+        self.assertEqual(self.socket.errors[0].message, "error 50")
+        self.assertTrue(str(self.socket.errors[-1]).endswith("] error 99"))
+
+    def test_error_frame_formatted_when_read(self):
+        frame = MagicMock()
+        frame.hex.return_value = "415053"
+
+        error = self.socket.add_error("invalid frame", frame)
+
+        frame.hex.assert_not_called()
+        self.assertTrue(str(error).endswith("] invalid frame data=415053"))
+        self.assertEqual(error.frame_hex(), "415053")
+        self.assertIsNone(self.socket.add_error("no frame").frame_hex())
+
+    def test_hex_frame(self):
+        self.assertEqual("%s" % HexFrame(b"APS"), "415053")
+
+    def test_process_ecu_data_frame(self):
+        self.socket.ecu_raw_data = frames.ecu_frame(
+            ecu_id="216200000042", lifetime_energy=1234.5, current_power=420, today_energy=3.21,
+            qty_of_inverters=12, qty_of_online_inverters=10, firmware="ECU_C_2.0", timezone="Etc/GMT-8",
+        )
+
+        self.socket.process_ecu_data()
+
+        self.assertEqual(self.socket.ecu_id, "216200000042")
+        self.assertEqual(self.socket.lifetime_energy, 1234.5)
+        self.assertEqual(self.socket.current_power, 420)
+        self.assertEqual(self.socket.today_energy, 3.21)
+        self.assertEqual(self.socket.qty_of_inverters, 12)
+        self.assertEqual(self.socket.qty_of_online_inverters, 10)
+        self.assertEqual(self.socket.firmware, "ECU_C_2.0")
+        self.assertEqual(self.socket.timezone, "Etc/GMT-8")
+
+    def test_aps_int_out_of_range(self):
+        with self.assertRaises(APSystemsInvalidData):
+            self.socket.aps_int(b"APS", 2)
 
     def test_check_ecu_checksum_invalid(self):
         with self.assertRaises(APSystemsInvalidData):
             self.socket.check_ecu_checksum(b'APS1100160001', "test")
 
+    def test_checksum_metrics(self):
+        metrics = Metrics()
+        metrics.enable()
+        with patch("aps2mqtt.apsystems.APSystemsSocket.METRICS", metrics):
+            with self.assertRaises(APSystemsInvalidData):
+                self.socket.check_ecu_checksum(b'APS1100160001', "test")
+
+        metrics_text = metrics.render()
+        self.assertIn('aps_checksum_failures_total{ecu="127.0.0.1"} 1', metrics_text)
+        self.assertIn('aps_errors_total{ecu="127.0.0.1"} 1', metrics_text)
+
+    def test_send_read_from_socket_metrics(self):
+        metrics = Metrics()
+        metrics.enable()
+        reply = make_frame(b"0001")
+        self.socket.wait_ready = True
+        self.socket.sock = ChunkedSocket([reply])
+        self.socket.sock.sendall = MagicMock()
+        with patch("aps2mqtt.apsystems.APSystemsSocket.METRICS", metrics), \
+                patch.object(self.socket, "wait_readable"):
+            self.socket.send_read_from_socket(self.socket.ecu_query)
+            self.socket.sock.recv_into = MagicMock(side_effect=socket.timeout("timed out"))
+            self.socket.sock.close = MagicMock()
+            with self.assertRaises(APSystemsInvalidData):
+                self.socket.send_read_from_socket(self.socket.ecu_query)
+
+        metrics_text = metrics.render()
+        self.assertIn('aps_command_send_seconds_count{command="ecu",ecu="127.0.0.1"} 1', metrics_text)
+        self.assertIn('aps_command_receive_seconds_count{command="ecu",ecu="127.0.0.1"} 1', metrics_text)
+        self.assertIn('aps_timeouts_total{ecu="127.0.0.1"} 1', metrics_text)
+
     @patch.object(APSystemsSocket, 'open_socket')
     @patch.object(APSystemsSocket, 'close_socket')
     @patch.object(APSystemsSocket, 'send_read_from_socket')
@@ -95,5 +244,202 @@ class TestAPSystemsSocket(unittest.TestCase):
         mock_process_inverter_data.assert_called_once()
         self.assertIn("ecu_id", data)
 
+    def test_read_frame_fragmented(self):
+        frame = make_frame(b"0002" + b"x" * 5000)
+        chunks = [frame[:4], frame[4:12]] + [frame[i : i + 1000] for i in range(12, len(frame), 1000)]
+        self.socket.sock = ChunkedSocket(chunks)
+
+        data = self.socket.read_frame(time.monotonic() + 10)
+
+        self.assertEqual(data, frame)
+        self.assertTrue(self.socket.check_ecu_checksum(data, "test"))
+
+    def test_read_frame_stops_at_announced_length(self):
+        frame = make_frame(b"0001")
+        self.socket.sock = ChunkedSocket([frame + b"APS11trailing"])
+
+        self.assertEqual(self.socket.read_frame(time.monotonic() + 10), frame)
+
+    def test_read_frame_invalid_length_uses_suffix(self):
+        frame = b"APS11abcd0001END\n"
+        self.socket.sock = ChunkedSocket([frame[:10], frame[10:]])
+
+        self.assertEqual(self.socket.read_frame(time.monotonic() + 10), frame)
+
+    def test_read_frame_connection_closed(self):
+        frame = make_frame(b"0001")
+        self.socket.sock = ChunkedSocket([frame[:12]])
+
+        self.assertEqual(self.socket.read_frame(time.monotonic() + 10), frame[:12])
+
+    def test_read_frame_deadline(self):
+        self.socket.sock = ChunkedSocket([b"APS11"])
+
+        with self.assertRaises(socket.timeout):
+            self.socket.read_frame(time.monotonic() - 1)
+
+    def test_send_read_from_socket_wait_ready(self):
+        frame = make_frame(b"0001")
+        ecu_side, self.socket.sock = socket.socketpair()
+        self.socket.socket_open = True
+        self.socket.wait_ready = True
+        ecu_side.sendall(frame)
+
+        with patch("aps2mqtt.apsystems.APSystemsSocket.time.sleep") as mock_sleep:
+            data = self.socket.send_read_from_socket(self.socket.ecu_query)
+
+        self.assertEqual(data, frame)
+        self.assertEqual(ecu_side.recv(1024), self.socket.ecu_query.encode())
+        mock_sleep.assert_not_called()
+        ecu_side.close()
+        self.socket.sock.close()
+
+    def test_wait_readable_deadline(self):
+        ecu_side, self.socket.sock = socket.socketpair()
+
+        with self.assertRaises(socket.timeout):
+            self.socket.wait_readable(time.monotonic() + 0.01)
+        ecu_side.close()
+        self.socket.sock.close()
+
+    @patch("aps2mqtt.apsystems.APSystemsSocket.time.sleep")
+    def test_wait_command_gap(self, mock_sleep):
+        self.socket.command_gap = 2
+        self.socket.wait_command_gap()
+        mock_sleep.assert_not_called()
+
+        self.socket.last_command_time = time.monotonic()
+        self.socket.wait_command_gap()
+        self.assertAlmostEqual(mock_sleep.call_args[0][0], 2, delta=0.1)
+
+    def _fake_open_socket(self):
+        self.socket.socket_open = True
+
+    def _fake_close_socket(self):
+        self.socket.socket_open = False
+
+    def test_send_command_persistent_connection(self):
+        self.socket.persistent = True
+        self.socket.firmware = "ECU_R_1.2.22"
+        with patch.object(self.socket, "open_socket", side_effect=self._fake_open_socket) as mock_open, \
+                patch.object(self.socket, "close_socket") as mock_close, \
+                patch.object(self.socket, "send_read_from_socket", return_value=b"reply"):
+            for _ in range(3):
+                self.assertEqual(self.socket.send_command("cmd"), b"reply")
+
+        mock_open.assert_called_once()
+        mock_close.assert_not_called()
+        self.assertTrue(self.socket.persistent_support["ECU_R_1.2.22"])
+
+    def test_send_command_persistent_connection_unsupported(self):
+        self.socket.persistent = True
+        self.socket.firmware = "ECU_C_1.0"
+        self.socket.socket_open = True
+
+        replies = [APSystemsInvalidData("connection reset"), b"reply", b"reply"]
+
+        def send_read(cmd):
+            reply = replies.pop(0)
+            if isinstance(reply, Exception):
+                self.socket.socket_open = False
+                raise reply
+            return reply
+
+        with patch.object(self.socket, "open_socket", side_effect=self._fake_open_socket) as mock_open, \
+                patch.object(self.socket, "close_socket", side_effect=self._fake_close_socket) as mock_close, \
+                patch.object(self.socket, "send_read_from_socket", side_effect=send_read):
+            self.assertEqual(self.socket.send_command("cmd"), b"reply")
+            self.assertFalse(self.socket.persistent_support["ECU_C_1.0"])
+            self.assertEqual(self.socket.send_command("cmd"), b"reply")
+
+        self.assertEqual(mock_open.call_count, 2)
+        self.assertEqual(mock_close.call_count, 2)
+
+    @patch("aps2mqtt.apsystems.APSystemsSocket.time.sleep")
+    def test_reconnect_backoff(self, mock_sleep):
+        with patch.object(self.socket, "open_socket", side_effect=APSystemsInvalidData("refused")):
+            for _ in range(3):
+                with self.assertRaises(APSystemsInvalidData):
+                    self.socket.reconnect()
+        self.assertEqual(self.socket.reconnect_delay, 4)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+        with patch.object(self.socket, "open_socket", side_effect=self._fake_open_socket):
+            self.socket.reconnect()
+        self.assertEqual(self.socket.reconnect_delay, self.socket.reconnect_min_delay)
+        self.assertIsNone(self.socket.next_connect_time)
+
+
+class TestAsyncAPSystemsSocket(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.replies = []
+        self.commands = []
+        self.hang = False
+        self.server = await asyncio.start_server(self._handle_client, "127.0.0.1", 0)
+        port = self.server.sockets[0].getsockname()[1]
+        self.socket = APSystemsSocket("127.0.0.1", port, timeout=2, wait_ready=True)
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _handle_client(self, reader, writer):
+        while self.replies:
+            self.commands.append(await reader.readuntil(b"END\n"))
+            reply = self.replies.pop(0)
+            # Send the reply in two parts to check the frame is reassembled
+            writer.write(reply[:7])
+            await writer.drain()
+            writer.write(reply[7:])
+            await writer.drain()
+        if self.hang:
+            await asyncio.sleep(1)
+        writer.close()
+
+    async def test_async_send_command(self):
+        frame = make_frame(b"0001")
+        self.replies = [frame]
+
+        data = await self.socket.async_send_command(self.socket.ecu_query)
+
+        self.assertEqual(data, frame)
+        self.assertEqual(self.commands, [self.socket.ecu_query.encode()])
+        self.assertFalse(self.socket.socket_open)
+
+    async def test_async_send_command_persistent(self):
+        self.socket.persistent = True
+        self.replies = [make_frame(b"0001"), make_frame(b"0002")]
+
+        self.assertEqual(await self.socket.async_send_command("cmd1END\n"), make_frame(b"0001"))
+        self.assertEqual(await self.socket.async_send_command("cmd2END\n"), make_frame(b"0002"))
+
+        self.assertEqual(self.commands, [b"cmd1END\n", b"cmd2END\n"])
+        self.assertTrue(self.socket.socket_open)
+        await self.socket.async_close()
+
+    async def test_async_read_frame_timeout(self):
+        self.replies = [b"APS11"]
+        self.hang = True
+
+        with self.assertRaises(APSystemsInvalidData):
+            self.socket.timeout = 0.1
+            await self.socket.async_send_command(self.socket.ecu_query)
+
+    @patch.object(APSystemsSocket, 'process_ecu_data')
+    @patch.object(APSystemsSocket, 'process_inverter_data')
+    async def test_async_query_ecu(self, mock_process_inverter_data, mock_process_ecu_data):
+        self.socket.ecu_id = "123456789012"
+        self.socket.lifetime_energy = 100
+        self.replies = [make_frame(b"0001"), make_frame(b"0002"), make_frame(b"0030")]
+        mock_process_inverter_data.return_value = {"inverters": []}
+
+        data = await self.socket.async_query_ecu()
+
+        self.assertEqual(self.socket.ecu_raw_data, make_frame(b"0001"))
+        self.assertEqual(self.socket.inverter_raw_data, make_frame(b"0002"))
+        self.assertEqual(self.socket.inverter_raw_signal, make_frame(b"0030"))
+        self.assertEqual(data["ecu_id"], "123456789012")
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,124 @@
+import os
+import tempfile
+import unittest
+from aps2mqtt.apsystems import frames
+from aps2mqtt.apsystems.APSystemsSocket import APSystemsSocket, APSystemsInvalidData
+from aps2mqtt.apsystems.capture import (
+    CaptureEnd,
+    CaptureWriter,
+    ReplaySocket,
+    capture_path,
+    read_capture,
+)
+from aps2mqtt.apsystems.simulator import ECUSimulator
+
+
+class TestCapture(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = capture_path(self.tmp_dir.name, "127.0.0.1", 8899)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_capture_path(self):
+        self.assertEqual(os.path.basename(self.path), "127.0.0.1_8899.apscap")
+
+    def test_write_read(self):
+        writer = CaptureWriter(self.path)
+        writer.write(b"APS first", 10.5)
+        writer.close()
+        # Appended to the existing capture
+        writer = CaptureWriter(self.path)
+        writer.write(b"APS second", 11.5)
+        writer.close()
+
+        self.assertEqual(
+            list(read_capture(self.path)), [(10.5, b"APS first"), (11.5, b"APS second")]
+        )
+
+    def test_truncated_record(self):
+        writer = CaptureWriter(self.path)
+        writer.write(b"APS first", 10.5)
+        writer.write(b"APS second", 11.5)
+        writer.close()
+        with open(self.path, "r+b") as capture:
+            capture.truncate(os.path.getsize(self.path) - 3)
+
+        with self.assertLogs("aps2mqtt.apsystems.capture", level="WARNING"):
+            self.assertEqual(list(read_capture(self.path)), [(10.5, b"APS first")])
+
+    def test_invalid_file(self):
+        with open(self.path, "wb") as capture:
+            capture.write(b"garbage")
+
+        with self.assertRaises(ValueError):
+            list(read_capture(self.path))
+
+    async def test_record_and_replay(self):
+        async with ECUSimulator(3, seed=1) as simulator:
+            aps_socket = APSystemsSocket("127.0.0.1", simulator.port, timeout=2, wait_ready=True)
+            aps_socket.recorder = CaptureWriter(self.path)
+            recorded = [await aps_socket.async_query_ecu() for _ in range(2)]
+            aps_socket.recorder.close()
+            await aps_socket.async_close()
+
+        self.assertEqual(len(list(read_capture(self.path))), 6)
+
+        replay_socket = ReplaySocket(self.path)
+        replayed = [replay_socket.query_ecu(), await replay_socket.async_query_ecu()]
+
+        for recorded_data, replayed_data in zip(recorded, replayed):
+            self.assertEqual(replayed_data["lifetime_energy"], recorded_data["lifetime_energy"])
+            self.assertEqual(replayed_data["inverters"], recorded_data["inverters"])
+        self.assertTrue(replay_socket.exhausted())
+        self.assertEqual(replay_socket.replayed, 6)
+        with self.assertRaises(CaptureEnd):
+            replay_socket.query_ecu()
+
+    def test_replay_invalid_frame(self):
+        writer = CaptureWriter(self.path)
+        writer.write(frames.ecu_frame(lifetime_energy=0))
+        writer.write(frames.ecu_frame())
+        writer.write(frames.inverter_frame([frames.inverter_record(frames.inverter_uid(1))]))
+        writer.write(frames.signal_frame([(frames.inverter_uid(1), 255)]))
+        writer.close()
+        replay_socket = ReplaySocket(self.path)
+
+        # Invalid ECU reply recorded without the inverter replies
+        with self.assertRaises(Exception):
+            replay_socket.query_ecu()
+        data = replay_socket.query_ecu()
+
+        self.assertEqual(data["inverters"][0]["uid"], frames.inverter_uid(1))
+        self.assertTrue(replay_socket.exhausted())
+
+    def test_replay_missing_reply(self):
+        uid = frames.inverter_uid(1)
+        writer = CaptureWriter(self.path)
+        # Inverter command of the first update timed out while recording
+        writer.write(frames.ecu_frame())
+        for power in (100, 200):
+            writer.write(frames.ecu_frame())
+            writer.write(frames.inverter_frame([frames.inverter_record(uid, power=[power, power])]))
+            writer.write(frames.signal_frame([(uid, 255)]))
+        # Signal reply of an update whose ECU reply is missing
+        writer.write(frames.signal_frame([(uid, 255)]))
+        writer.close()
+        replay_socket = ReplaySocket(self.path)
+
+        with self.assertRaises(APSystemsInvalidData):
+            replay_socket.query_ecu()
+        replayed = [replay_socket.query_ecu()["inverters"][0]["power"] for _ in range(2)]
+
+        self.assertEqual(replayed, [[100, 100], [200, 200]])
+        self.assertEqual(replay_socket.replayed, 7)
+        # The orphan reply is skipped
+        with self.assertRaises(CaptureEnd):
+            replay_socket.query_ecu()
+        self.assertTrue(replay_socket.exhausted())
+
+
+if __name__ == "__main__":
+    unittest.main()
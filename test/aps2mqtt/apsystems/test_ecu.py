@@ -1,9 +1,15 @@
+import asyncio
 import logging
+import socket
+import threading
 import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs
 from unittest.mock import MagicMock, patch
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
-from aps2mqtt.apsystems.ECU import ECU
+from aps2mqtt.apsystems.ECU import ECU, post_form
+from aps2mqtt.metrics import Metrics
 from suntime import Sun
 
 
@@ -15,6 +21,10 @@ class TestECU(unittest.TestCase):
         # Create a mock for ecu_config
         self.ecu_config = MagicMock()
         self.ecu_config.stop_at_night = True
+        self.ecu_config.columnar_snapshot = False
+        self.ecu_config.energy_integration = False
+        self.ecu_config.failure_threshold = 5
+        self.ecu_config.max_retry_delay = 60
         self.ecu_config.ecu_position_latitude = 47.15276689916119
         self.ecu_config.ecu_position_longitude = -1.336921926016209
 
@@ -100,6 +110,201 @@ class TestECU(unittest.TestCase):
         # Assert
         self.assertEqual(wake_up.date(), (sunrise_time + timedelta(days=1)).date())
 
+    def test_sun_times_computed_once_per_day(self):
+        with patch.object(self.ecu.ecu_location, "get_sunrise_time") as mock_sunrise, patch.object(
+            self.ecu.ecu_location, "get_sunset_time"
+        ) as mock_sunset:
+            today = datetime(2025, 7, 20).date()
+            for _ in range(3):
+                self.ecu.sun_times(today)
+            self.ecu.sun_times(today + timedelta(days=1))
+            self.ecu.sun_times(today)
+
+        self.assertEqual(mock_sunrise.call_count, 2)
+        self.assertEqual(mock_sunset.call_count, 2)
+        mock_sunrise.assert_any_call(today)
+
+    def test_update_energy(self):
+        self.ecu_config.stop_at_night = False
+        self.ecu_config.energy_integration = True
+        self.ecu_config.energy_state_file = None
+        self.ecu_config.power_window = 15
+        self.ecu_config.timezone = ZoneInfo("Europe/Paris")
+        ecu = ECU(self.ecu_config)
+        ecu.socket = MagicMock()
+
+        for timestamp, power in (("2025-07-20 12:00:00", 100), ("2025-07-20 12:05:00", 300)):
+            ecu.socket.query_ecu.return_value = {
+                "ecu_id": "216000000001",
+                "timestamp": timestamp,
+                "inverters": [{"uid": "408000000001", "online": True, "power": [power]}],
+            }
+            data = ecu.update()
+
+        self.assertEqual(data["inverters"][0]["today_energy"], 0.017)
+        self.assertEqual(data["inverters"][0]["peak_power"], 300)
+
+    def _fail(self, ecu, count):
+        for _ in range(count):
+            with self.assertRaises(ValueError):
+                ecu.handle_data({})
+
+    def _restart_ecu(self):
+        self.ecu_config.auto_restart = True
+        self.ecu_config.wifi_config.ssid = "MyWifi"
+        self.ecu_config.wifi_config.passwd = "secret"
+        self.ecu_config.restart_timeout = 300
+        ecu = ECU(self.ecu_config)
+        ecu.handle_data({"ecu_id": "216200001234"})
+        return ecu
+
+    @patch("aps2mqtt.apsystems.ECU._RESTART_GRACE", 0)
+    @patch("aps2mqtt.apsystems.ECU.ECU.port_open", return_value=True)
+    @patch("aps2mqtt.apsystems.ECU.post_form", return_value=200)
+    def test_invalid_data_restart(self, mock_post_form, mock_port_open):
+        ecu = self._restart_ecu()
+        # Synchronous update, waiting for the end of the restart
+        self._fail(ecu, 5)
+
+        mock_post_form.assert_called_once_with(
+            ecu.ipaddr,
+            "/index.php/management/set_wlan_ap",
+            {"SSID": "MyWifi", "channel": 0, "method": 2, "psk_wep": "", "psk_wpa": "secret"},
+        )
+        mock_port_open.assert_called_once()
+        self.assertEqual(ecu.health.state, "restarting")
+        self.assertLessEqual(ecu.health.next_attempt, datetime.now(timezone.utc))
+
+        # Not restarted again while the ECU is still failing
+        self._fail(ecu, 5)
+        mock_post_form.assert_called_once()
+        self.assertEqual(ecu.health.state, "open")
+
+    @patch("aps2mqtt.apsystems.ECU.post_form", side_effect=ConnectionRefusedError("refused"))
+    def test_invalid_data_restart_failed(self, mock_post_form):
+        ecu = self._restart_ecu()
+        self._fail(ecu, 5)
+
+        mock_post_form.assert_called_once()
+        self.assertEqual(ecu.health.state, "open")
+
+    @patch("aps2mqtt.apsystems.ECU._RESTART_GRACE", 0)
+    @patch("aps2mqtt.apsystems.ECU.ECU.port_open", return_value=False)
+    @patch("aps2mqtt.apsystems.ECU.post_form", return_value=200)
+    def test_invalid_data_restart_timeout(self, mock_post_form, mock_port_open):
+        ecu = self._restart_ecu()
+        ecu.health.restart_timeout = 0
+        metrics = Metrics()
+        metrics.enable()
+        with patch("aps2mqtt.apsystems.ECU.METRICS", metrics):
+            self._fail(ecu, 5)
+
+        mock_port_open.assert_called_once()
+        self.assertEqual(ecu.health.state, "open")
+        self.assertIn('result="timeout"} 1', metrics.render())
+
+    @patch("aps2mqtt.apsystems.ECU._RESTART_GRACE", 0)
+    @patch("aps2mqtt.apsystems.ECU._RESTART_CHECK_INTERVAL", 0)
+    @patch("aps2mqtt.apsystems.ECU.post_form", return_value=200)
+    def test_restart_in_background(self, mock_post_form):
+        ecu = self._restart_ecu()
+        metrics = Metrics()
+        metrics.enable()
+
+        async def restart():
+            server = await asyncio.start_server(lambda reader, writer: writer.close(), "127.0.0.1")
+            ecu.ipaddr = "127.0.0.1"
+            ecu.port = server.sockets[0].getsockname()[1]
+            async with server:
+                self._fail(ecu, 5)
+                # The failed update doesn't wait for the restart
+                self.assertFalse(ecu.restart_task.done())
+                self.assertEqual(ecu.health.state, "restarting")
+                self.assertGreater(ecu.health.next_attempt, datetime.now(timezone.utc))
+                return await ecu.restart_task
+
+        with patch("aps2mqtt.apsystems.ECU.METRICS", metrics):
+            self.assertTrue(asyncio.run(restart()))
+
+        mock_post_form.assert_called_once()
+        self.assertLessEqual(ecu.health.next_attempt, datetime.now(timezone.utc))
+        metrics_text = metrics.render()
+        self.assertIn(
+            'aps_ecu_restarts_total{ecu="127.0.0.1",result="recovered"} 1', metrics_text
+        )
+        self.assertIn('aps_ecu_restart_recovery_seconds{ecu="127.0.0.1"}', metrics_text)
+
+    def test_port_closed(self):
+        ecu = self._restart_ecu()
+        # Port free once the socket is closed
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            ecu.ipaddr, ecu.port = sock.getsockname()
+
+        self.assertFalse(asyncio.run(ecu.port_open()))
+
+    @patch("aps2mqtt.apsystems.ECU.post_form")
+    def test_invalid_data_without_restart(self, mock_post_form):
+        self.ecu_config.auto_restart = False
+        ecu = ECU(self.ecu_config)
+        ecu.handle_data({"ecu_id": "216200001234"})
+        self._fail(ecu, 4)
+        self.assertEqual(ecu.health.state, "degraded")
+
+        self._fail(ecu, 1)
+
+        mock_post_form.assert_not_called()
+        self.assertEqual(ecu.health.state, "open")
+
+    def test_invalid_data_before_valid_data(self):
+        self.ecu_config.auto_restart = True
+        ecu = ECU(self.ecu_config)
+
+        # The ECU id is unknown, it can't be restarted
+        self._fail(ecu, 5)
+
+        self.assertEqual(ecu.health.state, "open")
+
+    def test_success_closes_circuit(self):
+        self._fail(self.ecu, 5)
+        self.assertTrue(self.ecu.health.is_open())
+
+        self.ecu.handle_data({"ecu_id": "216000001234"})
+
+        self.assertEqual(self.ecu.health.status(), {"state": "healthy", "failures": 0, "next_attempt": None})
+
+    def test_post_form(self):
+        requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                requests.append((self.path, dict(self.headers), parse_qs(body.decode())))
+                self.send_response(200)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        status = post_form(f"127.0.0.1:{server.server_address[1]}", "/index.php/management/set_wlan_ap",
+                           {"SSID": "My Wifi", "channel": 0}, timeout=5)
+
+        self.assertEqual(status, 200)
+        path, headers, fields = requests[0]
+        self.assertEqual(path, "/index.php/management/set_wlan_ap")
+        self.assertEqual(headers["X-Requested-With"], "XMLHttpRequest")
+        self.assertEqual(headers["Content-Type"], "application/x-www-form-urlencoded")
+        self.assertEqual(fields, {"SSID": ["My Wifi"], "channel": ["0"]})
+
 
 if __name__ == "__main__":
     unittest.main()
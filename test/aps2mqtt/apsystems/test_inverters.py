@@ -0,0 +1,71 @@
+import struct
+import unittest
+from unittest.mock import patch
+from aps2mqtt.apsystems import frames
+from aps2mqtt.apsystems.inverters import InverterLayout, get_inverter_layout, register_inverter_layout
+
+
+class TestInverterLayout(unittest.TestCase):
+
+    def test_default_layouts(self):
+        self.assertIs(get_inverter_layout("01"), get_inverter_layout("04"))
+        self.assertIs(get_inverter_layout("01"), get_inverter_layout("05"))
+        self.assertEqual(get_inverter_layout("01").stride, 21)
+        self.assertEqual(get_inverter_layout("02").stride, 27)
+        self.assertEqual(get_inverter_layout("03").stride, 23)
+        self.assertIsNone(get_inverter_layout("99"))
+
+    def test_struct_covers_stride(self):
+        for type_code in ("01", "02", "03"):
+            layout = get_inverter_layout(type_code)
+            self.assertEqual(layout.struct.size, layout.stride)
+
+    def test_unpack(self):
+        record = frames.inverter_record(
+            "806000000001", "03", online=True, frequency=49.9, temperature=42, power=[1, 2, 3, 4], voltage=[231]
+        )
+
+        inverter = get_inverter_layout("03").unpack(b"xx" + record, 2, {"806000000001": 55})
+
+        self.assertEqual(inverter, {
+            "uid": "806000000001",
+            "online": True,
+            "signal": 55,
+            "frequency": 49.9,
+            "temperature": 42,
+            "model": "QS1",
+            "channel_qty": 4,
+            "power": [1, 2, 3, 4],
+            "voltage": [231],
+        })
+
+    def test_unpack_offline(self):
+        record = frames.inverter_record("806000000001", "01", online=False)
+
+        inverter = get_inverter_layout("01").unpack(record, 0, {})
+
+        self.assertFalse(inverter["online"])
+        self.assertNotIn("temperature", inverter)
+        self.assertEqual(inverter["signal"], 0)
+
+    @patch.dict("aps2mqtt.apsystems.inverters._LAYOUTS")
+    def test_custom_layout(self):
+        layout = InverterLayout(("T1",), "Test", channel_qty=1, power_offsets=(13,), voltage_offsets=(15,), stride=19)
+        register_inverter_layout(layout)
+        record = bytes.fromhex("806000000001") + b"\x01T1" + struct.pack(">HHHH", 500, 130, 42, 231) + b"\x00\x00"
+
+        inverter = get_inverter_layout("T1").unpack(record, 0, {})
+
+        self.assertEqual(inverter["power"], [42])
+        self.assertEqual(inverter["voltage"], [231])
+        self.assertEqual(inverter["temperature"], 30)
+
+    def test_invalid_layouts(self):
+        with self.assertRaises(ValueError):
+            InverterLayout(("T2",), "Overlap", 1, power_offsets=(13,), voltage_offsets=(14,), stride=21)
+        with self.assertRaises(ValueError):
+            InverterLayout(("T2",), "Too long", 1, power_offsets=(13,), voltage_offsets=(15,), stride=15)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+from aps2mqtt.apsystems.APSystemsSocket import APSystemsSocket, APSystemsInvalidData
+from aps2mqtt.apsystems.simulator import ECUSimulator
+
+
+class TestECUSimulator(unittest.IsolatedAsyncioTestCase):
+
+    async def test_async_query_ecu(self):
+        async with ECUSimulator(7, seed=1) as simulator:
+            aps_socket = APSystemsSocket("127.0.0.1", simulator.port, timeout=2, wait_ready=True)
+            data = await aps_socket.async_query_ecu()
+
+        self.assertEqual(data["ecu_id"], "216000000001")
+        self.assertEqual(len(data["inverters"]), 7)
+        self.assertEqual(data["inverters"][0]["uid"], "806000000001")
+        self.assertEqual(data["inverters"][1]["model"], "YC1000/QT2")
+        self.assertEqual(data["inverters"][2]["model"], "QS1")
+        self.assertEqual(simulator.commands, 3)
+
+    async def test_fragmented_reply(self):
+        async with ECUSimulator(3, chunk_size=5, chunk_delay=0.001) as simulator:
+            aps_socket = APSystemsSocket("127.0.0.1", simulator.port, timeout=2, wait_ready=True)
+            data = await aps_socket.async_query_ecu()
+
+        self.assertEqual(len(data["inverters"]), 3)
+
+    async def test_faults(self):
+        for fault in ("close", "hang", "truncate", "checksum", "garbage"):
+            with self.subTest(fault=fault):
+                async with ECUSimulator(2, fault_rate=1, faults=(fault,)) as simulator:
+                    aps_socket = APSystemsSocket(
+                        "127.0.0.1", simulator.port, timeout=0.2, wait_ready=True
+                    )
+                    with self.assertRaises(APSystemsInvalidData):
+                        await aps_socket.async_query_ecu()
+                self.assertEqual(simulator.injected_faults, 1)
+
+    def test_unknown_fault(self):
+        with self.assertRaises(ValueError):
+            ECUSimulator(faults=("explode",))
+
+
+class TestThreadedECUSimulator(unittest.TestCase):
+
+    def test_query_ecu(self):
+        simulator = ECUSimulator(5, latency=0.01)
+        port = simulator.start_thread()
+        try:
+            aps_socket = APSystemsSocket("127.0.0.1", port, timeout=2, wait_ready=True)
+            data = aps_socket.query_ecu()
+        finally:
+            simulator.stop_thread()
+
+        self.assertEqual(data["qty_of_inverters"], 5)
+        self.assertEqual(len(data["inverters"]), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import math
+import unittest
+from statistics import mean
+from aps2mqtt.apsystems import frames
+from aps2mqtt.apsystems.APSystemsSocket import APSystemsSocket
+from aps2mqtt.apsystems.snapshot import numpy_available, decode_inverter_snapshot
+
+
+@unittest.skipUnless(numpy_available(), "numpy is not installed")
+class TestInverterSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        types = ["01", "02", "03", "04", "05"]
+        self.uids = [frames.inverter_uid(i) for i in range(10)]
+        records = [
+            frames.inverter_record(uid, types[i % len(types)], online=i != 3, temperature=20 + i)
+            for i, uid in enumerate(self.uids)
+        ]
+        self.socket = APSystemsSocket("127.0.0.1", raw_inverter=frames.inverter_frame(records), snapshot=True)
+        self.socket.inverter_raw_signal = frames.signal_frame([(uid, 255) for uid in self.uids])
+        self.socket.qty_of_inverters = len(self.uids)
+
+    def test_snapshot_matches_inverters(self):
+        data = self.socket.process_inverter_data()
+        snapshot = data["snapshot"]
+
+        self.assertEqual(len(snapshot), 10)
+        self.assertEqual(list(snapshot.uid), self.uids)
+        for i, inverter in enumerate(data["inverters"]):
+            self.assertEqual(snapshot.model[i], inverter["model"])
+            self.assertEqual(bool(snapshot.online[i]), inverter["online"])
+            self.assertEqual(snapshot.signal[i], inverter["signal"])
+            self.assertEqual(snapshot.frequency[i], inverter["frequency"])
+            if inverter["online"]:
+                self.assertEqual(snapshot.temperature[i], inverter["temperature"])
+            else:
+                self.assertTrue(math.isnan(snapshot.temperature[i]))
+            self.assertEqual(snapshot.inverter_power()[i], sum(inverter["power"]))
+            self.assertAlmostEqual(snapshot.inverter_voltage()[i], mean(inverter["voltage"]))
+
+    def test_aggregate(self):
+        data = self.socket.process_inverter_data()
+
+        aggregate = data["snapshot"].aggregate()
+
+        self.assertEqual(aggregate["power"], sum(sum(inv["power"]) for inv in data["inverters"]))
+        self.assertEqual(aggregate["online"], 9)
+        self.assertEqual(aggregate["max_temperature"], 29)
+        self.assertEqual(aggregate["models"]["QS1"]["count"], 2)
+        self.assertEqual(aggregate["models"]["YC1000/QT2"]["power"], 2 * (100 + 101 + 102 + 103))
+
+    def test_empty_frame(self):
+        snapshot = decode_inverter_snapshot(frames.inverter_frame([]), 26, 0, {})
+
+        self.assertEqual(len(snapshot), 0)
+        self.assertEqual(snapshot.aggregate()["power"], 0)
+
+    def test_truncated_frame(self):
+        data = frames.inverter_frame([frames.inverter_record(self.uids[0], "02")])
+
+        with self.assertRaises(ValueError):
+            decode_inverter_snapshot(data[:40], 26, 1, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
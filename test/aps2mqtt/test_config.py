@@ -2,7 +2,7 @@ import unittest
 from unittest.mock import patch, mock_open
 import os
 import yaml
-from aps2mqtt.config import MQTTConfig, ECUConfig, WifiConfig, Config
+from aps2mqtt.config import MQTTConfig, ECUConfig, WifiConfig, DecodeConfig, Config
 
 class TestConfig(unittest.TestCase):
 
@@ -15,10 +15,23 @@ class TestConfig(unittest.TestCase):
             "MQTT_CLIENT_ID": "test_client",
             "MQTT_TOPIC_PREFIX": "test/topic",
             "MQTT_RETAIN": "True",
+            "MQTT_QOS": "1",
+            "MQTT_MAX_INFLIGHT": "50",
+            "MQTT_MAX_QUEUED": "1000",
+            "MQTT_PUBLISH_TIMEOUT": "5",
+            "MQTT_PAYLOAD_MODE": "Both",
+            "MQTT_PAYLOAD_ENCODING": "msgpack",
             "MQTT_DISCOVERY_ENABLED": "True",
             "MQTT_DISCOVERY_PREFIX": "test_discovery",
+            "MQTT_DISCOVERY_STATE_FILE": "/var/lib/aps2mqtt/discovery.json",
             "MQTT_BROKER_SECURED_CONNECTION": "True",
-            "MQTT_BROKER_CACERTS_PATH": "/path/to/ca.crt"
+            "MQTT_BROKER_CACERTS_PATH": "/path/to/ca.crt",
+            "MQTT_PUBLISH_ON_CHANGE": "True",
+            "MQTT_DEADBANDS": "voltage:1, temperature:0.5",
+            "MQTT_FULL_REFRESH_INTERVAL": "30",
+            "MQTT_SPOOL_FILE": "/var/lib/aps2mqtt/spool.db",
+            "MQTT_SPOOL_MAX_MESSAGES": "5000",
+            "MQTT_SPOOL_DRAIN_RATE": "20",
         }):
             cfg = MQTTConfig(os.environ)
             self.assertEqual(cfg.broker_addr, "mqtt.example.com")
@@ -28,16 +41,48 @@ class TestConfig(unittest.TestCase):
             self.assertEqual(cfg.client_id, "test_client")
             self.assertEqual(cfg.topic_prefix, "test/topic")
             self.assertTrue(cfg.retain)
+            self.assertEqual(cfg.qos, 1)
+            self.assertEqual(cfg.max_inflight, 50)
+            self.assertEqual(cfg.max_queued, 1000)
+            self.assertEqual(cfg.publish_timeout, 5)
+            self.assertEqual(cfg.payload_mode, "both")
+            self.assertEqual(cfg.payload_encoding, "msgpack")
             self.assertTrue(cfg.discovery_enabled)
             self.assertEqual(cfg.discovery.prefix, "test_discovery")
+            self.assertEqual(cfg.discovery.state_file, "/var/lib/aps2mqtt/discovery.json")
             self.assertTrue(cfg.secured_connection)
             self.assertEqual(cfg.cacerts_path, "/path/to/ca.crt")
+            self.assertTrue(cfg.publish_on_change)
+            self.assertEqual(cfg.deadbands, {"voltage": 1.0, "temperature": 0.5})
+            self.assertEqual(cfg.full_refresh_interval, 30)
+            self.assertEqual(cfg.spool_file, "/var/lib/aps2mqtt/spool.db")
+            self.assertEqual(cfg.spool_max_messages, 5000)
+            self.assertEqual(cfg.spool_drain_rate, 20)
+
+    def test_mqtt_config_invalid_qos(self):
+        with self.assertRaises(ValueError):
+            MQTTConfig({"MQTT_QOS": "3"})
+
+    def test_mqtt_config_invalid_payload_encoding(self):
+        with self.assertRaises(ValueError):
+            MQTTConfig({"MQTT_PAYLOAD_ENCODING": "xml"})
+
+    def test_mqtt_config_invalid_payload_mode(self):
+        with self.assertRaises(ValueError):
+            MQTTConfig({"MQTT_PAYLOAD_MODE": "single"})
 
     def test_ecu_config_from_env(self):
         with patch.dict(os.environ, {
             "APS_ECU_IP": "192.168.1.100",
             "APS_ECU_PORT": "8888",
             "APS_ECU_TIMEZONE": "America/New_York",
+            "APS_ECU_COMMAND_TIMEOUT": "20",
+            "APS_ECU_WAIT_READY": "True",
+            "APS_ECU_COMMAND_GAP": "1.5",
+            "APS_ECU_PERSISTENT_CONNECTION": "True",
+            "APS_ECU_COLUMNAR_SNAPSHOT": "True",
+            "APS_ECU_FAILURE_THRESHOLD": "3",
+            "APS_ECU_MAX_RETRY_DELAY": "30",
             "APS_ECU_AUTO_RESTART": "True",
             "APS_ECU_WIFI_SSID": "my_wifi",
             "APS_ECU_WIFI_PASSWD": "wifi_password",
@@ -46,9 +91,17 @@ class TestConfig(unittest.TestCase):
             "APS_ECU_POSITION_LNG": "-74.0060"
         }):
             cfg = ECUConfig(os.environ)
+            self.assertFalse(cfg.energy_integration)
             self.assertEqual(cfg.ipaddr, "192.168.1.100")
             self.assertEqual(cfg.port, 8888)
             self.assertEqual(str(cfg.timezone), "America/New_York")
+            self.assertEqual(cfg.command_timeout, 20)
+            self.assertTrue(cfg.wait_ready)
+            self.assertEqual(cfg.command_gap, 1.5)
+            self.assertTrue(cfg.persistent_connection)
+            self.assertTrue(cfg.columnar_snapshot)
+            self.assertEqual(cfg.failure_threshold, 3)
+            self.assertEqual(cfg.max_retry_delay, 30)
             self.assertTrue(cfg.auto_restart)
             self.assertEqual(cfg.wifi_config.ssid, "my_wifi")
             self.assertEqual(cfg.wifi_config.passwd, "wifi_password")
@@ -56,6 +109,22 @@ class TestConfig(unittest.TestCase):
             self.assertEqual(cfg.ecu_position_latitude, 40.7128)
             self.assertEqual(cfg.ecu_position_longitude, -74.0060)
 
+    def test_ecu_config_energy(self):
+        cfg = ECUConfig({
+            "APS_ECU_IP": "192.168.1.100",
+            "APS_ECU_ENERGY_INTEGRATION": "True",
+            "APS_ECU_ENERGY_STATE_FILE": "/var/lib/aps2mqtt/energy.json",
+        })
+        self.assertTrue(cfg.energy_integration)
+        self.assertEqual(cfg.energy_state_file, "/var/lib/aps2mqtt/energy.json")
+        self.assertEqual(cfg.power_window, 15)
+        self.assertEqual(cfg.failure_threshold, 5)
+        self.assertEqual(cfg.max_retry_delay, 60)
+
+    def test_ecu_config_invalid_failure_threshold(self):
+        with self.assertRaises(ValueError):
+            ECUConfig({"APS_ECU_IP": "192.168.1.100", "APS_ECU_FAILURE_THRESHOLD": "0"})
+
     def test_config_from_yaml(self):
         yaml_content = """
         mqtt:
@@ -70,6 +139,73 @@ class TestConfig(unittest.TestCase):
                 self.assertEqual(cfg.mqtt_config.broker_addr, "yaml.broker")
                 self.assertEqual(cfg.mqtt_config.broker_port, 1885)
                 self.assertEqual(cfg.ecu_config.ipaddr, "192.168.1.200")
+                self.assertFalse(cfg.metrics_config.enabled)
+
+    def test_deadbands_from_yaml(self):
+        yaml_content = """
+        mqtt:
+          MQTT_PUBLISH_ON_CHANGE: True
+          MQTT_DEADBANDS:
+            voltage: 1
+            temperature: 2
+        ecu:
+          APS_ECU_IP: 192.168.1.200
+        """
+        with patch("builtins.open", mock_open(read_data=yaml_content)):
+            cfg = Config(config_path="dummy_path.yaml")
+            self.assertEqual(cfg.mqtt_config.deadbands, {"voltage": 1.0, "temperature": 2.0})
+            self.assertEqual(cfg.mqtt_config.full_refresh_interval, 60)
+
+    def test_config_from_yaml_multiple_ecus(self):
+        yaml_content = """
+        mqtt:
+          MQTT_BROKER_HOST: yaml.broker
+        ecu:
+          - APS_ECU_IP: 192.168.1.200
+          - APS_ECU_IP: 192.168.1.201
+            APS_ECU_PORT: 8900
+        """
+        with patch("builtins.open", mock_open(read_data=yaml_content)):
+            cfg = Config(config_path="dummy_path.yaml")
+            self.assertEqual(len(cfg.ecu_configs), 2)
+            self.assertEqual(cfg.ecu_configs[0].ipaddr, "192.168.1.200")
+            self.assertEqual(cfg.ecu_configs[1].ipaddr, "192.168.1.201")
+            self.assertEqual(cfg.ecu_configs[1].port, 8900)
+            self.assertIs(cfg.ecu_config, cfg.ecu_configs[0])
+
+    def test_metrics_config_from_yaml(self):
+        yaml_content = """
+        mqtt:
+          MQTT_BROKER_HOST: yaml.broker
+        ecu:
+          APS_ECU_IP: 192.168.1.200
+        metrics:
+          METRICS_ENABLED: True
+          METRICS_PORT: 9100
+        """
+        with patch("builtins.open", mock_open(read_data=yaml_content)):
+            cfg = Config(config_path="dummy_path.yaml")
+            self.assertTrue(cfg.metrics_config.enabled)
+            self.assertEqual(cfg.metrics_config.host, "0.0.0.0")
+            self.assertEqual(cfg.metrics_config.port, 9100)
+            self.assertEqual(cfg.decode_config.workers, 0)
+
+    def test_decode_config_from_yaml(self):
+        yaml_content = """
+        mqtt:
+          MQTT_BROKER_HOST: yaml.broker
+        ecu:
+          APS_ECU_IP: 192.168.1.200
+        decoding:
+          DECODE_WORKERS: 4
+        """
+        with patch("builtins.open", mock_open(read_data=yaml_content)):
+            cfg = Config(config_path="dummy_path.yaml")
+            self.assertEqual(cfg.decode_config.workers, 4)
+
+    def test_decode_config_invalid_workers(self):
+        with self.assertRaises(ValueError):
+            DecodeConfig({"DECODE_WORKERS": -1})
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,116 @@
+import asyncio
+import json
+import unittest
+from collections import deque
+from unittest.mock import MagicMock
+from aps2mqtt.apsystems import frames
+from aps2mqtt.apsystems.simulator import ECUSimulator
+from aps2mqtt.apsystems.APSystemsSocket import APSystemsSocket, APSystemsInvalidData
+from aps2mqtt.decoder import DecoderPool, decode_inverters
+from aps2mqtt.mqtthandler import MQTTHandler
+
+ECU_VALUES = {
+    "ecu_id": "216200001234",
+    "today_energy": 12.5,
+    "lifetime_energy": 1234.5,
+    "current_power": 450,
+    "qty_of_inverters": 2,
+    "qty_of_online_inverters": 2,
+}
+
+
+class TestDecoder(unittest.TestCase):
+
+    def setUp(self):
+        self.uids = [frames.inverter_uid(i) for i in range(2)]
+        self.inverter_frame = frames.inverter_frame([frames.inverter_record(uid) for uid in self.uids])
+        self.signal_frame = frames.signal_frame([(uid, 255) for uid in self.uids])
+        mqtt_config = MagicMock()
+        mqtt_config.discovery_enabled = False
+        mqtt_config.publish_on_change = False
+        mqtt_config.topic_prefix = "aps2mqtt"
+        mqtt_config.payload_mode = "both"
+        mqtt_config.payload_encoding = "json"
+        mqtt_config.spool_file = None
+        self.handler = MQTTHandler(mqtt_config)
+
+    def _invalid_inverter_frame(self):
+        # Length doesn't match the frame
+        return self.inverter_frame[:5] + b"0000" + self.inverter_frame[9:]
+
+    def _in_process_data(self):
+        aps_socket = APSystemsSocket("127.0.0.1", raw_inverter=self.inverter_frame)
+        for name, value in ECU_VALUES.items():
+            setattr(aps_socket, name, value)
+        aps_socket.inverter_raw_signal = self.signal_frame
+        return aps_socket.collect_data()
+
+    def test_decode_inverters(self):
+        data, errors, err = decode_inverters(
+            "127.0.0.1", ECU_VALUES, self.inverter_frame, self.signal_frame, False,
+            self.handler.worker_payload_options())
+
+        self.assertIsNone(err)
+        self.assertEqual(errors, [])
+        payloads = data.pop("payloads")
+        self.assertEqual(data, self._in_process_data())
+        self.assertEqual(payloads, self.handler._parse_data(data))
+
+    def test_decode_inverters_without_payloads(self):
+        data, _, _ = decode_inverters("127.0.0.1", ECU_VALUES, self.inverter_frame, self.signal_frame)
+
+        self.assertNotIn("payloads", data)
+        self.assertEqual(data, self._in_process_data())
+
+    def test_decode_inverters_error(self):
+        inverter_frame = self._invalid_inverter_frame()
+
+        data, errors, err = decode_inverters(
+            "127.0.0.1", ECU_VALUES, inverter_frame, self.signal_frame)
+
+        self.assertIsNone(data)
+        self.assertIsInstance(err, APSystemsInvalidData)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0].data, inverter_frame)
+
+    def test_pool(self):
+        pool = DecoderPool(1, self.handler.worker_payload_options())
+        self.addCleanup(pool.shutdown)
+        aps_socket = APSystemsSocket("127.0.0.1", raw_inverter=self.inverter_frame)
+        for name, value in ECU_VALUES.items():
+            setattr(aps_socket, name, value)
+        aps_socket.inverter_raw_signal = self.signal_frame
+
+        data = asyncio.run(pool.decode(aps_socket))
+
+        payloads = data.pop("payloads")
+        self.assertEqual(data, self._in_process_data())
+        self.assertEqual(json.loads(payloads["aps2mqtt/aps/216200001234"])["current_power"], 450)
+        self.assertEqual(aps_socket.inverters, data["inverters"])
+        self.assertEqual(aps_socket.last_update, data["timestamp"])
+
+        # Errors found by the worker are kept by the socket
+        aps_socket.inverter_raw_data = self._invalid_inverter_frame()
+        with self.assertRaises(APSystemsInvalidData):
+            asyncio.run(pool.decode(aps_socket, payloads=False))
+        self.assertEqual(len(aps_socket.errors), 1)
+        self.assertIsInstance(aps_socket.errors, deque)
+
+    def test_socket_decoder(self):
+        pool = DecoderPool(1, self.handler.worker_payload_options())
+        self.addCleanup(pool.shutdown)
+
+        async def query():
+            async with ECUSimulator(3, seed=1) as simulator:
+                aps_socket = APSystemsSocket("127.0.0.1", simulator.port, timeout=2, wait_ready=True)
+                aps_socket.decoder = pool.decode
+                return await aps_socket.async_query_ecu()
+
+        data = asyncio.run(query())
+
+        self.assertEqual(len(data["inverters"]), 3)
+        self.assertEqual(data.pop("payloads"), self.handler._parse_data(data))
+
+
+if __name__ == "__main__":
+    unittest.main()
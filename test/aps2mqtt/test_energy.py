@@ -0,0 +1,141 @@
+import os
+import tempfile
+import unittest
+from zoneinfo import ZoneInfo
+from aps2mqtt.energy import EnergyIntegrator, RollingPower
+
+PARIS = ZoneInfo("Europe/Paris")
+
+
+def ecu_data(timestamp, *inverters):
+    return {"timestamp": timestamp, "inverters": [dict(inverter) for inverter in inverters]}
+
+
+def online(uid, power):
+    return {"uid": uid, "online": True, "power": power}
+
+
+class TestRollingPower(unittest.TestCase):
+
+    def test_window(self):
+        rolling = RollingPower(900)
+
+        self.assertIsNone(rolling.average())
+        self.assertIsNone(rolling.peak())
+
+        rolling.add(0, 100)
+        rolling.add(300, 400)
+        rolling.add(600, 200)
+        self.assertEqual(rolling.average(), 700 / 3)
+        self.assertEqual(rolling.peak(), 400)
+
+        # The first sample leaves the window
+        rolling.add(900, 300)
+        self.assertEqual(rolling.average(), 300)
+        self.assertEqual(rolling.peak(), 400)
+
+        # The peak leaves the window
+        rolling.add(1200, 100)
+        self.assertEqual(rolling.average(), 200)
+        self.assertEqual(rolling.peak(), 300)
+        self.assertEqual(len(rolling.samples), 3)
+
+
+class TestEnergyIntegrator(unittest.TestCase):
+
+    def setUp(self):
+        self.integrator = EnergyIntegrator(PARIS)
+
+    def test_integration(self):
+        first = self.integrator.update(ecu_data("2025-07-20 12:00:00", online("1", [100, 200])))
+        self.assertEqual(first["inverters"][0]["today_energy"], 0)
+
+        data = self.integrator.update(ecu_data("2025-07-20 12:05:00", online("1", [200, 200])))
+
+        inverter = data["inverters"][0]
+        # (100 + 200) / 2 W and 200 W during 5 minutes
+        self.assertEqual(inverter["panel_today_energy"], [0.013, 0.017])
+        self.assertEqual(inverter["today_energy"], 0.029)
+        self.assertEqual(inverter["avg_power"], 350)
+        self.assertEqual(inverter["peak_power"], 400)
+
+    def test_same_timestamp(self):
+        self.integrator.update(ecu_data("2025-07-20 12:00:00", online("1", [100])))
+        self.integrator.update(ecu_data("2025-07-20 12:05:00", online("1", [100])))
+
+        data = self.integrator.update(ecu_data("2025-07-20 12:05:00", online("1", [100])))
+
+        self.assertEqual(data["inverters"][0]["panel_today_energy"], [0.008])
+        self.assertEqual(len(self.integrator.inverters["1"].rolling.samples), 2)
+
+    def test_gap_and_offline(self):
+        self.integrator.update(ecu_data("2025-07-20 12:00:00", online("1", [100])))
+        # Power unknown during more than 15 minutes
+        self.integrator.update(ecu_data("2025-07-20 13:00:00", online("1", [100])))
+        data = self.integrator.update(ecu_data("2025-07-20 13:05:00", {"uid": "1", "online": False}))
+        inverter = data["inverters"][0]
+        self.assertEqual(inverter["today_energy"], 0)
+        self.assertNotIn("avg_power", inverter)
+
+        self.integrator.update(ecu_data("2025-07-20 13:10:00", online("1", [100])))
+        data = self.integrator.update(ecu_data("2025-07-20 13:15:00", online("1", [100])))
+        self.assertEqual(data["inverters"][0]["today_energy"], 0.008)
+
+    def test_reset_at_local_midnight(self):
+        self.integrator.update(ecu_data("2025-07-20 23:50:00", online("1", [100])))
+        data = self.integrator.update(ecu_data("2025-07-20 23:55:00", online("1", [100])))
+        self.assertEqual(data["inverters"][0]["today_energy"], 0.008)
+
+        data = self.integrator.update(ecu_data("2025-07-21 00:00:00", online("1", [100])))
+        # Only the energy since 23:55
+        self.assertEqual(data["inverters"][0]["today_energy"], 0.008)
+
+        # Midnight in UTC
+        self.integrator.update(ecu_data("2025-07-21 01:55:00", online("1", [100])))
+        data = self.integrator.update(ecu_data("2025-07-21 02:00:00", online("1", [100])))
+        self.assertEqual(data["inverters"][0]["today_energy"], 0.017)
+
+    def test_state_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            state_file = os.path.join(tmp_dir, "energy.json")
+            integrator = EnergyIntegrator(PARIS, state_file)
+            integrator.update(ecu_data("2025-07-20 12:00:00", online("1", [100])))
+            integrator.update(ecu_data("2025-07-20 12:05:00", online("1", [100])))
+
+            # Restarted
+            integrator = EnergyIntegrator(PARIS, state_file)
+            data = integrator.update(ecu_data("2025-07-20 12:10:00", online("1", [100])))
+            self.assertEqual(data["inverters"][0]["today_energy"], 0.017)
+
+            # Restarted the next day
+            integrator = EnergyIntegrator(PARIS, state_file)
+            data = integrator.update(ecu_data("2025-07-21 08:00:00", online("1", [100])))
+            self.assertEqual(data["inverters"][0]["today_energy"], 0)
+
+    def test_restart_same_timestamp(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            state_file = os.path.join(tmp_dir, "energy.json")
+            integrator = EnergyIntegrator(PARIS, state_file)
+            integrator.update(ecu_data("2025-07-20 12:00:00", online("1", [100, 150])))
+
+            # Restarted, the ECU data didn't change since the last update
+            integrator = EnergyIntegrator(PARIS, state_file)
+            data = integrator.update(ecu_data("2025-07-20 12:00:00", online("1", [100, 150])))
+
+            self.assertEqual(data["inverters"][0]["avg_power"], 250)
+            self.assertEqual(data["inverters"][0]["peak_power"], 250)
+            self.assertEqual(data["inverters"][0]["today_energy"], 0)
+
+    def test_invalid_state_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            state_file = os.path.join(tmp_dir, "energy.json")
+            with open(state_file, "w", encoding="UTF-8") as state:
+                state.write("{")
+
+            with self.assertLogs("aps2mqtt.energy", level="WARNING"):
+                integrator = EnergyIntegrator(PARIS, state_file)
+            self.assertEqual(integrator.inverters, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+from aps2mqtt.health import DEGRADED, HEALTHY, OPEN, RESTARTING, ECUHealth
+
+NOW = datetime(2025, 7, 20, 12, 0, 0, tzinfo=timezone.utc)
+
+
+class TestECUHealth(unittest.TestCase):
+
+    def setUp(self):
+        self.health = ECUHealth(failure_threshold=3, min_delay=60, max_delay=300, restart_timeout=180)
+
+    def test_degraded_below_threshold(self):
+        self.assertFalse(self.health.failure(NOW))
+        self.assertFalse(self.health.failure(NOW))
+
+        self.assertEqual(self.health.state, DEGRADED)
+        self.assertFalse(self.health.is_open())
+        self.assertEqual(self.health.status(), {"state": DEGRADED, "failures": 2, "next_attempt": None})
+
+    def test_open_at_threshold(self):
+        self.health.failure(NOW)
+        self.health.failure(NOW)
+
+        self.assertTrue(self.health.failure(NOW))
+
+        self.assertEqual(self.health.state, OPEN)
+        self.assertTrue(self.health.is_open())
+        self.assertEqual(self.health.next_attempt, NOW + timedelta(seconds=60))
+        self.assertEqual(self.health.status()["next_attempt"], "2025-07-20T12:01:00+00:00")
+
+    def test_failed_probes_backoff(self):
+        for _ in range(3):
+            self.health.failure(NOW)
+
+        delays = []
+        for _ in range(4):
+            # Probes failing at their scheduled time don't open the circuit again
+            self.assertFalse(self.health.failure(NOW))
+            delays.append((self.health.next_attempt - NOW).total_seconds())
+
+        self.assertEqual(delays, [120, 240, 300, 300])
+        self.assertEqual(self.health.state, OPEN)
+
+    def test_success_resets(self):
+        for _ in range(4):
+            self.health.failure(NOW)
+
+        self.health.success()
+
+        self.assertEqual(self.health.status(), {"state": HEALTHY, "failures": 0, "next_attempt": None})
+        # Counted again from zero
+        self.health.failure(NOW)
+        self.assertEqual(self.health.state, DEGRADED)
+        for _ in range(2):
+            self.health.failure(NOW)
+        self.assertEqual(self.health.next_attempt, NOW + timedelta(seconds=60))
+
+    def test_restarting(self):
+        for _ in range(3):
+            self.health.failure(NOW)
+
+        self.health.restarting(NOW)
+
+        self.assertEqual(self.health.state, RESTARTING)
+        self.assertTrue(self.health.is_open())
+        self.assertEqual(self.health.next_attempt, NOW + timedelta(seconds=180))
+
+        # ECU still failing after its restart
+        self.assertFalse(self.health.failure(NOW))
+        self.assertEqual(self.health.state, OPEN)
+        self.assertEqual(self.health.next_attempt, NOW + timedelta(seconds=120))
+
+    def test_restarted(self):
+        for _ in range(3):
+            self.health.failure(NOW)
+        self.health.restarting(NOW)
+
+        self.health.restarted(NOW + timedelta(seconds=45))
+
+        # Probed right away, closed by the next successful update
+        self.assertEqual(self.health.state, RESTARTING)
+        self.assertEqual(self.health.next_attempt, NOW + timedelta(seconds=45))
+
+    def test_restart_failed(self):
+        for _ in range(3):
+            self.health.failure(NOW)
+        self.health.restarting(NOW)
+
+        self.health.restart_failed(NOW)
+
+        self.assertEqual(self.health.state, OPEN)
+        self.assertEqual(self.health.next_attempt, NOW + timedelta(seconds=120))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,12 +1,17 @@
+import asyncio
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, ANY, MagicMock, AsyncMock
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
-from aps2mqtt.main import cli_args, main
+from aps2mqtt.config import MQTTConfig
+from aps2mqtt.health import ECUHealth
+from aps2mqtt.main import cli_args, main, poll_ecu, replay, run, schedule_poll
+from aps2mqtt.refresh import RefreshPredictor
+
 
 class TestMain(unittest.TestCase):
 
-    @patch('aps2mqtt.main.ArgumentParser')
+    @patch("aps2mqtt.main.ArgumentParser")
     def test_cli_args(self, mock_parser):
         # Arrange
         mock_parser_instance = MagicMock()
@@ -24,47 +29,291 @@ class TestMain(unittest.TestCase):
         )
         mock_parser_instance.parse_args.assert_called_once()
 
-    @patch('aps2mqtt.main.Config')
-    @patch('aps2mqtt.main.ECU')
-    @patch('aps2mqtt.main.MQTTHandler')
-    @patch('aps2mqtt.main.time.sleep', side_effect=InterruptedError)  # To break the loop
-    @patch('aps2mqtt.main.datetime')
-    @patch('aps2mqtt.main.cli_args')
-    def test_main_loop(self, mock_cli_args, mock_datetime, mock_sleep, mock_mqtt, mock_ecu, mock_config):
-        # Arrange
-        mock_args = MagicMock()
-        mock_args.config_path = None
-        mock_args.debug_level = False
-        mock_cli_args.return_value = mock_args
-
-        mock_ecu_instance = MagicMock()
-        mock_ecu.return_value = mock_ecu_instance
-        mock_ecu_instance.should_sleep.return_value = False
-        mock_ecu_instance.update.return_value = {"timestamp": "2025-07-20 12:00:00"}
-
-        mock_mqtt_instance = MagicMock()
-        mock_mqtt.return_value = mock_mqtt_instance
-
-        mock_config_instance = MagicMock()
-        mock_config.return_value = mock_config_instance
-        mock_config_instance.ecu_config.timezone = ZoneInfo("UTC")
-
-        # Mock datetime.now to control the loop
-        mock_datetime.now.side_effect = [
-            datetime(2025, 7, 20, 11, 59, 0, tzinfo=timezone.utc), # Before update_time
-            datetime(2025, 7, 20, 12, 0, 1, tzinfo=timezone.utc), # After update_time, to trigger update
-            datetime(2025, 7, 20, 12, 10, 0, tzinfo=timezone.utc)  # After next update_time
+    @patch("aps2mqtt.main.run", new_callable=AsyncMock)
+    @patch("aps2mqtt.main.Config")
+    @patch("aps2mqtt.main.cli_args")
+    def test_main(self, mock_cli_args, mock_config, mock_run):
+        mock_cli_args.return_value.config_path = None
+        mock_cli_args.return_value.debug_level = False
+        mock_cli_args.return_value.record_dir = None
+        mock_cli_args.return_value.replay_dir = None
+
+        main()
+
+        mock_config.assert_called_once_with(None)
+        mock_run.assert_awaited_once_with(mock_config.return_value, None)
+
+    @patch("aps2mqtt.main.replay", new_callable=AsyncMock)
+    @patch("aps2mqtt.main.run", new_callable=AsyncMock)
+    @patch("aps2mqtt.main.Config")
+    @patch("aps2mqtt.main.cli_args")
+    def test_main_replay(self, mock_cli_args, mock_config, mock_run, mock_replay):
+        mock_cli_args.return_value.config_path = None
+        mock_cli_args.return_value.debug_level = False
+        mock_cli_args.return_value.replay_dir = "captures"
+
+        main()
+
+        mock_replay.assert_awaited_once_with(mock_config.return_value, "captures")
+        mock_run.assert_not_awaited()
+
+    @patch("aps2mqtt.main.replay_ecu", new_callable=AsyncMock)
+    @patch("aps2mqtt.main.ReplaySocket")
+    @patch("aps2mqtt.main.os.path.exists", return_value=True)
+    @patch("aps2mqtt.main.ECU")
+    @patch("aps2mqtt.main.MQTTHandler")
+    def test_replay_isolated(self, mock_handler, mock_ecu, _, mock_socket, mock_replay_ecu):
+        for mqtt_env in (
+            {},
+            {
+                "MQTT_DISCOVERY_ENABLED": "True",
+                "MQTT_DISCOVERY_STATE_FILE": "discovery.json",
+                "MQTT_SPOOL_FILE": "spool.db",
+            },
+        ):
+            with self.subTest(mqtt_env=mqtt_env):
+                mock_handler.reset_mock()
+                mock_ecu.reset_mock()
+                conf = MagicMock()
+                conf.mqtt_config = MQTTConfig(mqtt_env)
+                ecu_config = MagicMock()
+                ecu_config.auto_restart = True
+                ecu_config.energy_state_file = "energy.json"
+                conf.ecu_configs = [ecu_config]
+
+                asyncio.run(replay(conf, "captures"))
+
+                # Neither the live ECU nor the live state files are touched
+                mock_handler.assert_called_once_with(conf.mqtt_config)
+                if conf.mqtt_config.discovery_enabled:
+                    self.assertIsNone(conf.mqtt_config.discovery.state_file)
+                self.assertIsNone(conf.mqtt_config.spool_file)
+                mock_ecu.assert_called_once_with(ecu_config)
+                self.assertFalse(ecu_config.auto_restart)
+                self.assertIsNone(ecu_config.energy_state_file)
+                mock_replay_ecu.assert_awaited_with(
+                    mock_ecu.return_value, mock_handler.return_value
+                )
+
+    @patch("aps2mqtt.main.datetime")
+    def test_poll_ecu(self, mock_datetime):
+        ecu = MagicMock()
+        ecu.health = ECUHealth()
+        ecu.should_sleep.return_value = False
+        ecu.async_update = AsyncMock(return_value={"timestamp": "2025-07-20 12:00:00"})
+        mqtt_handler = MagicMock()
+        mqtt_handler.async_publish_values = AsyncMock()
+        ecu_config = MagicMock()
+        ecu_config.timezone = timezone.utc
+        predictor = RefreshPredictor()
+        mock_datetime.strptime.side_effect = datetime.strptime
+        now = datetime(2025, 7, 20, 12, 0, 10, tzinfo=timezone.utc)
+        mock_datetime.now.return_value = now
+
+        update_time = asyncio.run(poll_ecu(ecu, mqtt_handler, ecu_config, predictor))
+
+        ecu.async_update.assert_awaited_once()
+        mqtt_handler.async_publish_values.assert_awaited_once()
+        # Shortly after the next ECU refresh, 5 minutes after its timestamp by default
+        self.assertEqual(update_time, datetime(2025, 7, 20, 12, 5, 30, tzinfo=timezone.utc))
+
+        # Same data again, not published and polled again soon
+        update_time = asyncio.run(poll_ecu(ecu, mqtt_handler, ecu_config, predictor))
+        mqtt_handler.async_publish_values.assert_awaited_once()
+        self.assertEqual(update_time, now + timedelta(seconds=30))
+
+        # Refresh period learned from the timestamps
+        ecu.async_update.return_value = {"timestamp": "2025-07-20 12:04:00"}
+        update_time = asyncio.run(poll_ecu(ecu, mqtt_handler, ecu_config, predictor))
+        self.assertEqual(mqtt_handler.async_publish_values.await_count, 2)
+        self.assertEqual(update_time, datetime(2025, 7, 20, 12, 8, 30, tzinfo=timezone.utc))
+
+    @patch("aps2mqtt.main.datetime")
+    def test_poll_ecu_error(self, mock_datetime):
+        ecu = MagicMock()
+        ecu.health = ECUHealth()
+        ecu.should_sleep.return_value = False
+        ecu.async_update = AsyncMock(side_effect=ValueError("no data"))
+        now = datetime(2025, 7, 20, 12, 0, 0, tzinfo=timezone.utc)
+        mock_datetime.now.return_value = now
+        predictor = RefreshPredictor()
+
+        update_times = [
+            asyncio.run(poll_ecu(ecu, MagicMock(), MagicMock(), predictor)) for _ in range(3)
         ]
-        mock_datetime.strptime.return_value = datetime(2025, 7, 20, 12, 0, 0)
-        mock_datetime.side_effect = lambda *args, **kw: datetime(*args, **kw) if args else mock_datetime.now()
 
-        # Act
-        with self.assertRaises(InterruptedError):
-            main()
+        # Exponential backoff
+        self.assertEqual(update_times, [now + timedelta(seconds=delay) for delay in (60, 120, 240)])
+
+    @patch("aps2mqtt.main.datetime")
+    def test_poll_ecu_publish_error(self, mock_datetime):
+        ecu = MagicMock()
+        ecu.health = ECUHealth()
+        ecu.should_sleep.return_value = False
+        ecu.async_update = AsyncMock(return_value={"timestamp": "2025-07-20 12:00:00"})
+        mqtt_handler = MagicMock()
+        mqtt_handler.async_publish_values = AsyncMock(side_effect=[ConnectionError, None])
+        ecu_config = MagicMock()
+        ecu_config.timezone = timezone.utc
+        mock_datetime.strptime.side_effect = datetime.strptime
+        mock_datetime.now.return_value = datetime(2025, 7, 20, 12, 0, 10, tzinfo=timezone.utc)
+        predictor = RefreshPredictor()
+
+        asyncio.run(poll_ecu(ecu, mqtt_handler, ecu_config, predictor))
+        asyncio.run(poll_ecu(ecu, mqtt_handler, ecu_config, predictor))
+
+        # Data not published are not stale
+        self.assertEqual(mqtt_handler.async_publish_values.await_count, 2)
+
+    @patch("aps2mqtt.main.datetime")
+    def test_poll_ecu_open_circuit(self, mock_datetime):
+        ecu = MagicMock()
+        ecu.health = ECUHealth(failure_threshold=1, min_delay=300)
+        ecu.should_sleep.return_value = False
+        now = datetime(2025, 7, 20, 12, 0, 0, tzinfo=timezone.utc)
+
+        async def failed_update():
+            ecu.health.failure(now)
+            raise ValueError("no data")
+
+        ecu.async_update = failed_update
+        mock_datetime.now.return_value = now
+        mqtt_handler = MagicMock()
+
+        update_time = asyncio.run(poll_ecu(ecu, mqtt_handler, MagicMock(), RefreshPredictor()))
+
+        # Probed after the circuit delay, longer than the poll backoff
+        self.assertEqual(update_time, now + timedelta(seconds=300))
+        mqtt_handler.publish_ecu_status.assert_called_once_with(
+            ecu.ipaddr,
+            {"state": "open", "failures": 1, "next_attempt": "2025-07-20T12:05:00+00:00"},
+        )
+
+    @patch("aps2mqtt.main.datetime")
+    def test_poll_ecu_restarting(self, mock_datetime):
+        ecu = MagicMock()
+        ecu.health = ECUHealth(failure_threshold=1, restart_timeout=300)
+        ecu.should_sleep.return_value = False
+        ecu.async_update = AsyncMock()
+        now = datetime(2025, 7, 20, 12, 0, 0, tzinfo=timezone.utc)
+        ecu.health.failure(now)
+        ecu.health.restarting(now)
+        mock_datetime.now.return_value = now + timedelta(seconds=30)
+
+        update_time = asyncio.run(poll_ecu(ecu, MagicMock(), MagicMock(), RefreshPredictor()))
+
+        # Not queried while restarting, checked again shortly
+        ecu.async_update.assert_not_awaited()
+        self.assertEqual(update_time, now + timedelta(seconds=40))
+
+        # Queried as soon as the ECU is back
+        ecu.health.restarted(now + timedelta(seconds=35))
+        mock_datetime.now.return_value = now + timedelta(seconds=40)
+        asyncio.run(poll_ecu(ecu, MagicMock(), MagicMock(), RefreshPredictor()))
+        ecu.async_update.assert_awaited_once()
+
+    def test_poll_ecu_sleep(self):
+        ecu = MagicMock()
+        ecu.should_sleep.return_value = True
+        ecu.async_update = AsyncMock()
+        ecu.wake_up_time.return_value = datetime(2025, 7, 21, 6, 0, 0, tzinfo=timezone.utc)
+
+        update_time = asyncio.run(poll_ecu(ecu, MagicMock(), MagicMock(), RefreshPredictor()))
+
+        self.assertEqual(update_time, ecu.wake_up_time.return_value)
+        ecu.async_update.assert_not_awaited()
+
+    @patch("aps2mqtt.main.datetime")
+    @patch("aps2mqtt.main.poll_ecu", new_callable=AsyncMock)
+    def test_schedule_poll(self, mock_poll_ecu, mock_datetime):
+        scheduler = MagicMock()
+        now = datetime(2025, 7, 20, 12, 0, 1, tzinfo=timezone.utc)
+        mock_datetime.now.return_value = now
+        mock_poll_ecu.side_effect = [now + timedelta(seconds=359), now - timedelta(seconds=10)]
+
+        schedule_poll(scheduler, "ecu", "mqtt_handler", "ecu_config")
+        delay, poll = scheduler.schedule_in.call_args[0]
+        self.assertEqual(delay, 0)
+
+        # Each poll schedules the next one at the next ECU update
+        asyncio.run(poll())
+        scheduler.schedule_in.assert_called_with(359, poll)
+        mock_poll_ecu.assert_awaited_with("ecu", "mqtt_handler", "ecu_config", ANY)
+
+        # Without polling again right away if the ECU clock is late
+        asyncio.run(poll())
+        scheduler.schedule_in.assert_called_with(5, poll)
+
+    @patch("aps2mqtt.main.ECU")
+    @patch("aps2mqtt.main.MQTTHandler")
+    @patch("aps2mqtt.main.poll_ecu", new_callable=AsyncMock)
+    @patch("aps2mqtt.main.Scheduler")
+    def test_run_polls_every_ecu(self, mock_scheduler, mock_poll_ecu, mock_mqtt, mock_ecu):
+        conf = MagicMock()
+        conf.ecu_configs = [MagicMock(), MagicMock()]
+        conf.metrics_config.enabled = False
+        conf.decode_config.workers = 0
+        mock_ecu.side_effect = lambda ecu_config: ecu_config.ecu
+        mock_scheduler.return_value.run = AsyncMock()
+        mock_poll_ecu.return_value = datetime.now(timezone.utc)
+
+        asyncio.run(run(conf))
+
+        # A single broker connection shared by all the ECUs
+        mock_mqtt.return_value.connect_mqtt.assert_called_once()
+        mock_scheduler.return_value.run.assert_awaited_once()
+        # A first poll of each ECU scheduled right away
+        schedule_in_calls = list(mock_scheduler.return_value.schedule_in.call_args_list)
+        self.assertEqual([call.args[0] for call in schedule_in_calls], [0, 0])
+        for call in schedule_in_calls:
+            asyncio.run(call.args[1]())
+        self.assertEqual(mock_poll_ecu.await_count, 2)
+        for ecu_config in conf.ecu_configs:
+            mock_poll_ecu.assert_any_await(ecu_config.ecu, mock_mqtt.return_value, ecu_config, ANY)
+
+    @patch("aps2mqtt.main.ECU")
+    @patch("aps2mqtt.main.MQTTHandler")
+    @patch("aps2mqtt.main.Scheduler")
+    @patch("aps2mqtt.main.MetricsServer")
+    @patch("aps2mqtt.main.METRICS")
+    def test_run_metrics(self, mock_metrics, mock_server, mock_scheduler, mock_mqtt, mock_ecu):
+        conf = MagicMock()
+        conf.ecu_configs = []
+        conf.metrics_config.enabled = True
+        conf.metrics_config.host = "127.0.0.1"
+        conf.metrics_config.port = 9880
+        conf.decode_config.workers = 0
+        mock_scheduler.return_value.run = AsyncMock()
+
+        asyncio.run(run(conf))
+
+        mock_metrics.enable.assert_called_once()
+        mock_server.assert_called_once_with(mock_metrics, "127.0.0.1", 9880)
+        mock_server.return_value.start.assert_called_once()
+
+    @patch("aps2mqtt.main.ECU")
+    @patch("aps2mqtt.main.MQTTHandler")
+    @patch("aps2mqtt.main.Scheduler")
+    @patch("aps2mqtt.decoder.DecoderPool")
+    def test_run_decoder_pool(self, mock_pool, mock_scheduler, mock_mqtt, mock_ecu):
+        conf = MagicMock()
+        conf.ecu_configs = [MagicMock(), MagicMock()]
+        conf.ecu_configs[0].energy_integration = False
+        conf.ecu_configs[1].energy_integration = True
+        conf.metrics_config.enabled = False
+        conf.decode_config.workers = 4
+        mock_ecu.side_effect = lambda ecu_config: ecu_config.ecu
+        mock_scheduler.return_value.run = AsyncMock()
+
+        asyncio.run(run(conf))
+
+        mock_pool.assert_called_once_with(4, mock_mqtt.return_value.worker_payload_options())
+        decoders = [ecu_config.ecu.socket.decoder for ecu_config in conf.ecu_configs]
+        self.assertEqual([decoder.func for decoder in decoders], [mock_pool.return_value.decode] * 2)
+        # Payloads of the ECU with energy integration are built after adding the energy
+        self.assertEqual([decoder.keywords for decoder in decoders], [{"payloads": True}, {"payloads": False}])
+        mock_pool.return_value.shutdown.assert_called_once()
 
-        # Assert
-        mock_ecu_instance.update.assert_called_once()
-        mock_mqtt_instance.publish_values.assert_called_once()
 
-if __name__ == '__main__':
+if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,186 @@
+import unittest
+import urllib.error
+import urllib.request
+from aps2mqtt.apsystems import frames
+from aps2mqtt.apsystems.APSystemsSocket import APSystemsSocket
+from aps2mqtt.apsystems.snapshot import numpy_available
+from aps2mqtt.metrics import CONTENT_TYPE, Histogram, Metrics, MetricsServer
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_cumulative_counts(self):
+        histogram = Histogram(buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 5):
+            histogram.observe(value)
+
+        self.assertEqual(
+            list(histogram.cumulative_counts()), [(0.1, 2), (1, 3), (float("inf"), 4)]
+        )
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 5.65)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.enable()
+
+    def test_disabled(self):
+        metrics = Metrics()
+
+        metrics.inc("aps_timeouts_total", ecu="1.2.3.4")
+        metrics.set("aps_ecu_current_power_watts", 42, ecu="216000000001")
+        metrics.observe("aps_parse_seconds", 0.1)
+        with metrics.timer("aps_update_seconds"):
+            pass
+
+        self.assertEqual(metrics.render(), "\n")
+
+    def test_counter(self):
+        self.metrics.inc("aps_timeouts_total", ecu="1.2.3.4")
+        self.metrics.inc("aps_timeouts_total", ecu="1.2.3.4")
+        self.metrics.inc("aps_timeouts_total", ecu="1.2.3.5")
+
+        self.assertEqual(
+            self.metrics.render(),
+            "# HELP aps_timeouts_total ECU commands without reply before the timeout\n"
+            "# TYPE aps_timeouts_total counter\n"
+            'aps_timeouts_total{ecu="1.2.3.4"} 2\n'
+            'aps_timeouts_total{ecu="1.2.3.5"} 1\n',
+        )
+
+    def test_histogram(self):
+        self.metrics.observe("aps_mqtt_publish_seconds", 0.2)
+        self.metrics.observe("aps_mqtt_publish_seconds", 60.0)
+
+        lines = self.metrics.render().splitlines()
+
+        self.assertIn("# TYPE aps_mqtt_publish_seconds histogram", lines)
+        self.assertIn('aps_mqtt_publish_seconds_bucket{le="0.1"} 0', lines)
+        self.assertIn('aps_mqtt_publish_seconds_bucket{le="0.25"} 1', lines)
+        self.assertIn('aps_mqtt_publish_seconds_bucket{le="30"} 1', lines)
+        self.assertIn('aps_mqtt_publish_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn("aps_mqtt_publish_seconds_sum 60.2", lines)
+        self.assertIn("aps_mqtt_publish_seconds_count 2", lines)
+
+    def test_timer(self):
+        with self.metrics.timer("aps_parse_seconds", command="ecu"):
+            pass
+        with self.assertRaises(ValueError):
+            with self.metrics.timer("aps_parse_seconds", command="ecu"):
+                raise ValueError()
+
+        # Only the successful block is recorded
+        self.assertIn('aps_parse_seconds_count{command="ecu"} 1', self.metrics.render())
+
+    def test_label_escaping(self):
+        self.metrics.set("aps_ecu_current_power_watts", 1, ecu='a"b\\c')
+
+        self.assertIn('aps_ecu_current_power_watts{ecu="a\\"b\\\\c"} 1', self.metrics.render())
+
+    def test_record_ecu_data(self):
+        self.metrics.record_ecu_data(
+            {
+                "ecu_id": "216000000001",
+                "current_power": 450,
+                "today_energy": 2.5,
+                "lifetime_energy": 1000.25,
+                "qty_of_inverters": 2,
+                "qty_of_online_inverters": 1,
+                "inverters": [
+                    {
+                        "uid": "408000000001",
+                        "online": True,
+                        "signal": 200,
+                        "temperature": 35,
+                        "frequency": 50.0,
+                        "power": [220, 230],
+                        "voltage": [238, 239],
+                    },
+                    {"uid": "408000000002", "online": False},
+                ],
+            }
+        )
+
+        lines = self.metrics.render().splitlines()
+
+        self.assertIn('aps_ecu_current_power_watts{ecu="216000000001"} 450', lines)
+        self.assertIn('aps_ecu_lifetime_energy_kwh{ecu="216000000001"} 1000.25', lines)
+        self.assertIn(
+            'aps_inverter_online{ecu="216000000001",inverter="408000000002"} 0', lines
+        )
+        self.assertIn(
+            'aps_panel_power_watts{ecu="216000000001",inverter="408000000001",panel="2"} 230',
+            lines,
+        )
+        # Only the online state of an offline inverter
+        self.assertEqual(sum('inverter="408000000002"' in line for line in lines), 1)
+        # No snapshot, no aggregate
+        self.assertFalse(any(line.startswith("aps_model_") for line in lines))
+
+    @unittest.skipUnless(numpy_available(), "numpy is not installed")
+    def test_record_ecu_data_snapshot(self):
+        records = [
+            frames.inverter_record(frames.inverter_uid(0), "01", power=[100, 110], temperature=30),
+            frames.inverter_record(frames.inverter_uid(1), "01", power=[120, 130], temperature=35),
+            frames.inverter_record(frames.inverter_uid(2), "03", online=False),
+        ]
+        aps_socket = APSystemsSocket(
+            "127.0.0.1", raw_inverter=frames.inverter_frame(records), snapshot=True
+        )
+        aps_socket.inverter_raw_signal = frames.signal_frame(
+            [(frames.inverter_uid(i), 255) for i in range(len(records))]
+        )
+        aps_socket.qty_of_inverters = len(records)
+        data = aps_socket.process_inverter_data()
+        data.update(
+            {
+                "ecu_id": "216000000001",
+                "current_power": 460,
+                "today_energy": 2.5,
+                "lifetime_energy": 1000.25,
+                "qty_of_inverters": 3,
+                "qty_of_online_inverters": 2,
+            }
+        )
+
+        self.metrics.record_ecu_data(data)
+
+        lines = self.metrics.render().splitlines()
+        models = {inverter["model"] for inverter in data["inverters"]}
+        self.assertEqual(len(models), 2)
+        model = data["inverters"][0]["model"]
+        self.assertIn(f'aps_model_inverters{{ecu="216000000001",model="{model}"}} 2', lines)
+        self.assertIn(f'aps_model_power_watts{{ecu="216000000001",model="{model}"}} 460.0', lines)
+        self.assertIn('aps_ecu_max_temperature_celsius{ecu="216000000001"} 35.0', lines)
+
+
+class TestMetricsServer(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.metrics.enable()
+        self.server = MetricsServer(self.metrics, "127.0.0.1", 0)
+        self.port = self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_metrics_endpoint(self):
+        self.metrics.inc("aps_retries_total", ecu="1.2.3.4")
+
+        with urllib.request.urlopen(f"http://127.0.0.1:{self.port}/metrics", timeout=5) as resp:
+            self.assertEqual(resp.headers["Content-Type"], CONTENT_TYPE)
+            self.assertIn('aps_retries_total{ecu="1.2.3.4"} 1', resp.read().decode())
+
+    def test_unknown_path(self):
+        with self.assertRaises(urllib.error.HTTPError) as ctx:
+            urllib.request.urlopen(f"http://127.0.0.1:{self.port}/", timeout=5)
+        self.assertEqual(ctx.exception.code, 404)
+        ctx.exception.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
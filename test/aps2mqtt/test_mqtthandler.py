@@ -1,6 +1,14 @@
+import asyncio
+import importlib.util
+import os
+import tempfile
+import threading
 import unittest
 from unittest.mock import MagicMock, patch, call
 import json
+from aps2mqtt.apsystems import frames
+from aps2mqtt.apsystems.APSystemsSocket import APSystemsSocket
+from aps2mqtt.apsystems.snapshot import numpy_available
 from aps2mqtt.mqtthandler import MQTTHandler
 
 
@@ -10,8 +18,15 @@ class TestMQTTHandler(unittest.TestCase):
         self.mock_mqtt_config = MagicMock()
         self.mock_mqtt_config.discovery_enabled = True
         self.mock_mqtt_config.discovery.prefix = "homeassistant"
+        self.mock_mqtt_config.discovery.state_file = None
         self.mock_mqtt_config.topic_prefix = "aps2mqtt"
         self.mock_mqtt_config.retain = False
+        self.mock_mqtt_config.publish_on_change = False
+        self.mock_mqtt_config.qos = 0
+        self.mock_mqtt_config.payload_mode = "topics"
+        self.mock_mqtt_config.payload_encoding = "json"
+        self.mock_mqtt_config.publish_timeout = 10
+        self.mock_mqtt_config.spool_file = None
         self.handler = MQTTHandler(self.mock_mqtt_config)
         self.handler.client = MagicMock()
 
@@ -68,6 +83,397 @@ class TestMQTTHandler(unittest.TestCase):
             self.assertEqual(payload["payload_available"], "online")
             self.assertEqual(payload["payload_not_available"], "offline")
 
+    def test_publish_discovery_messages_per_ecu(self):
+        data = {"ecu_id": "123456789", "inverters": []}
+
+        with patch.object(self.handler, "_publish") as mock_publish:
+            self.handler.publish_discovery_messages(data)
+            first_count = mock_publish.call_count
+            self.handler.publish_discovery_messages(data)
+            self.assertEqual(mock_publish.call_count, first_count)
+            self.handler.publish_discovery_messages({"ecu_id": "987654321", "inverters": []})
+            self.assertEqual(mock_publish.call_count, 2 * first_count)
+
+    def _discovery_topics(self, publish_calls):
+        return [args[1] for args, kwargs in publish_calls]
+
+    def test_publish_discovery_messages_new_inverter(self):
+        inverter = {"uid": "987654321", "power": [150, 150], "voltage": [240, 240]}
+        data = {"ecu_id": "123456789", "inverters": [inverter]}
+
+        with patch.object(self.handler, "_publish", return_value=True) as mock_publish:
+            self.handler.publish_discovery_messages(data)
+            self.assertEqual(mock_publish.call_count, 13)
+
+            mock_publish.reset_mock()
+            data["inverters"].append(dict(inverter, uid="987654322"))
+            self.handler.publish_discovery_messages(data)
+            topics = self._discovery_topics(mock_publish.call_args_list)
+            self.assertEqual(len(topics), 10)
+            self.assertTrue(all("aps_987654322_" in topic for topic in topics))
+
+    def test_publish_discovery_messages_removed_panel(self):
+        inverter = {"uid": "987654321", "power": [150, 150], "voltage": [240, 240]}
+        data = {"ecu_id": "123456789", "inverters": [inverter]}
+
+        with patch.object(self.handler, "_publish", return_value=True) as mock_publish:
+            self.handler.publish_discovery_messages(data)
+            mock_publish.reset_mock()
+            inverter["power"] = [150]
+            self.handler.publish_discovery_messages(data)
+
+            # Unchanged entities are not published again, the removed one is cleared
+            mock_publish.assert_called_once_with(
+                self.handler.client,
+                "homeassistant/sensor/aps_987654321_panel_2_power/config",
+                "",
+                retain=True,
+            )
+
+    def test_publish_discovery_messages_failed(self):
+        data = {"ecu_id": "123456789", "inverters": []}
+
+        with patch.object(self.handler, "_publish", return_value=False) as mock_publish:
+            self.handler.publish_discovery_messages(data)
+            self.handler.publish_discovery_messages(data)
+            self.assertEqual(mock_publish.call_count, 6)
+
+    def test_publish_discovery_messages_state_file(self):
+        data = {
+            "ecu_id": "123456789",
+            "inverters": [{"uid": "987654321", "power": [150, 150], "voltage": [240, 240]}],
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.mock_mqtt_config.discovery.state_file = os.path.join(tmp_dir, "discovery.json")
+            handler = MQTTHandler(self.mock_mqtt_config)
+            with patch.object(handler, "_publish", return_value=True) as mock_publish:
+                handler.publish_discovery_messages(data)
+                self.assertEqual(mock_publish.call_count, 13)
+
+            # After a restart, nothing is published again
+            handler = MQTTHandler(self.mock_mqtt_config)
+            with patch.object(handler, "_publish", return_value=True) as mock_publish:
+                handler.publish_discovery_messages(data)
+                mock_publish.assert_not_called()
+
+            # Unless the discovery payloads changed
+            self.mock_mqtt_config.topic_prefix = "other"
+            handler = MQTTHandler(self.mock_mqtt_config)
+            with patch.object(handler, "_publish", return_value=True) as mock_publish:
+                handler.publish_discovery_messages(data)
+                self.assertEqual(mock_publish.call_count, 13)
+
+    def test_invalid_discovery_state_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            state_file = os.path.join(tmp_dir, "discovery.json")
+            with open(state_file, "w", encoding="UTF-8") as f:
+                f.write("not json")
+            self.mock_mqtt_config.discovery.state_file = state_file
+            handler = MQTTHandler(self.mock_mqtt_config)
+            self.assertEqual(handler.discovery_state, {})
+
+    def _publish_result(self, mid, rc=0):
+        result = MagicMock()
+        result.mid = mid
+        result.rc = rc
+        return result
+
+    def test_publish_acknowledgement(self):
+        self.handler.client.publish.side_effect = [self._publish_result(1), self._publish_result(2)]
+        with patch("aps2mqtt.mqtthandler.time.monotonic", side_effect=[10, 10.5, 11]):
+            self.handler._publish(self.handler.client, "topic", "1")
+            self.handler.on_publish(None, None, 1, 0, None)
+            self.handler._publish(self.handler.client, "topic", "2")
+
+        stats = self.handler.publish_stats
+        self.assertEqual(stats.sent, 2)
+        self.assertEqual(stats.acknowledged, 1)
+        self.assertEqual(stats.last_latency, 0.5)
+        self.assertEqual(self.handler._pending, {2: 11})
+
+    def test_publish_acknowledged_before_return(self):
+        def publish(topic, msg, qos, retain):
+            # Acknowledgement received by the network thread before publish returns
+            self.handler.on_publish(None, None, 3, 0, None)
+            return self._publish_result(3)
+
+        self.handler.client.publish.side_effect = publish
+        self.handler._publish(self.handler.client, "topic", "msg")
+
+        self.assertEqual(self.handler.publish_stats.acknowledged, 1)
+        self.assertEqual(self.handler._pending, {})
+        self.assertEqual(self.handler._early_acks, set())
+
+    def test_publish_dropped(self):
+        self.handler.client.publish.side_effect = [self._publish_result(1, rc=15), self._publish_result(2)]
+        self.assertIsNone(self.handler._publish(self.handler.client, "topic", "1"))
+        self.assertIsNotNone(self.handler._publish(self.handler.client, "topic", "2"))
+
+        # Pending QoS 0 messages are lost on disconnection
+        self.handler.on_disconnect(None, None, None, 7, None)
+        self.assertEqual(self.handler.publish_stats.dropped, 2)
+        self.assertEqual(self.handler._pending, {})
+
+    def test_wait_for_delivery(self):
+        delivered = MagicMock()
+        delivered.is_published.return_value = True
+        lost = MagicMock()
+        lost.is_published.return_value = False
+        queue_full = MagicMock()
+        queue_full.wait_for_publish.side_effect = ValueError("queue full")
+        queue_full.is_published.side_effect = ValueError("queue full")
+
+        self.assertTrue(self.handler.wait_for_delivery([delivered]))
+        self.assertFalse(self.handler.wait_for_delivery([delivered, lost, queue_full]))
+        self.assertEqual(self.handler.publish_stats.unacknowledged, 2)
+        delivered.wait_for_publish.assert_called()
+
+    @patch("aps2mqtt.mqtthandler.asyncio.sleep")
+    def test_async_publish_values_not_connected(self, mock_sleep):
+        self.handler.client.is_connected.return_value = False
+
+        with self.assertRaises(ConnectionError):
+            asyncio.run(self.handler.async_publish_values({}))
+        self.assertEqual(mock_sleep.await_count, 10)
+
+    def test_async_publish_values(self):
+        data = {
+            "ecu_id": "123456789",
+            "current_power": 100,
+            "today_energy": 200,
+            "lifetime_energy": 300,
+            "inverters": [],
+        }
+        self.handler.client.is_connected.return_value = True
+        self.handler.client.publish.return_value.rc = 0
+
+        asyncio.run(self.handler.async_publish_values(data))
+
+        args, kwargs = self.handler.client.publish.call_args
+        self.assertEqual(args[0], "aps2mqtt/aps/123456789")
+        self.assertEqual(
+            json.loads(args[1]),
+            {"current_power": 100, "today_energy": 200, "lifetime_energy": 300},
+        )
+        self.assertEqual(kwargs, {"qos": 0, "retain": False})
+
+    def test_publish_values_worker_payloads(self):
+        self.mock_mqtt_config.discovery_enabled = False
+        handler = MQTTHandler(self.mock_mqtt_config)
+        handler.client = self.handler.client
+        handler.client.is_connected.return_value = True
+        handler.client.publish.return_value.rc = 0
+        data = {"ecu_id": "123456789", "current_power": 100, "today_energy": 200,
+                "lifetime_energy": 300, "inverters": [],
+                "payloads": {"aps2mqtt/aps/123456789": b'{"current_power":100}'}}
+
+        handler.publish_values(data)
+
+        handler.client.publish.assert_called_once_with(
+            "aps2mqtt/aps/123456789", b'{"current_power":100}', qos=0, retain=False)
+
+    def test_publish_ecu_status(self):
+        self.handler.client.is_connected.return_value = True
+        self.handler.client.publish.return_value.rc = 0
+        status = {"state": "open", "failures": 5, "next_attempt": "2025-07-20T12:05:00+00:00"}
+
+        self.handler.publish_ecu_status("192.168.1.10", status)
+        # Unchanged status not published again
+        self.handler.publish_ecu_status("192.168.1.10", dict(status))
+
+        self.handler.client.publish.assert_called_once()
+        args, kwargs = self.handler.client.publish.call_args
+        self.assertEqual(args[0], "aps2mqtt/aps/status/192.168.1.10")
+        self.assertEqual(json.loads(args[1]), status)
+        self.assertTrue(kwargs["retain"])
+
+    def test_publish_ecu_status_not_connected(self):
+        self.handler.client.is_connected.return_value = False
+
+        self.handler.publish_ecu_status("192.168.1.10", {"state": "healthy"})
+
+        self.handler.client.publish.assert_not_called()
+        self.assertEqual(self.handler.ecu_statuses, {})
+
+    def test_worker_payload_options(self):
+        self.assertEqual(self.handler.worker_payload_options(), ("aps2mqtt/", "topics", "json"))
+
+        # Payloads compared to the published ones
+        self.mock_mqtt_config.publish_on_change = True
+        self.mock_mqtt_config.deadbands = {}
+        self.mock_mqtt_config.full_refresh_interval = 60
+        self.assertIsNone(MQTTHandler(self.mock_mqtt_config).worker_payload_options())
+
+    def _spool_handler(self, tmp_dir, drain_rate=0):
+        self.mock_mqtt_config.discovery_enabled = False
+        self.mock_mqtt_config.spool_file = os.path.join(tmp_dir, "spool.db")
+        self.mock_mqtt_config.spool_max_messages = 100
+        self.mock_mqtt_config.spool_drain_rate = drain_rate
+        handler = MQTTHandler(self.mock_mqtt_config)
+        handler.client = self.handler.client
+        handler.client.publish.return_value.rc = 0
+        handler.client.publish.return_value.is_published.return_value = True
+        self.addCleanup(handler.spool.close)
+        return handler
+
+    def _ecu_data(self, timestamp, power):
+        return {"ecu_id": "123456789", "timestamp": timestamp, "current_power": power,
+                "today_energy": 200, "lifetime_energy": 300,
+                "inverters": [{"uid": "987654321", "online": False}]}
+
+    def test_publish_values_spooled(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            handler = self._spool_handler(tmp_dir)
+            handler.client.is_connected.return_value = False
+
+            self.assertFalse(handler.publish_values(self._ecu_data("2025-07-20 12:00:00", 100)))
+            self.assertFalse(
+                asyncio.run(handler.async_publish_values(self._ecu_data("2025-07-20 12:05:00", 110)))
+            )
+            handler.client.publish.assert_not_called()
+            self.assertEqual(len(handler.spool), 4)
+
+            # Spooled messages published first and in order, with their timestamp
+            handler.client.is_connected.return_value = True
+            self.assertTrue(handler.publish_values(self._ecu_data("2025-07-20 12:10:00", 120)))
+
+            published = [(args[0], json.loads(args[1])) for args, _ in handler.client.publish.call_args_list]
+            self.assertEqual(
+                [(topic, payload.get("timestamp")) for topic, payload in published],
+                [
+                    ("aps2mqtt/aps/123456789", "2025-07-20 12:00:00"),
+                    ("aps2mqtt/aps/123456789/987654321", "2025-07-20 12:00:00"),
+                    ("aps2mqtt/aps/123456789", "2025-07-20 12:05:00"),
+                    ("aps2mqtt/aps/123456789/987654321", "2025-07-20 12:05:00"),
+                    ("aps2mqtt/aps/123456789", None),
+                    ("aps2mqtt/aps/123456789/987654321", None),
+                ],
+            )
+            self.assertEqual(published[2][1]["current_power"], 110)
+            self.assertEqual(len(handler.spool), 0)
+
+    def test_drain_spool_not_acknowledged(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            handler = self._spool_handler(tmp_dir)
+            self.mock_mqtt_config.publish_timeout = 0
+            handler.client.is_connected.return_value = False
+            handler.publish_values(self._ecu_data("2025-07-20 12:00:00", 100))
+
+            handler.client.is_connected.return_value = True
+            handler.client.publish.return_value.is_published.return_value = False
+            self.assertFalse(handler.publish_values(self._ecu_data("2025-07-20 12:05:00", 110)))
+
+            # Kept until acknowledged, the new data after them
+            self.assertEqual(len(handler.spool), 4)
+
+    @patch("aps2mqtt.mqtthandler.time.sleep")
+    def test_drain_spool_rate(self, mock_sleep):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            handler = self._spool_handler(tmp_dir, drain_rate=2)
+            handler.spool.append([("topic", b"1"), ("topic", b"2"), ("topic", b"3")])
+            handler.client.is_connected.return_value = True
+
+            with patch("aps2mqtt.mqtthandler.time.monotonic", return_value=100):
+                self.assertTrue(handler.drain_spool())
+
+            self.assertEqual([args[0] for args, _ in mock_sleep.call_args_list], [0.5, 1.0])
+            self.assertEqual(handler.client.publish.call_count, 3)
+
+    def test_drain_spool_once(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            handler = self._spool_handler(tmp_dir)
+            handler.spool.append([("topic", b"1")])
+            handler.client.is_connected.return_value = True
+            result = handler.client.publish.return_value
+            draining = threading.Event()
+            release = threading.Event()
+
+            def publish(*args, **kwargs):
+                draining.set()
+                release.wait(5)
+                return result
+
+            handler.client.publish.side_effect = publish
+            drain = threading.Thread(target=handler.drain_spool)
+            drain.start()
+            draining.wait(5)
+
+            # Spooled behind the messages being drained by the other update
+            self.assertFalse(handler.publish_values(self._ecu_data("2025-07-20 12:00:00", 100)))
+            self.assertEqual(handler.client.publish.call_count, 1)
+            release.set()
+            drain.join(5)
+
+            self.assertEqual(
+                [args[0] for args, _ in handler.client.publish.call_args_list],
+                ["topic", "aps2mqtt/aps/123456789", "aps2mqtt/aps/123456789/987654321"],
+            )
+            self.assertEqual(len(handler.spool), 0)
+
+    def test_publish_values_on_change(self):
+        self.mock_mqtt_config.discovery_enabled = False
+        self.mock_mqtt_config.publish_on_change = True
+        self.mock_mqtt_config.deadbands = {"voltage": 1}
+        self.mock_mqtt_config.full_refresh_interval = 60
+        handler = MQTTHandler(self.mock_mqtt_config)
+        handler.client = self.handler.client
+        handler.client.is_connected.return_value = True
+        handler.client.publish.return_value.rc = 0
+        inverter = {"uid": "987654321", "online": True, "signal": 80, "temperature": 50,
+                    "frequency": 60, "power": [150, 150], "voltage": [240, 240]}
+        data = {"ecu_id": "123456789", "current_power": 300, "today_energy": 200,
+                "lifetime_energy": 300, "inverters": [inverter]}
+
+        handler.publish_values(data)
+        self.assertEqual(handler.client.publish.call_count, 2)
+
+        # Voltage within its deadband, ECU unchanged: nothing published
+        inverter["voltage"] = [241, 240]
+        handler.publish_values(data)
+        self.assertEqual(handler.client.publish.call_count, 2)
+
+        inverter["power"] = [151, 150]
+        handler.publish_values(data)
+        self.assertEqual(handler.client.publish.call_count, 3)
+        self.assertEqual(handler.client.publish.call_args[0][0], "aps2mqtt/aps/123456789/987654321")
+
+        # Everything is published again after a reconnection
+        handler.on_connect(handler.client, None, None, 0, None)
+        handler.client.publish.reset_mock()
+        handler.publish_values(data)
+        self.assertEqual(handler.client.publish.call_count, 2)
+
+    def test_publish_values_on_change_not_delivered(self):
+        self.mock_mqtt_config.discovery_enabled = False
+        self.mock_mqtt_config.publish_on_change = True
+        self.mock_mqtt_config.deadbands = {}
+        self.mock_mqtt_config.full_refresh_interval = 60
+        self.mock_mqtt_config.publish_timeout = 0
+        handler = MQTTHandler(self.mock_mqtt_config)
+        handler.client = self.handler.client
+        handler.client.is_connected.return_value = True
+        data = {"ecu_id": "123456789", "current_power": 300, "today_energy": 200,
+                "lifetime_energy": 300, "inverters": []}
+
+        # Not sent
+        handler.client.publish.return_value.rc = 4
+        handler.publish_values(data)
+        self.assertEqual(handler.client.publish.call_count, 1)
+
+        # Sent, not acknowledged
+        handler.client.publish.return_value.rc = 0
+        handler.client.publish.return_value.is_published.return_value = False
+        handler.publish_values(data)
+        self.assertEqual(handler.client.publish.call_count, 2)
+
+        handler.client.publish.return_value.is_published.return_value = True
+        handler.publish_values(data)
+        self.assertEqual(handler.client.publish.call_count, 3)
+
+        # Delivered, not published again
+        handler.publish_values(data)
+        self.assertEqual(handler.client.publish.call_count, 3)
+
     def test_parse_data(self):
         data = {
             "ecu_id": "123456789",
@@ -108,6 +514,141 @@ class TestMQTTHandler(unittest.TestCase):
         self.assertEqual(inverter_payload["panel_2_power"], 150)
         self.assertEqual(inverter_payload["panel_2_voltage"], 240)
 
+    def _aggregated_data(self):
+        return {
+            "ecu_id": "123456789",
+            "current_power": 100,
+            "today_energy": 200,
+            "lifetime_energy": 300,
+            "inverters": [
+                {"uid": "987654321", "online": False, "power": [0, 0], "voltage": [0, 0]},
+                {"uid": "987654322", "online": True, "signal": 80, "temperature": 50,
+                 "frequency": 60, "power": [150, 150], "voltage": [240, 240]},
+            ],
+        }
+
+    @unittest.skipUnless(importlib.util.find_spec("msgpack"), "msgpack is not installed")
+    def test_parse_data_msgpack(self):
+        import msgpack
+
+        self.mock_mqtt_config.payload_encoding = "msgpack"
+        handler = MQTTHandler(self.mock_mqtt_config)
+
+        parsed_data = handler._parse_data(self._aggregated_data())
+
+        ecu_payload = msgpack.unpackb(parsed_data["aps2mqtt/aps/123456789"])
+        self.assertEqual(ecu_payload["current_power"], 100)
+
+    def test_parse_data_aggregated(self):
+        self.mock_mqtt_config.payload_mode = "aggregated"
+
+        parsed_data = self.handler._parse_data(self._aggregated_data())
+
+        self.assertEqual(list(parsed_data), ["aps2mqtt/aps/123456789"])
+        ecu_payload = json.loads(parsed_data["aps2mqtt/aps/123456789"])
+        self.assertEqual(ecu_payload["current_power"], 100)
+        self.assertEqual(ecu_payload["inverters"]["987654321"], {"online": False})
+        self.assertEqual(ecu_payload["inverters"]["987654322"]["power"], 300)
+        self.assertEqual(ecu_payload["inverters"]["987654322"]["panel_2_voltage"], 240)
+
+    def test_parse_data_energy(self):
+        data = self._aggregated_data()
+        data["inverters"][0].update(today_energy=0.5, panel_today_energy=[0.2, 0.3])
+        data["inverters"][1].update(
+            today_energy=1.5, panel_today_energy=[0.7, 0.8], avg_power=290.5, peak_power=310
+        )
+
+        parsed_data = self.handler._parse_data(data)
+
+        offline = json.loads(parsed_data["aps2mqtt/aps/123456789/987654321"])
+        self.assertEqual(
+            offline,
+            {"online": False, "today_energy": 0.5, "panel_1_today_energy": 0.2,
+             "panel_2_today_energy": 0.3},
+        )
+        inverter = json.loads(parsed_data["aps2mqtt/aps/123456789/987654322"])
+        self.assertEqual(inverter["today_energy"], 1.5)
+        self.assertEqual(inverter["panel_2_today_energy"], 0.8)
+        self.assertEqual(inverter["avg_power"], 290.5)
+        self.assertEqual(inverter["peak_power"], 310)
+
+    def test_discovery_energy(self):
+        inverter = {"uid": "987654321", "online": False, "today_energy": 0.5,
+                    "panel_today_energy": [0.2, 0.3]}
+
+        topics = [topic for topic, _ in self.handler._inverter_discovery_payloads("123456789", inverter)]
+
+        self.assertIn("homeassistant/sensor/aps_987654321_today_energy/config", topics)
+        self.assertIn("homeassistant/sensor/aps_987654321_peak_power/config", topics)
+        self.assertIn("homeassistant/sensor/aps_987654321_panel_2_today_energy/config", topics)
+
+    def test_parse_data_both(self):
+        self.mock_mqtt_config.payload_mode = "both"
+
+        parsed_data = self.handler._parse_data(self._aggregated_data())
+
+        self.assertEqual(len(parsed_data), 3)
+        ecu_payload = json.loads(parsed_data["aps2mqtt/aps/123456789"])
+        inverter_payload = json.loads(parsed_data["aps2mqtt/aps/123456789/987654322"])
+        self.assertEqual(ecu_payload["inverters"]["987654322"], inverter_payload)
+
+    def test_discovery_aggregated(self):
+        self.mock_mqtt_config.payload_mode = "aggregated"
+        data = {"ecu_id": "123456789", "inverters": [{"uid": "987654321", "power": [1, 2], "voltage": [1, 2]}]}
+
+        with patch.object(self.handler, "_publish") as mock_publish:
+            self.handler.publish_discovery_messages(data)
+
+        payloads = {args[1]: json.loads(args[2]) for args, kwargs in mock_publish.call_args_list}
+        online = payloads["homeassistant/binary_sensor/aps_987654321_online/config"]
+        self.assertEqual(online["state_topic"], "aps2mqtt/aps/123456789")
+        self.assertEqual(online["value_template"], "{{ value_json.inverters['987654321'].online }}")
+        panel = payloads["homeassistant/sensor/aps_987654321_panel_2_power/config"]
+        self.assertEqual(panel["state_topic"], "aps2mqtt/aps/123456789")
+        self.assertEqual(
+            panel["value_template"], "{{ value_json.inverters['987654321'].panel_2_power }}"
+        )
+        ecu_power = payloads["homeassistant/sensor/aps_123456789_power/config"]
+        self.assertEqual(ecu_power["value_template"], "{{ value_json.current_power }}")
+
+
+    def _snapshot_data(self, uid, power, voltage):
+        aps_socket = APSystemsSocket(
+            "127.0.0.1",
+            raw_inverter=frames.inverter_frame(
+                [frames.inverter_record(uid, "01", power=power, voltage=voltage)]
+            ),
+            snapshot=True,
+        )
+        aps_socket.inverter_raw_signal = frames.signal_frame([(uid, 255)])
+        aps_socket.qty_of_inverters = 1
+        data = aps_socket.process_inverter_data()
+        data.update({"ecu_id": "123456789", "current_power": 301, "today_energy": 2, "lifetime_energy": 3})
+        return data
+
+    @unittest.skipUnless(numpy_available(), "numpy is not installed")
+    def test_parse_data_snapshot(self):
+        uid = "806000000001"
+        data = self._snapshot_data(uid, [150, 151], [240, 241])
+
+        parsed_data = self.handler._parse_data(data)
+
+        inverter_payload = json.loads(parsed_data["aps2mqtt/aps/123456789/" + uid])
+        self.assertEqual(inverter_payload["power"], 301)
+        self.assertEqual(inverter_payload["voltage"], 240.5)
+        self.assertEqual(inverter_payload["panel_2_power"], 151)
+
+    @unittest.skipUnless(numpy_available(), "numpy is not installed")
+    def test_parse_data_snapshot_types(self):
+        for voltage in ([240, 241], [240, 240]):
+            with self.subTest(voltage=voltage):
+                data = self._snapshot_data("806000000001", [150, 151], voltage)
+
+                parsed_data = self.handler._parse_data(data)
+
+                # Same payloads as without snapshot, sums and integral means are ints
+                del data["snapshot"]
+                self.assertEqual(parsed_data, self.handler._parse_data(data))
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+from aps2mqtt.payloadcache import PayloadCache
+
+
+class TestPayloadCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = PayloadCache({"voltage": 1, "temperature": 1}, refresh_interval=600)
+        self.cache.published("topic", {"online": True, "power": 100, "voltage": 230, "panel_1_voltage": 230}, now=0)
+
+    def test_unknown_topic(self):
+        self.assertTrue(self.cache.should_publish("other", {"power": 100}, now=1))
+
+    def test_unchanged(self):
+        payload = {"online": True, "power": 100, "voltage": 230, "panel_1_voltage": 230}
+        self.assertFalse(self.cache.should_publish("topic", payload, now=1))
+
+    def test_within_deadband(self):
+        payload = {"online": True, "power": 100, "voltage": 231, "panel_1_voltage": 229}
+        self.assertFalse(self.cache.should_publish("topic", payload, now=1))
+
+    def test_outside_deadband(self):
+        payload = {"online": True, "power": 100, "voltage": 230, "panel_1_voltage": 231.5}
+        self.assertTrue(self.cache.should_publish("topic", payload, now=1))
+
+    def test_field_without_deadband(self):
+        payload = {"online": True, "power": 101, "voltage": 230, "panel_1_voltage": 230}
+        self.assertTrue(self.cache.should_publish("topic", payload, now=1))
+
+    def test_non_numeric_change(self):
+        payload = {"online": False, "power": 100, "voltage": 230, "panel_1_voltage": 230}
+        self.assertTrue(self.cache.should_publish("topic", payload, now=1))
+
+    def test_fields_change(self):
+        self.assertTrue(self.cache.should_publish("topic", {"online": False}, now=1))
+
+    def test_nested_payload(self):
+        self.cache.published("nested", {"inverters": {"1": {"voltage": 230}}}, now=0)
+        self.assertFalse(self.cache.should_publish("nested", {"inverters": {"1": {"voltage": 230.5}}}, now=1))
+        self.assertTrue(self.cache.should_publish("nested", {"inverters": {"1": {"voltage": 232}}}, now=1))
+
+    def test_full_refresh(self):
+        payload = {"online": True, "power": 100, "voltage": 230, "panel_1_voltage": 230}
+        self.assertTrue(self.cache.should_publish("topic", payload, now=600))
+
+    def test_clear(self):
+        self.cache.clear()
+        self.assertTrue(self.cache.should_publish("topic", {"online": True}, now=1))
+
+
+if __name__ == "__main__":
+    unittest.main()
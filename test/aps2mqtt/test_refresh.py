@@ -0,0 +1,81 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+from aps2mqtt.refresh import RefreshPredictor
+
+START = datetime(2025, 7, 20, 12, 0, 0, tzinfo=timezone.utc)
+
+
+class TestRefreshPredictor(unittest.TestCase):
+
+    def setUp(self):
+        self.predictor = RefreshPredictor()
+
+    def _receive(self, *offsets):
+        for offset in offsets:
+            self.predictor.data_received(START + timedelta(seconds=offset))
+
+    def test_default_period(self):
+        now = START + timedelta(seconds=10)
+        # Nothing received yet, poll again soon
+        self.assertEqual(self.predictor.next_update(now), now + timedelta(seconds=30))
+
+        self._receive(0)
+
+        self.assertEqual(self.predictor.period(), 300)
+        self.assertEqual(self.predictor.next_update(now), START + timedelta(seconds=330))
+
+    def test_median_period(self):
+        self._receive(0, 290, 580, 1200, 1500)
+
+        # The 620s interval is a missed refresh, ignored
+        self.assertEqual(self.predictor.period(), 295)
+        self.assertEqual(
+            self.predictor.next_update(START), START + timedelta(seconds=1500 + 295 + 30)
+        )
+
+    def test_is_stale(self):
+        self._receive(0)
+
+        self.assertTrue(self.predictor.is_stale(START))
+        self.assertFalse(self.predictor.is_stale(START + timedelta(seconds=300)))
+        # The ECU clock may have been set back
+        self.assertFalse(self.predictor.is_stale(START - timedelta(seconds=300)))
+
+    def test_stale_backoff(self):
+        self._receive(0)
+        now = START + timedelta(seconds=330)
+
+        delays = []
+        for _ in range(6):
+            self.predictor.stale()
+            delays.append((self.predictor.next_update(now) - now).total_seconds())
+
+        # Capped at the refresh period
+        self.assertEqual(delays, [30, 60, 120, 240, 300, 300])
+
+        self._receive(300)
+        self.assertEqual(self.predictor.stale_count, 0)
+        self.assertEqual(self.predictor.next_update(now), START + timedelta(seconds=630))
+
+    def test_error_backoff(self):
+        now = START
+
+        delays = []
+        for _ in range(6):
+            self.predictor.error()
+            delays.append((self.predictor.next_update(now) - now).total_seconds())
+
+        self.assertEqual(delays, [60, 120, 240, 480, 600, 600])
+
+        self.predictor.stale()
+        self.assertEqual(self.predictor.error_count, 0)
+
+    def test_earlier_timestamp_no_interval(self):
+        self._receive(600, 0)
+
+        self.assertEqual(len(self.predictor.intervals), 0)
+        self.assertEqual(self.predictor.last_timestamp, START)
+
+
+if __name__ == '__main__':
+    unittest.main()
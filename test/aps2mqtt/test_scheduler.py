@@ -0,0 +1,74 @@
+import asyncio
+import time
+import unittest
+from aps2mqtt.scheduler import Scheduler
+
+
+class TestScheduler(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.scheduler = Scheduler()
+        self.runs = []
+
+    def _job(self, name):
+        async def job():
+            self.runs.append(name)
+
+        return job
+
+    async def test_run_in_deadline_order(self):
+        self.scheduler.schedule_in(0.03, self._job("last"))
+        self.scheduler.schedule_in(0.01, self._job("first"))
+        self.scheduler.schedule_in(0.01, self._job("second"))
+
+        await asyncio.wait_for(self.scheduler.run(), 1)
+
+        self.assertEqual(self.runs, ["first", "second", "last"])
+        self.assertEqual(len(self.scheduler), 0)
+
+    async def test_rescheduled_job(self):
+        async def job():
+            self.runs.append(time.monotonic())
+            if len(self.runs) < 3:
+                self.scheduler.schedule_in(0.02, job)
+
+        self.scheduler.schedule_in(0, job)
+        await asyncio.wait_for(self.scheduler.run(), 1)
+
+        self.assertEqual(len(self.runs), 3)
+        self.assertGreaterEqual(self.runs[2] - self.runs[0], 0.04)
+
+    async def test_earlier_job_wakes_up_scheduler(self):
+        async def job():
+            self.runs.append("first")
+            self.scheduler.schedule_in(0.01, self._job("second"))
+
+        self.scheduler.schedule_in(0.2, self._job("last"))
+        self.scheduler.schedule_in(0, job)
+
+        await asyncio.wait_for(self.scheduler.run(), 1)
+
+        self.assertEqual(self.runs, ["first", "second", "last"])
+
+    async def test_failed_job(self):
+        async def job():
+            raise ValueError("failed")
+
+        self.scheduler.schedule_in(0, job)
+        self.scheduler.schedule_in(0.01, self._job("next"))
+
+        with self.assertLogs("aps2mqtt.scheduler", "ERROR"):
+            await asyncio.wait_for(self.scheduler.run(), 1)
+        self.assertEqual(self.runs, ["next"])
+
+    async def test_jitter(self):
+        scheduler = Scheduler(jitter=5, clock=lambda: 100)
+        for _ in range(20):
+            deadline = scheduler.schedule_in(10, self._job("job"))
+            self.assertGreaterEqual(deadline, 110)
+            self.assertLessEqual(deadline, 115)
+        self.assertEqual(scheduler.next_deadline(), min(entry[0] for entry in scheduler._queue))
+
+
+if __name__ == "__main__":
+    unittest.main()
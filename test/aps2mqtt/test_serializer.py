@@ -0,0 +1,56 @@
+import importlib.util
+import json
+import sys
+import unittest
+from unittest.mock import patch
+from aps2mqtt.serializer import get_serializer
+
+PAYLOAD = {
+    "current_power": 300,
+    "today_energy": 2.5,
+    "inverters": {"806000000001": {"online": True, "voltage": 240.5, "panel_1_power": 150}},
+}
+
+
+class TestSerializer(unittest.TestCase):
+
+    def test_json(self):
+        json_serializer = get_serializer("json")
+        self.assertEqual(json.loads(json_serializer.dumps(PAYLOAD)), PAYLOAD)
+
+    def test_json_without_orjson(self):
+        with patch.dict(sys.modules, {"orjson": None}):
+            encoded = get_serializer("json").dumps(PAYLOAD)
+        self.assertIsInstance(encoded, bytes)
+        self.assertEqual(json.loads(encoded), PAYLOAD)
+        self.assertNotIn(b" ", encoded)
+
+    @unittest.skipUnless(importlib.util.find_spec("msgpack"), "msgpack is not installed")
+    def test_msgpack(self):
+        import msgpack
+
+        msgpack_serializer = get_serializer("msgpack")
+        for _ in range(2):
+            self.assertEqual(msgpack.unpackb(msgpack_serializer.dumps(PAYLOAD)), PAYLOAD)
+
+    @unittest.skipUnless(importlib.util.find_spec("cbor2"), "cbor2 is not installed")
+    def test_cbor(self):
+        import cbor2
+
+        cbor_serializer = get_serializer("cbor")
+        self.assertEqual(cbor2.loads(cbor_serializer.dumps({"power": 1})), {"power": 1})
+        # The buffer is reused, the previous payload must not leak in the next one
+        self.assertEqual(cbor2.loads(cbor_serializer.dumps(PAYLOAD)), PAYLOAD)
+
+    def test_missing_package(self):
+        with patch.dict(sys.modules, {"msgpack": None}):
+            with self.assertRaises(ValueError):
+                get_serializer("msgpack")
+
+    def test_unknown_encoding(self):
+        with self.assertRaises(ValueError):
+            get_serializer("xml")
+
+
+if __name__ == "__main__":
+    unittest.main()
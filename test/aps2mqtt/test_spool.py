@@ -0,0 +1,51 @@
+import os
+import tempfile
+import unittest
+from aps2mqtt.spool import Spool
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "spool.db")
+        self.spool = Spool(self.path, max_messages=5)
+
+    def tearDown(self):
+        self.spool.close()
+        self.tmp_dir.cleanup()
+
+    def test_in_order(self):
+        self.spool.append([("a", b"1"), ("b", b"2")])
+        self.spool.append([("c", b"3")])
+
+        batch = self.spool.peek(2)
+
+        self.assertEqual([(topic, payload) for _, topic, payload in batch], [("a", b"1"), ("b", b"2")])
+        self.assertEqual(len(self.spool), 3)
+        self.spool.remove(batch[-1][0])
+        self.assertEqual([topic for _, topic, _ in self.spool.peek(10)], ["c"])
+        self.assertEqual(len(self.spool), 1)
+
+    def test_max_messages(self):
+        self.spool.append([("topic", b"%d" % index) for index in range(4)])
+
+        dropped = self.spool.append([("topic", b"4"), ("topic", b"5"), ("topic", b"6")])
+
+        # Oldest messages dropped first
+        self.assertEqual(dropped, 2)
+        self.assertEqual(len(self.spool), 5)
+        self.assertEqual([payload for _, _, payload in self.spool.peek(10)], [b"2", b"3", b"4", b"5", b"6"])
+
+    def test_persistence(self):
+        self.spool.append([("a", b"1"), ("b", b"2")])
+        self.spool.close()
+
+        self.spool = Spool(self.path)
+
+        self.assertEqual(len(self.spool), 2)
+        self.assertEqual([topic for _, topic, _ in self.spool.peek(10)], ["a", "b"])
+
+
+if __name__ == '__main__':
+    unittest.main()
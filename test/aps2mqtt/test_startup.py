@@ -0,0 +1,71 @@
+import os
+import subprocess
+import sys
+import unittest
+import aps2mqtt
+
+SRC_PATH = os.path.dirname(os.path.dirname(aps2mqtt.__file__))
+
+# Only needed by optional features or rare events, imported when first needed
+COLD_MODULES = (
+    "requests",
+    "numpy",
+    "yaml",
+    "suntime",
+    "dateutil",
+    "certifi",
+    "multiprocessing",
+    "http.server",
+    "orjson",
+    "msgpack",
+    "cbor2",
+    "sqlite3",
+)
+
+# Cumulative import time of aps2mqtt.main, mostly asyncio and paho. numpy or requests
+# alone would take about 100 ms more.
+IMPORT_TIME_BUDGET_US = 250000
+
+IMPORT_SCRIPT = """
+import sys
+before = set(sys.modules)
+import aps2mqtt.main
+print("\\n".join(sorted(set(sys.modules) - before)))
+"""
+
+
+class TestStartup(unittest.TestCase):
+
+    def _import_main(self):
+        env = dict(
+            os.environ,
+            PYTHONPATH=os.pathsep.join(filter(None, [SRC_PATH, os.getenv("PYTHONPATH")])),
+        )
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", IMPORT_SCRIPT],
+            capture_output=True,
+            text=True,
+            env=env,
+            check=True,
+        )
+        imported = set(result.stdout.split())
+        main_line = [
+            line for line in result.stderr.splitlines() if line.endswith("| aps2mqtt.main")
+        ]
+        return imported, int(main_line[0].split("|")[1])
+
+    def test_cold_modules_not_imported(self):
+        imported, _ = self._import_main()
+
+        for module in COLD_MODULES:
+            self.assertNotIn(module, imported)
+
+    def test_import_time_budget(self):
+        # Best of a few runs, a busy machine only slows some of them down
+        import_time = min(self._import_main()[1] for _ in range(3))
+
+        self.assertLess(import_time, IMPORT_TIME_BUDGET_US)
+
+
+if __name__ == "__main__":
+    unittest.main()